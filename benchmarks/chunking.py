@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput of content-defined chunking, as done for `bigstore-chunked` files.
+
+    python benchmarks/chunking.py [--size MB] [FILE ...]
+
+Splits each sample (random data by default) with the native `_cdc` scan, if
+it's built, and with the pure-Python one, reporting MB/s and the number of
+chunks found. Build the extension first with
+`python setup.py build_ext --inplace`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bigstore import chunking  # noqa: E402
+
+
+def measure(data, native):
+    saved = chunking._cdc
+    if not native:
+        chunking._cdc = None
+    try:
+        start = time.time()
+        count = sum(1 for _ in chunking.chunks(io.BytesIO(data)))
+        seconds = time.time() - start
+    finally:
+        chunking._cdc = saved
+    return count, len(data) / (1024 * 1024) / max(seconds, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="representative assets to chunk")
+    parser.add_argument("--size", type=int, default=32, help="MB of random data to chunk if no files are given")
+    args = parser.parse_args()
+
+    if args.files:
+        samples = []
+        for filename in args.files:
+            with open(filename, 'rb') as file:
+                samples.append((os.path.basename(filename), file.read()))
+    else:
+        samples = [("random", os.urandom(args.size * 1024 * 1024))]
+
+    print("{:<12} {:<8} {:>8} {:>9}".format("sample", "scan", "chunks", "MB/s"))
+    for sample_name, data in samples:
+        scans = ([("native", True)] if chunking._cdc is not None else []) + [("python", False)]
+        for scan_name, native in scans:
+            count, speed = measure(data, native)
+            print("{:<12} {:<8} {:>8} {:>9.1f}".format(sample_name, scan_name, count, speed))
+            sys.stdout.flush()
+        if chunking._cdc is None:
+            print("(the _cdc extension isn't built, so only the pure-Python scan was measured)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare compression ratio and throughput of the available bigstore codecs.
+
+    python benchmarks/compression.py [--levels] [FILE ...]
+
+Without files, a few synthetic samples are generated: text, incompressible
+random data, and a mix of the two (like a typical binary asset with embedded
+metadata and compressed payloads).
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bigstore.compression import codecs, compress_file, decompress_file
+
+sample_size = 16 * 1024 * 1024
+
+
+def synthetic_samples():
+    words = [u"bigstore", u"object", u"asset", u"texture", u"vertex", u"frame", u"layer", u"0x3f", u"\n"]
+    rng = random.Random(0)
+
+    text = u" ".join(rng.choice(words) for _ in range(sample_size // 6)).encode('utf-8')[:sample_size]
+    noise = os.urandom(sample_size)
+    mixed = b"".join(text[i:i + 65536] if (i // 65536) % 2 else noise[i:i + 65536]
+                     for i in range(0, sample_size, 65536))
+    return [("text", text), ("random", noise), ("mixed", mixed)]
+
+
+def measure(codec, level, data):
+    compressed = io.BytesIO()
+    start = time.time()
+    compress_file(codec, io.BytesIO(data), compressed, level)
+    compress_time = time.time() - start
+
+    compressed.seek(0)
+    decompressed = io.BytesIO()
+    start = time.time()
+    decompress_file(codec, compressed, decompressed)
+    decompress_time = time.time() - start
+
+    if decompressed.getvalue() != data:
+        raise AssertionError("{} level {} didn't round-trip".format(codec.name, level))
+
+    megabytes = len(data) / (1024 * 1024)
+    return (len(compressed.getvalue()) / len(data),
+            megabytes / max(compress_time, 1e-9),
+            megabytes / max(decompress_time, 1e-9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="representative assets to compress")
+    parser.add_argument("--levels", action="store_true", help="measure every level instead of just the default")
+    args = parser.parse_args()
+
+    if args.files:
+        samples = []
+        for filename in args.files:
+            with open(filename, 'rb') as file:
+                samples.append((os.path.basename(filename), file.read()))
+    else:
+        samples = synthetic_samples()
+
+    print("{:<12} {:<6} {:>6} {:>8} {:>14} {:>16}".format(
+        "sample", "codec", "level", "ratio", "compress MB/s", "decompress MB/s"))
+    for sample_name, data in samples:
+        for name in sorted(codecs):
+            codec = codecs[name]
+            levels = codec.levels if args.levels else [codec.default_level]
+            for level in levels:
+                ratio, compress_speed, decompress_speed = measure(codec, level, data)
+                print("{:<12} {:<6} {:>6} {:>8.3f} {:>14.1f} {:>16.1f}".format(
+                    sample_name, name, level, ratio, compress_speed, decompress_speed))
+                sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
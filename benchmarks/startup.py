@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure how long git-bigstore takes to start, which is what every filter
+invocation pays.
+
+    python benchmarks/startup.py [--runs N]
+
+Reports the time to import the bigstore package, then the wall time and the
+number of git subprocesses for a few commands that do (almost) no work, run in
+a scratch repository.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+script = os.path.join(root, 'bin', 'git-bigstore')
+
+pointer = b"bigstore\nsha1\n0123456789abcdef0123456789abcdef01234567\n"
+
+
+def import_time(environment):
+    """ :return: seconds spent importing bigstore, according to -X importtime """
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import bigstore"],
+                               env=environment, stderr=subprocess.PIPE)
+    _, output = process.communicate()
+    for line in reversed(output.decode('utf-8').splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "bigstore":
+            return int(fields[1]) / 1e6
+
+
+def git_shim(directory):
+    """
+    Put a `git` first on the PATH that logs each invocation before running the
+    real one.
+
+    :return: path of the invocation log
+    """
+    real_git = None
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        candidate = os.path.join(path, "git")
+        if os.access(candidate, os.X_OK):
+            real_git = candidate
+            break
+
+    log_filename = os.path.join(directory, "git.log")
+    shim = os.path.join(directory, "bin", "git")
+    os.makedirs(os.path.dirname(shim))
+    with open(shim, "w") as file:
+        file.write('#!/bin/sh\necho "$*" >> "{}"\nexec "{}" "$@"\n'.format(log_filename, real_git))
+    os.chmod(shim, 0o755)
+    return log_filename
+
+
+def measure(arguments, input_data, environment, cwd, log_filename, runs):
+    """ :return: (median seconds, git subprocesses per run) """
+    if os.path.exists(log_filename):
+        os.unlink(log_filename)
+
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, script] + arguments, env=environment, cwd=cwd,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate(input_data)
+        times.append(time.time() - start)
+
+    try:
+        with open(log_filename) as file:
+            invocations = len(file.readlines())
+    except IOError:
+        invocations = 0
+    return sorted(times)[len(times) // 2], invocations / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20, help="runs per command (default: 20)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bigstore-startup-")
+    try:
+        repository = os.path.join(directory, "repository")
+        subprocess.check_call(["git", "init", "-q", repository])
+        with open(os.path.join(repository, ".bigstore"), "w") as file:
+            file.write("[bigstore]\n\tbackend = s3\n[bigstore \"s3\"]\n\tbucket = bigstore\n")
+
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [root, environment.get("PYTHONPATH")]))
+
+        print("import bigstore: {:.1f} ms".format(import_time(environment) * 1000))
+
+        log_filename = git_shim(directory)
+        environment["PATH"] = os.pathsep.join([os.path.join(directory, "bin"), environment.get("PATH", "")])
+
+        commands = [
+            ("--help", ["--help"], b""),
+            ("filter-clean (small file)", ["filter-clean"], b"hello\n" * 100),
+            ("filter-clean (pointer)", ["filter-clean"], pointer),
+            ("filter-smudge (not a pointer)", ["filter-smudge"], b"hello\n"),
+        ]
+        print("{:<32} {:>10} {:>14}".format("command", "median ms", "git processes"))
+        for name, arguments, input_data in commands:
+            seconds, invocations = measure(arguments, input_data, environment, repository, log_filename, args.runs)
+            print("{:<32} {:>10.1f} {:>14.1f}".format(name, seconds * 1000, invocations))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
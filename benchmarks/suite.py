@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end throughput of git-bigstore against the local backend.
+
+    python benchmarks/suite.py [--profile NAME ...] [--scale N] [--jobs N]
+                               [--latency SECONDS] [--bandwidth BYTES]
+
+Each profile is a synthetic repository, generated from a fixed seed. For each
+one the suite times:
+
+    add       `git add` of every file (the clean filter)
+    push      `git bigstore push` to a local backend directory
+    pull      `git bigstore pull` into a fresh clone
+    checkout  `git checkout` of every file from the local object store (the
+              smudge filter)
+
+and reports files/s, MB/s, the number of git processes started (counted from
+git's trace2 events, which also cover git commands run by the filters) and the
+peak RSS of any process involved. --latency and --bandwidth make the backend
+behave like a remote store.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import binascii
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+script = os.path.join(root, 'bin', 'git-bigstore')
+
+# name -> list of (number of files, size of each, kind of data)
+profiles = {
+    'small': [(2000, 4 * 1024, 'text'), (2000, 4 * 1024, 'random')],
+    'large': [(2, 64 * 1024 * 1024, 'text'), (2, 64 * 1024 * 1024, 'random')],
+    'mixed': [(500, 16 * 1024, 'text'), (100, 512 * 1024, 'random'), (4, 16 * 1024 * 1024, 'mixed')],
+}
+
+# Text files go through bigstore-compress, so that compression is measured too.
+attributes = "*.txt filter=bigstore-compress\n*.bin filter=bigstore\n*.mix filter=bigstore-compress\n"
+
+# Runs a command and reports the peak RSS of everything it started, since a
+# process's RUSAGE_CHILDREN covers every descendant it (transitively) waited
+# for.
+rusage_wrapper = """
+import json, resource, subprocess, sys
+returncode = subprocess.call(sys.argv[2:])
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(sys.argv[1], "w") as file:
+    json.dump({"returncode": returncode, "maxrss": usage.ru_maxrss}, file)
+"""
+
+words = [b"bigstore", b"object", b"asset", b"texture", b"vertex", b"frame", b"layer", b"0x3f", b"\n"]
+
+
+def random_bytes(rng, size):
+    """ `size` bytes from `rng`, a block of random bits at a time. """
+    blocks = []
+    for offset in range(0, size, 1024 * 1024):
+        length = min(size - offset, 1024 * 1024)
+        blocks.append(binascii.unhexlify("{:0{}x}".format(rng.getrandbits(length * 8), length * 2)))
+    return b"".join(blocks)
+
+
+def generate(rng, size, kind):
+    if kind == 'random':
+        # Generated in full, since repeating a block would let it compress.
+        return random_bytes(rng, size)
+    if kind == 'text':
+        data = b" ".join(rng.choice(words) for _ in range(min(size, 1024 * 1024) // 6))
+        return (data * (size // len(data) + 1))[:size]
+    return (generate(rng, size // 2, 'text') + generate(rng, size - size // 2, 'random'))[:size]
+
+
+def write_files(directory, profile, scale):
+    """ :return: (number of files, total bytes) """
+    rng = random.Random(0)
+    extensions = {'text': 'txt', 'random': 'bin', 'mixed': 'mix'}
+    count = 0
+    total = 0
+    for group, (files, size, kind) in enumerate(profiles[profile]):
+        files = max(1, int(files * scale))
+        subdirectory = os.path.join(directory, "group{}".format(group))
+        os.makedirs(subdirectory)
+        # Files of the same kind and size differ only in their first bytes, so
+        # they're distinct objects without generating everything from scratch.
+        template = generate(rng, size, kind)
+        for index in range(files):
+            filename = os.path.join(subdirectory, "{:05d}.{}".format(index, extensions[kind]))
+            data = "{:08d}".format(index).encode('ascii') + template[8:]
+            with open(filename, 'wb') as file:
+                file.write(data)
+            count += 1
+            total += len(data)
+    return count, total
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(("git",) + args, stdout=subprocess.PIPE, **kwargs)
+
+
+def configure(repository, args):
+    git("config", "user.name", "Benchmark", cwd=repository)
+    git("config", "user.email", "benchmark@example.com", cwd=repository)
+    for filter_name in ("bigstore", "bigstore-compress"):
+        git("config", "filter.{}.clean".format(filter_name), "git-bigstore filter-clean", cwd=repository)
+        git("config", "filter.{}.smudge".format(filter_name), "git-bigstore filter-smudge", cwd=repository)
+        git("config", "filter.{}.process".format(filter_name), "git-bigstore filter-process", cwd=repository)
+    git("config", "bigstore.local.latency", str(args.latency), cwd=repository)
+    if args.bandwidth:
+        git("config", "bigstore.local.bandwidth", str(args.bandwidth), cwd=repository)
+
+
+def run(command, cwd, environment, trace_filename):
+    """
+    Run a command, timing it and counting the git processes it starts.
+
+    :return: (seconds, git processes, peak RSS in bytes)
+    """
+    if os.path.exists(trace_filename):
+        os.unlink(trace_filename)
+    environment = dict(environment, GIT_TRACE2_EVENT=trace_filename)
+
+    fd, result_filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", rusage_wrapper, result_filename] + command,
+                              cwd=cwd, env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        seconds = time.time() - start
+        with open(result_filename) as file:
+            result = json.load(file)
+    finally:
+        os.unlink(result_filename)
+
+    if result["returncode"] != 0:
+        raise RuntimeError("{} failed with status {}".format(" ".join(command), result["returncode"]))
+
+    invocations = 0
+    try:
+        with open(trace_filename) as file:
+            for line in file:
+                if '"event":"start"' in line:
+                    invocations += 1
+    except IOError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    maxrss = result["maxrss"] * (1 if sys.platform == "darwin" else 1024)
+    return seconds, invocations, maxrss
+
+
+def benchmark(profile, args, directory):
+    bin_directory = os.path.join(directory, "bin")
+    os.makedirs(bin_directory)
+    trace_filename = os.path.join(directory, "trace2.json")
+    with open(os.path.join(bin_directory, "git-bigstore"), "w") as file:
+        file.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, script))
+    os.chmod(os.path.join(bin_directory, "git-bigstore"), 0o755)
+
+    environment = dict(os.environ)
+    environment["PATH"] = os.pathsep.join([bin_directory, environment.get("PATH", "")])
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [root, environment.get("PYTHONPATH")]))
+
+    origin = os.path.join(directory, "origin.git")
+    work = os.path.join(directory, "work")
+    clone = os.path.join(directory, "clone")
+    remote = os.path.join(directory, "remote")
+
+    git("init", "-q", "--bare", origin)
+    git("init", "-q", work)
+    configure(work, args)
+    with open(os.path.join(work, ".gitattributes"), "w") as file:
+        file.write(attributes)
+    with open(os.path.join(work, ".bigstore"), "w") as file:
+        file.write("[bigstore]\n\tbackend = local\n[bigstore \"local\"]\n\tpath = {}\n".format(remote))
+    git("remote", "add", "origin", origin, cwd=work)
+
+    files, size = write_files(work, profile, args.scale)
+    results = []
+
+    def record(command, seconds, invocations, maxrss):
+        results.append((profile, command, files, size, seconds, invocations, maxrss))
+
+    jobs = ["--jobs", str(args.jobs)]
+
+    record("add", *run(["git", "add", "-A"], work, environment, trace_filename))
+    git("commit", "-q", "-m", "benchmark", cwd=work, env=environment)
+    git("push", "-q", "origin", "HEAD:refs/heads/master", cwd=work, env=environment)
+    record("push", *run(["git-bigstore", "push"] + jobs, work, environment, trace_filename))
+
+    # Clone without the filters, so that the checkout holds pointers for pull
+    # to replace.
+    git("clone", "-q", origin, clone, env=environment)
+    configure(clone, args)
+    record("pull", *run(["git-bigstore", "pull"] + jobs, clone, environment, trace_filename))
+
+    for name in os.listdir(clone):
+        if name.startswith("group"):
+            shutil.rmtree(os.path.join(clone, name))
+    record("checkout", *run(["git", "checkout", "--", "."], clone, environment, trace_filename))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", action="append", choices=sorted(profiles),
+                        help="repository profile to run (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the number of files in each profile by this")
+    parser.add_argument("--jobs", type=int, default=4, help="concurrent transfers for push and pull")
+    parser.add_argument("--latency", type=float, default=0, help="seconds of latency per backend request")
+    parser.add_argument("--bandwidth", help="backend bandwidth in bytes per second, e.g. 100m")
+    args = parser.parse_args()
+
+    print("{:<8} {:<9} {:>6} {:>9} {:>9} {:>9} {:>9} {:>6} {:>9}".format(
+        "profile", "command", "files", "MB", "seconds", "files/s", "MB/s", "git", "RSS MB"))
+    for profile in args.profile or sorted(profiles):
+        directory = tempfile.mkdtemp(prefix="bigstore-benchmark-")
+        try:
+            for profile, command, files, size, seconds, invocations, maxrss in benchmark(profile, args, directory):
+                megabytes = size / (1024 * 1024)
+                print("{:<8} {:<9} {:>6} {:>9.1f} {:>9.2f} {:>9.1f} {:>9.1f} {:>6} {:>9.1f}".format(
+                    profile, command, files, megabytes, seconds, files / max(seconds, 1e-9),
+                    megabytes / max(seconds, 1e-9), invocations, maxrss / (1024 * 1024)))
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
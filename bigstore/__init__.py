@@ -31,15 +31,21 @@ from .bigstore import (
     init,
     push,
     pull,
+    checkout,
+    prune,
     log,
-    fetch
+    fetch,
+    compact_notes
 )
 
+from .filter_process import filter_process
+
 from . import backends
 
 __all__ = [
     '__author__', '__copyright__', '__email__', '__license__',
     '__maintainer__', '__version__', 'filter_smudge', 'filter_clean',
-    'init', 'push', 'pull', 'backends', 'log', 'fetch'
+    'filter_process', 'init', 'push', 'pull', 'checkout', 'prune', 'backends', 'log', 'fetch',
+    'compact_notes'
 ]
 
@@ -0,0 +1,125 @@
+/*
+ * Copyright 2015-2017 Lionheart Software LLC
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/*
+ * Native version of bigstore.chunking.cut_point(). The gear table, sizes and
+ * masks are passed in from chunking.py, so that there's one definition of the
+ * format, and the scan runs without the GIL so that several files can be
+ * chunked at once.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define BUFFER_FORMAT "y*"
+#else
+#define BUFFER_FORMAT "s*"
+#endif
+
+static Py_ssize_t
+scan(const unsigned char *data, Py_ssize_t start, Py_ssize_t end, const uint64_t *gear,
+     Py_ssize_t min_size, Py_ssize_t average_size, Py_ssize_t max_size,
+     uint64_t mask_small, uint64_t mask_large)
+{
+    Py_ssize_t length = end - start;
+    Py_ssize_t normal, limit, position;
+    uint64_t fingerprint = 0;
+
+    if (length <= min_size)
+        return length;
+
+    normal = start + (average_size < length ? average_size : length);
+    limit = start + (max_size < length ? max_size : length);
+
+    for (position = start + min_size; position < normal; position++) {
+        fingerprint = (fingerprint << 1) + gear[data[position]];
+        if (!(fingerprint & mask_small))
+            return position + 1 - start;
+    }
+
+    for (; position < limit; position++) {
+        fingerprint = (fingerprint << 1) + gear[data[position]];
+        if (!(fingerprint & mask_large))
+            return position + 1 - start;
+    }
+
+    return limit - start;
+}
+
+static PyObject *
+cut_point(PyObject *self, PyObject *args)
+{
+    Py_buffer data, gear_buffer;
+    Py_ssize_t start, end, min_size, average_size, max_size, result;
+    unsigned long long mask_small, mask_large;
+    uint64_t gear[256];
+    const unsigned char *packed;
+    int i, j;
+
+    if (!PyArg_ParseTuple(args, BUFFER_FORMAT "nn" BUFFER_FORMAT "nnnKK", &data, &start, &end, &gear_buffer,
+                          &min_size, &average_size, &max_size, &mask_small, &mask_large))
+        return NULL;
+
+    if (gear_buffer.len != 256 * 8 || start < 0 || start > end || end > data.len) {
+        PyBuffer_Release(&data);
+        PyBuffer_Release(&gear_buffer);
+        PyErr_SetString(PyExc_ValueError, "invalid gear table or range");
+        return NULL;
+    }
+
+    /* The table is packed little-endian, whatever the host's byte order. */
+    packed = (const unsigned char *)gear_buffer.buf;
+    for (i = 0; i < 256; i++) {
+        gear[i] = 0;
+        for (j = 7; j >= 0; j--)
+            gear[i] = (gear[i] << 8) | packed[i * 8 + j];
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    result = scan((const unsigned char *)data.buf, start, end, gear, min_size, average_size, max_size,
+                  (uint64_t)mask_small, (uint64_t)mask_large);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&gear_buffer);
+    return PyLong_FromSsize_t(result);
+}
+
+static PyMethodDef methods[] = {
+    {"cut_point", cut_point, METH_VARARGS,
+     "cut_point(data, start, end, gear, min_size, average_size, max_size, mask_small, mask_large)"},
+    {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_cdc", NULL, -1, methods
+};
+
+PyMODINIT_FUNC
+PyInit__cdc(void)
+{
+    return PyModule_Create(&module);
+}
+#else
+PyMODINIT_FUNC
+init_cdc(void)
+{
+    Py_InitModule("_cdc", methods);
+}
+#endif
@@ -17,6 +17,8 @@
 from .s3 import S3Backend
 from .rackspace import RackspaceBackend
 from .google import GoogleBackend
+from .local import LocalBackend
+from .registry import BackendRegistry
 
-__all__ = ['S3Backend', 'RackspaceBackend', 'GoogleBackend']
+__all__ = ['S3Backend', 'RackspaceBackend', 'GoogleBackend', 'LocalBackend', 'BackendRegistry']
 
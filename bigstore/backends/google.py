@@ -13,13 +13,20 @@
 # limitations under the License.
 
 from builtins import object
-try:
-    import boto
-except ImportError:
-    pass
+# Imported once a backend is built, since boto takes a while to load.
+boto = None
 
 class GoogleBackend(object):
+    # Boto2 connections can't be shared between threads.
+    thread_safe = False
+
     def __init__(self, key, secret, bucket_name):
+        global boto
+        if boto is None:
+            import boto
+            import boto.exception
+            import boto.s3.bucket
+            import boto.s3.key
         self.access_key = key
         self.secret = secret
         self.bucket = bucket_name
@@ -39,6 +46,38 @@ class GoogleBackend(object):
     def pull(self, file, hash, cb=None):
         self.key(hash).get_contents_to_file(file, cb=cb)
 
+    def stream(self, hash, chunk_size=1024*1024):
+        """ Yield the object's contents in chunks as they arrive. """
+        key = self.key(hash)
+        key.open_read()
+        try:
+            while True:
+                data = key.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            key.close()
+
+    def read_range(self, hash, offset, length):
+        """ :return: `length` bytes of the object, starting at `offset` """
+        return self.key(hash).get_contents_as_string(
+            headers={'Range': "bytes={}-{}".format(offset, offset + length - 1)})
+
+    def list(self, prefix):
+        """ Yield the hash of every object whose hash starts with the two characters in `prefix`. """
+        for key in self.bucket.list(prefix="{}/".format(prefix)):
+            yield key.name.replace("/", "", 1)
+
     def exists(self, hash):
         return self.key(hash).exists()
 
+    def classify_error(self, error):
+        """ :return: "throttled" or "transient" for errors worth retrying, otherwise None """
+        if isinstance(error, boto.exception.BotoServerError):
+            if error.status in (429, 503):
+                return 'throttled'
+            if error.status in (500, 502, 504):
+                return 'transient'
+        return None
+
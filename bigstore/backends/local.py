@@ -0,0 +1,146 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import os
+import tempfile
+import threading
+import time
+
+from ..compat import replace
+
+try:
+    from urllib.parse import urlparse, unquote
+except ImportError:
+    from urlparse import urlparse
+    from urllib import unquote
+
+chunk_size = 1024 * 1024
+
+
+class LocalBackend(object):
+    """
+    Objects stored in a directory (a local disk, a network share, ...) laid out
+    the same way as in a bucket.
+
+    `latency` (seconds per request) and `bandwidth` (bytes per second, shared by
+    every transfer through the backend) can be set to make the directory
+    behave more like a remote store, e.g. for benchmarking.
+    """
+
+    thread_safe = True
+
+    def __init__(self, path, latency=None, bandwidth=None):
+        if path.startswith("file://"):
+            path = unquote(urlparse(path).path)
+        self.path = path
+        self.latency = latency or 0
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.link_free_at = 0
+
+    @property
+    def name(self):
+        return "local"
+
+    def filename(self, hash):
+        return os.path.join(self.path, hash[:2], hash[2:])
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def throttle(self, size):
+        """ Wait as long as sending `size` bytes over the simulated link would take. """
+        if not self.bandwidth:
+            return
+
+        with self.lock:
+            start = max(time.time(), self.link_free_at)
+            self.link_free_at = start + size / float(self.bandwidth)
+            finish = self.link_free_at
+
+        delay = finish - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def copy(self, source, destination, cb=None):
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            self.throttle(len(data))
+            destination.write(data)
+            if cb:
+                cb(len(data))
+
+    def push(self, file, hash, cb=None):
+        self.request()
+        filename = self.filename(hash)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".push-")
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                self.copy(file, destination, cb)
+            replace(temporary_filename, filename)
+        except BaseException:
+            os.unlink(temporary_filename)
+            raise
+
+    def pull(self, file, hash, cb=None):
+        self.request()
+        with open(self.filename(hash), 'rb') as source:
+            self.copy(source, file, cb)
+
+    def stream(self, hash, chunk_size=chunk_size):
+        """ Yield the object's contents in chunks. """
+        self.request()
+        with open(self.filename(hash), 'rb') as source:
+            while True:
+                data = source.read(chunk_size)
+                if not data:
+                    break
+                self.throttle(len(data))
+                yield data
+
+    def read_range(self, hash, offset, length):
+        """ :return: `length` bytes of the object, starting at `offset` """
+        self.request()
+        with open(self.filename(hash), 'rb') as source:
+            source.seek(offset)
+            data = source.read(length)
+        self.throttle(len(data))
+        return data
+
+    def list(self, prefix):
+        """ Yield the hash of every object whose hash starts with the two characters in `prefix`. """
+        self.request()
+        try:
+            names = os.listdir(os.path.join(self.path, prefix))
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith("."):
+                yield prefix + name
+
+    def exists(self, hash):
+        self.request()
+        return os.path.exists(self.filename(hash))
@@ -13,13 +13,19 @@
 # limitations under the License.
 
 from builtins import object
-try:
-    import cloudfiles
-except ImportError:
-    pass
+# Imported once a backend is built, so that commands that never touch the
+# network don't load it.
+cloudfiles = None
 
 class RackspaceBackend(object):
+    # Cloudfiles connections can't be shared between threads.
+    thread_safe = False
+
     def __init__(self, username, api_key, container_name):
+        global cloudfiles
+        if cloudfiles is None:
+            import cloudfiles
+            import cloudfiles.errors
         self.username = username
         self.api_key = api_key
         self.conn = cloudfiles.Connection(username=username, api_key=api_key)
@@ -33,12 +39,40 @@ class RackspaceBackend(object):
         return cloudfiles.Object(container=self.container, name="{}/{}".format(hash[:2], hash[2:]))
 
     def push(self, file, hash, cb=None):
-        self.key(hash).load_from_filename(file.name, callback=cb)
+        self.key(hash).write(file, callback=cb)
 
     def pull(self, file, hash, cb=None):
         self.key(hash).save_to_filename(file.name, callback=cb)
 
+    def stream(self, hash, chunk_size=1024*1024):
+        """ Yield the object's contents in chunks as they arrive. """
+        return self.key(hash).stream(chunksize=chunk_size)
+
+    def read_range(self, hash, offset, length):
+        """ :return: `length` bytes of the object, starting at `offset` """
+        return self.key(hash).read(size=length, offset=offset)
+
+    def list(self, prefix):
+        """ Yield the hash of every object whose hash starts with the two characters in `prefix`. """
+        marker = None
+        while True:
+            names = self.container.list_objects(prefix="{}/".format(prefix), marker=marker)
+            if not names:
+                break
+            for name in names:
+                yield name.replace("/", "", 1)
+            marker = names[-1]
+
     def exists(self, hash):
         return self.key(hash).etag is not None
 
+    def classify_error(self, error):
+        """ :return: "throttled" or "transient" for errors worth retrying, otherwise None """
+        if isinstance(error, cloudfiles.errors.ResponseError):
+            if error.status in (429, 498, 503):
+                return 'throttled'
+            if error.status in (500, 502, 504):
+                return 'transient'
+        return None
+
 
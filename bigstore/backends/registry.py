@@ -0,0 +1,52 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import threading
+
+
+class BackendRegistry(object):
+    """
+    Builds each backend once per process and hands the same instance back
+    whenever it's asked for with the same configuration, so that sessions,
+    credentials and connection pools are set up once rather than per file.
+
+    Backends whose clients are safe to use from several threads at once (those
+    with `thread_safe = True`) are shared by every thread. Anything else is
+    built once per thread.
+
+    Usage:
+
+        registry = BackendRegistry()
+        backend = registry.get(S3Backend, bucket_name, part_size=part_size)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shared = {}
+        self.local = threading.local()
+
+    def get(self, cls, *args, **kwargs):
+        key = (cls, args, tuple(sorted(kwargs.items())))
+        if getattr(cls, 'thread_safe', False):
+            with self.lock:
+                if key not in self.shared:
+                    self.shared[key] = cls(*args, **kwargs)
+                return self.shared[key]
+
+        if not hasattr(self.local, 'backends'):
+            self.local.backends = {}
+        if key not in self.local.backends:
+            self.local.backends[key] = cls(*args, **kwargs)
+        return self.local.backends[key]
@@ -13,18 +13,87 @@
 # limitations under the License.
 
 from builtins import object
+import hashlib
+import json
+import os
 import sys
+import threading
+
+from ..compat import pread, pwrite, replace
+
+# boto3 takes a while to import, so it's only loaded once an S3 backend is
+# actually built.
+boto3 = None
+botocore = None
+ThreadPoolExecutor = None
+
+
+def import_sdk():
+    global boto3, botocore, ThreadPoolExecutor
+    if boto3 is None:
+        import boto3
+        import boto3.s3.transfer
+        import botocore
+        import botocore.config
+        from concurrent.futures import ThreadPoolExecutor
+
+# boto3's own defaults.
+default_part_size = 8 * 1024 * 1024
+default_max_concurrency = 10
+
+# S3 refuses multipart uploads with more parts than this.
+max_parts = 10000
+
+# Error codes S3 (and S3-compatible stores) answer with when requests should
+# slow down, and ones that are worth trying again.
+throttling_codes = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                    'RequestThrottled', 'ServiceUnavailable', '429', '503')
+transient_codes = ('InternalError', 'RequestTimeout', 'RequestTimeTooSkewed', '500', '502', '504')
 
-try:
-    import boto3
-    import botocore
-except ImportError:
-    pass
 
 class S3Backend(object):
-    def __init__(self, bucket_name):
+    """
+    Objects larger than one part are uploaded as multipart uploads and
+    downloaded with ranged GETs, `max_concurrency` parts at a time.
+
+    When a `state_directory` is given, transfers of large objects can be
+    resumed: the id of an unfinished multipart upload is kept in a sidecar file
+    there, and downloads are written into a partial file whose finished parts
+    are recorded alongside it. An interrupted transfer picks up where it left
+    off the next time the same object is pushed or pulled.
+
+    boto3 clients are thread-safe, so one backend (and its connection pool)
+    can serve every transfer thread. The pool is sized for `jobs` threads each
+    with `max_concurrency` requests in flight, unless `max_pool_connections`
+    says otherwise; connections are only opened as they're needed.
+
+    An upload that's abandoned rather than resumed (because the file changed
+    size, say) is aborted, so that its parts don't go on being stored. Ones
+    that are never pushed again are left to the bucket's lifecycle rules.
+    """
+
+    thread_safe = True
+
+    def __init__(self, bucket_name, part_size=None, max_concurrency=None, endpoint_url=None,
+                 state_directory=None, max_pool_connections=None, jobs=None):
+        import_sdk()
         self.bucket = bucket_name
-        self.s3_client = aws(type="client", service_name="s3")
+        self.part_size = part_size or default_part_size
+        self.max_concurrency = max_concurrency or default_max_concurrency
+        self.state_directory = state_directory
+
+        kwargs = {
+            'config': botocore.config.Config(
+                max_pool_connections=max_pool_connections or max(1, jobs or 1) * self.max_concurrency),
+        }
+        if endpoint_url:
+            # e.g. a local S3-compatible server like MinIO
+            kwargs['endpoint_url'] = endpoint_url
+        self.s3_client = aws(type="client", service_name="s3", **kwargs)
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=self.max_concurrency)
 
     @property
     def name(self):
@@ -33,11 +102,227 @@ class S3Backend(object):
     def get_remote_file_name(self, hash):
         return "{}/{}".format(hash[:2], hash[2:])
 
+    def state_filename(self, hash, kind):
+        return os.path.join(self.state_directory, "{}.{}".format(hash, kind))
+
+    def parts(self, size):
+        """ :return: list of (part number, offset, length) covering `size` bytes """
+        part_size = max(self.part_size, -(-size // max_parts))
+        return [(number + 1, offset, min(part_size, size - offset))
+                for number, offset in enumerate(range(0, size, part_size))]
+
     def push(self, file, hash, cb=None):
-        self.s3_client.upload_file(file.name, self.bucket, self.get_remote_file_name(hash), Callback=cb)
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell() - position
+        file.seek(position)
+        if self.state_directory is None or size <= self.part_size:
+            self.s3_client.upload_fileobj(file, self.bucket, self.get_remote_file_name(hash),
+                                          Callback=cb, Config=self.transfer_config)
+            if self.state_directory is not None:
+                # A multipart upload from before the part size was raised.
+                state_filename = self.state_filename(hash, "upload")
+                state = read_state(state_filename)
+                if state and state.get('upload_id'):
+                    self.abort_upload(self.get_remote_file_name(hash), state['upload_id'])
+                    remove_state(state_filename)
+        else:
+            self.push_multipart(file, hash, size, locked_callback(cb))
+
+    def push_multipart(self, file, hash, size, cb):
+        key = self.get_remote_file_name(hash)
+        state_filename = self.state_filename(hash, "upload")
+        parts = self.parts(size)
+
+        state = read_state(state_filename)
+        uploaded = {}
+        upload_id = state.get('upload_id') if state else None
+        if upload_id is not None:
+            if state.get('size') == size and state.get('parts') == len(parts):
+                try:
+                    uploaded = self.uploaded_parts(key, upload_id)
+                except botocore.exceptions.ClientError:
+                    # The upload was aborted or has expired.
+                    self.abort_upload(key, upload_id)
+                    upload_id = None
+            else:
+                # The part size has changed since, so the parts can't be reused.
+                self.abort_upload(key, upload_id)
+                upload_id = None
+
+        if upload_id is None:
+            upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+            write_state(state_filename, {'upload_id': upload_id, 'size': size, 'parts': len(parts)})
+
+        fd = file.fileno()
+
+        def upload_part(part):
+            number, offset, length = part
+            data = pread(fd, length, offset)
+            # Parts left over from an earlier attempt are only reused if they
+            # match what's on disk now.
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            if uploaded.get(number) != etag:
+                etag = self.s3_client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  PartNumber=number, Body=data)['ETag']
+            if cb:
+                cb(length)
+            return {'PartNumber': number, 'ETag': etag}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            completed = list(executor.map(upload_part, parts))
+
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                 MultipartUpload={'Parts': completed})
+        remove_state(state_filename)
+
+    def abort_upload(self, key, upload_id):
+        """ Abort an unfinished multipart upload, so that its parts are deleted. """
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except botocore.exceptions.ClientError:
+            # It's already gone.
+            pass
+
+    def uploaded_parts(self, key, upload_id):
+        """ :return: dict of part number -> ETag for the parts of an unfinished upload """
+        uploaded = {}
+        paginator = self.s3_client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', ()):
+                uploaded[part['PartNumber']] = part['ETag']
+        return uploaded
 
     def pull(self, file, hash, cb=None):
-        self.s3_client.download_file(self.bucket, self.get_remote_file_name(hash), file.name, Callback=cb)
+        key = self.get_remote_file_name(hash)
+        head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        size = head['ContentLength']
+        if self.state_directory is None or size <= self.part_size:
+            self.s3_client.download_fileobj(self.bucket, key, file, Callback=cb, Config=self.transfer_config)
+        else:
+            self.pull_ranges(file, hash, size, head['ETag'], locked_callback(cb))
+
+    def pull_ranges(self, file, hash, size, etag, cb):
+        """
+        Download a large object with parallel ranged GETs, each written at its
+        offset into a preallocated partial file that is moved over `file` once
+        complete.
+        """
+        key = self.get_remote_file_name(hash)
+        state_filename = self.state_filename(hash, "download")
+        partial_filename = self.state_filename(hash, "partial")
+        parts = self.parts(size)
+
+        state = read_state(state_filename)
+        if not (state and state.get('etag') == etag and state.get('size') == size
+                and state.get('parts') == len(parts) and os.path.exists(partial_filename)):
+            state = {'etag': etag, 'size': size, 'parts': len(parts), 'done': []}
+
+        fd = os.open(partial_filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            write_state(state_filename, state)
+
+            done = set(state['done'])
+            lock = threading.Lock()
+
+            def download_part(part):
+                number, offset, length = part
+                if number not in done:
+                    response = self.s3_client.get_object(Bucket=self.bucket, Key=key, IfMatch=etag,
+                                                         Range="bytes={}-{}".format(offset, offset + length - 1))
+                    body = response['Body']
+                    position = offset
+                    while True:
+                        data = body.read(1024 * 1024)
+                        if not data:
+                            break
+                        pwrite(fd, data, position)
+                        position += len(data)
+                    if position != offset + length:
+                        raise IOError("short read of {} bytes {}-{}".format(key, offset, offset + length - 1))
+
+                    with lock:
+                        done.add(number)
+                        state['done'] = sorted(done)
+                        write_state(state_filename, state)
+                if cb:
+                    cb(length)
+
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                list(executor.map(download_part, parts))
+
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        try:
+            os.chmod(partial_filename, os.stat(file.name).st_mode & 0o777)
+        except OSError:
+            pass
+        try:
+            replace(partial_filename, file.name)
+        except OSError:
+            # The working tree is on another filesystem.
+            with open(partial_filename, 'rb') as partial:
+                file.seek(0)
+                file.truncate()
+                while True:
+                    data = partial.read(1024 * 1024)
+                    if not data:
+                        break
+                    file.write(data)
+            os.unlink(partial_filename)
+        remove_state(state_filename)
+
+    def read_range(self, hash, offset, length):
+        """ :return: `length` bytes of the object, starting at `offset` """
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.get_remote_file_name(hash),
+                                             Range="bytes={}-{}".format(offset, offset + length - 1))
+        return response['Body'].read()
+
+    def stream(self, hash, chunk_size=1024*1024):
+        """
+        Yield the object's contents in chunks as they arrive. Large objects are
+        fetched as several ranged GETs at once and handed back in order.
+        """
+        key = self.get_remote_file_name(hash)
+        head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        size = head['ContentLength']
+
+        if size <= self.part_size:
+            body = self.s3_client.get_object(Bucket=self.bucket, Key=key)['Body']
+            try:
+                while True:
+                    data = body.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            finally:
+                body.close()
+            return
+
+        def get_range(offset, length):
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key, IfMatch=head['ETag'],
+                                                 Range="bytes={}-{}".format(offset, offset + length - 1))
+            return response['Body'].read()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            in_flight = []
+            for _, offset, length in self.parts(size):
+                in_flight.append(executor.submit(get_range, offset, length))
+                if len(in_flight) >= self.max_concurrency:
+                    yield in_flight.pop(0).result()
+            for future in in_flight:
+                yield future.result()
+
+    def list(self, prefix):
+        """ Yield the hash of every object whose hash starts with the two characters in `prefix`. """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix="{}/".format(prefix)):
+            for item in page.get('Contents', ()):
+                yield item['Key'].replace("/", "", 1)
 
     def exists(self, hash):
         exists = False
@@ -54,6 +339,61 @@ class S3Backend(object):
 
         return exists
 
+    def classify_error(self, error):
+        """ :return: "throttled" or "transient" for errors worth retrying, otherwise None """
+        if isinstance(error, botocore.exceptions.ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if code in throttling_codes or status in (429, 503):
+                return 'throttled'
+            if code in transient_codes or status in (500, 502, 504):
+                return 'transient'
+        elif isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+            return 'transient'
+        return None
+
+
+def locked_callback(cb):
+    """ Serialize progress callbacks coming from several part transfers. """
+    if cb is None:
+        return None
+
+    lock = threading.Lock()
+
+    def callback(bytes_amount):
+        with lock:
+            cb(bytes_amount)
+    return callback
+
+
+def read_state(filename):
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_state(filename, state):
+    directory = os.path.dirname(filename)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+    temporary_filename = "{}.tmp".format(filename)
+    with open(temporary_filename, 'w') as file:
+        json.dump(state, file)
+    replace(temporary_filename, filename)
+
+
+def remove_state(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
 ## Generic AWS helper functions, from https://gist.github.com/bkruger99/6bbaacf1e7fa49891d421d6a1a7ba9c9
 """
     Generic AWS Helper call class to setup a boto3 Session.  Now with assume role support.
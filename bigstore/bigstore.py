@@ -17,28 +17,40 @@
 from __future__ import division
 from __future__ import print_function
 from builtins import input, object
-from future.utils import bytes_to_native_str, native_str_to_bytes, iteritems
 
-from datetime import datetime
-import bz2
+import collections
 import errno
 import fnmatch
 import hashlib
-import operator
+import io
 import os
 import re
-import shutil
+import stat
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 from .backends import S3Backend
 from .backends import RackspaceBackend
 from .backends import GoogleBackend
-
-from dateutil import tz as dateutil_tz
-import git
-import pytz
+from .backends import LocalBackend
+from .backends import BackendRegistry
+from .cache import CacheIndex, record_access
+from .catfile import CatFile, parse_pointer, pointer_max_size
+from .chunking import (ChunkIndex, chunk_hexdigest, chunked_action, chunked_filter_name, chunks, format_manifest,
+                       manifest_for_action, parse_manifest)
+from .compat import cpu_count, fsdecode, replace
+from .config import GitConfig
+from .compression import (codec_for_action, codec_for_filter, codec_names, compress_file, compressed_action,
+                          filter_names, get_codec, is_upload_action, make_decompressor)
+from .inventory import Inventory, list_jobs, prefixes
+from .journal import TransferJournal
+from .notes import NotesIndex, NotesWriter, git_output, notes_ref
+from .packing import coalesce, location_for_action, pack_hash_function_name, packed_action, plan_packs
+from .scheduler import BandwidthLimit, ScheduledBackend, Scheduler
+from .transfer import TransferPool, prefetch
 
 # Use a bytes mode stdin/stdout for both Python 2 and 3.
 if sys.version_info >= (3,):
@@ -48,21 +60,17 @@ else:
     stdin = sys.stdin
     stdout = sys.stdout
 
-attribute_regex = re.compile(r'^([^\s]*) filter=(bigstore(?:-compress)?)$')
+# GitPython is imported the first time it's needed, since filters and most
+# lookups don't use it.
+git = None
 
-g = lambda: git.Git('.')
-git_directory = lambda git_instance: git_instance.rev_parse(git_dir=True)
 
-try:
-    default_hash_function_name = g().config("bigstore.hash_function")
-except git.exc.GitCommandError:
-    default_hash_function_name = 'sha1'
+def g():
+    global git
+    if git is None:
+        import git
+    return git.Git('.')
 
-try:
-    toplevel_dir = g().rev_parse(show_toplevel=True)
-except git.exc.GitCommandError:
-    toplevel_dir = '.'
-config_filename = os.path.join(toplevel_dir, '.bigstore')
 
 hash_functions = {
     'md5': hashlib.md5,
@@ -73,7 +81,65 @@ hash_functions = {
     'sha512': hashlib.sha512
 }
 
-default_hash_function = hash_functions[default_hash_function_name]
+pointer_prefix = b"bigstore\n"
+
+# Size of the buffer that file contents are streamed through.
+chunk_size = 1024 * 1024
+
+# Number of downloaded chunks that can be waiting for the decompressor.
+download_queue_size = 8
+
+# Pack mode defaults, for bigstore.pack.threshold and bigstore.pack.size.
+default_pack_threshold = 1024 * 1024
+default_pack_size = 16 * 1024 * 1024
+
+
+# Everything in the repository's git config (including the global and system
+# files), read once.
+repository_config = GitConfig()
+
+bigstore_config_snapshot = None
+toplevel_directory_name = None
+
+
+def look_up_directories():
+    """
+    Find the top of the working tree and the git directory with one git
+    process, since every filter invocation needs both.
+
+    :return: False if git couldn't answer for both (e.g. in a bare repository)
+    """
+    global toplevel_directory_name, bigstore_directory_name
+    output = git_output("rev-parse", "--show-toplevel", "--git-dir", "--git-common-dir")
+    if output is None:
+        return False
+    lines = output.decode('utf-8').split("\n")
+    if len(lines) < 3:
+        return False
+    toplevel_directory_name = lines[0]
+    bigstore_directory_name = bigstore_directory_in(lines[1], lines[2])
+    return True
+
+
+def toplevel_directory():
+    """ Top of the working tree, looked up the first time it's needed. """
+    global toplevel_directory_name
+    if toplevel_directory_name is None and not look_up_directories():
+        toplevel = git_output("rev-parse", "--show-toplevel")
+        toplevel_directory_name = toplevel.decode('utf-8').rstrip("\n") if toplevel else '.'
+    return toplevel_directory_name
+
+
+def config_filename():
+    return os.path.join(toplevel_directory(), '.bigstore')
+
+
+def bigstore_config():
+    """ The .bigstore config file, read once. """
+    global bigstore_config_snapshot
+    if bigstore_config_snapshot is None:
+        bigstore_config_snapshot = GitConfig("--file", config_filename())
+    return bigstore_config_snapshot
 
 
 def config(name):
@@ -83,10 +149,11 @@ def config(name):
     :param name: name of config setting to read
     :return: str or None
     """
-    try:
-        return g().config(name, file=config_filename)
-    except git.exc.GitCommandError:
-        return None
+    return bigstore_config().get(name)
+
+
+def default_hash_function_name():
+    return repository_config.get("bigstore.hash_function", "sha1")
 
 
 def default_backend():
@@ -96,11 +163,118 @@ def default_backend():
     if backend:
         return backend
     else:
-        sys.stderr.write("error: s3, gs, and cloudfiles are currently the only supported backends")
+        sys.stderr.write("error: s3, gs, cloudfiles and local are currently the only supported backends")
         sys.exit(0)
 
 
+def setting(name):
+    """
+    Read a setting from the repository's git config, so that it can be tuned
+    per machine, falling back to the .bigstore config file.
+
+    :return: str or None
+    """
+    value = repository_config.get(name)
+    if value is None:
+        return config(name)
+    return value
+
+
+def parse_size(value):
+    """
+    Parse a size the way git does, with an optional k, m or g suffix.
+
+    :return: int, or None if `value` isn't a size
+    """
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    if not value:
+        return None
+    value = value.strip().lower()
+    multiplier = units.get(value[-1:], 1)
+    if value[-1:] in units:
+        value = value[:-1]
+    try:
+        return int(value) * multiplier
+    except ValueError:
+        return None
+
+
+def int_setting(name):
+    try:
+        return int(setting(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def bool_setting(name):
+    """ :return: True or False, or None if the setting isn't set """
+    value = setting(name)
+    if value is None:
+        return None
+    return value.strip().lower() in ('true', 'yes', 'on', '1')
+
+
+backend_registry = BackendRegistry()
+
+# backend name -> Scheduler, shared by every thread
+schedulers = {}
+schedulers_lock = threading.Lock()
+bandwidth_limit = None
+
+# Most transfer threads this process has said it will run at once, which
+# connection pools are sized for.
+peak_jobs = 0
+
+
+def scheduler_for_name(name):
+    """
+    :return: the Scheduler for requests to the backend called `name`, set up
+             from `bigstore.<name>.max-requests`, `bigstore.<name>.max-bandwidth`,
+             `bigstore.max-bandwidth` and `bigstore.retries`
+    """
+    global bandwidth_limit
+    with schedulers_lock:
+        if name not in schedulers:
+            # Shared by every backend, since they all go over the same link.
+            if bandwidth_limit is None:
+                rate = parse_size(setting('bigstore.max-bandwidth'))
+                bandwidth_limit = BandwidthLimit(rate) if rate else False
+            rate = parse_size(setting('bigstore.{}.max-bandwidth'.format(name)))
+            schedulers[name] = Scheduler(max_requests=int_setting('bigstore.{}.max-requests'.format(name)),
+                                         bandwidth_limits=[bandwidth_limit or None,
+                                                           BandwidthLimit(rate) if rate else None],
+                                         retries=int_setting('bigstore.retries'))
+        return schedulers[name]
+
+
+def reserve_jobs(jobs):
+    """
+    Say that up to `jobs` threads will use backends at once. Backends are built
+    once per process and shared by every command that runs in it, so this is
+    called before any are, and their connection pools are made big enough for
+    the most threads asked for.
+    """
+    global peak_jobs
+    peak_jobs = max(peak_jobs, jobs)
+
+
 def backend_for_name(name):
+    """
+    :return: the backend called `name`, with its requests going through the
+             backend's Scheduler, or None if there's no such backend
+    """
+    backend = configured_backend(name)
+    if backend is None:
+        return None
+    return ScheduledBackend(backend, scheduler_for_name(name))
+
+
+def configured_backend(name):
+    """
+    :return: the backend called `name`, built from the current configuration.
+             Backends are built once per process (or per thread, for those
+             that can't be shared) and reused after that.
+    """
     if name == 's3':
         bucket_name = config('bigstore.s3.bucket')
         # Backward compatibility, but not suggested.
@@ -110,29 +284,177 @@ def backend_for_name(name):
             os.environ["AWS_SECRET_ACCESS_KEY"] = config('bigstore.s3.secret')
         if config('bigstore.s3.profile-name'):
             os.environ["AWS_PROFILE"] = config('bigstore.s3.profile-name')
-        return S3Backend(bucket_name)
+        return backend_registry.get(S3Backend, bucket_name,
+                                    part_size=parse_size(setting('bigstore.s3.part-size')),
+                                    max_concurrency=int_setting('bigstore.s3.max-concurrency'),
+                                    endpoint_url=setting('bigstore.s3.endpoint-url'),
+                                    state_directory=os.path.join(bigstore_directory(), "transfers"),
+                                    max_pool_connections=int_setting('bigstore.s3.max-pool-connections'),
+                                    jobs=max(peak_jobs, list_jobs, default_jobs()))
     elif name == 'cloudfiles':
         username = config('bigstore.cloudfiles.username')
         api_key = config('bigstore.cloudfiles.key')
         container_name = config('bigstore.cloudfiles.container')
-        return RackspaceBackend(username, api_key, container_name)
+        return backend_registry.get(RackspaceBackend, username, api_key, container_name)
     elif name == 'gs':
         access_key_id = config('bigstore.gs.key')
         secret_access_key = config('bigstore.gs.secret')
         bucket_name = config('bigstore.gs.bucket')
-        return GoogleBackend(access_key_id, secret_access_key, bucket_name)
+        return backend_registry.get(GoogleBackend, access_key_id, secret_access_key, bucket_name)
+    elif name == 'local':
+        path = config('bigstore.local.path')
+        if path is None:
+            return None
+        if not path.startswith("file://"):
+            path = os.path.join(toplevel_directory(), os.path.expanduser(path))
+        try:
+            latency = float(setting('bigstore.local.latency') or 0)
+        except ValueError:
+            latency = 0
+        return backend_registry.get(LocalBackend, path, latency=latency,
+                                    bandwidth=parse_size(setting('bigstore.local.bandwidth')))
     else:
         return None
 
 
+def bigstore_directory():
+    """
+    Location of bigstore's private data inside the git directory, shared by all
+    worktrees of the repository. The lookup is cached so that a long-running
+    filter process only asks git once.
+    """
+    global bigstore_directory_name
+    if bigstore_directory_name is None and not look_up_directories():
+        output = git_output("rev-parse", "--git-dir", "--git-common-dir")
+        if output is None:
+            raise RuntimeError("not a git repository")
+        git_dir, common_dir = output.decode('utf-8').split("\n")[:2]
+        bigstore_directory_name = bigstore_directory_in(git_dir, common_dir)
+    return bigstore_directory_name
+
+
+bigstore_directory_name = None
+
+
+def bigstore_directory_in(git_dir, common_dir):
+    """ :return: bigstore's directory, given rev-parse's --git-dir and --git-common-dir """
+    # Git before 2.5 doesn't know --git-common-dir, and echoes it back.
+    if common_dir and common_dir != "--git-common-dir":
+        git_dir = common_dir
+    return os.path.join(os.path.abspath(git_dir), "bigstore")
+
+
 def object_directory(hash_function_name):
-    return os.path.join(git_directory(g()), "bigstore", "objects", hash_function_name)
+    return os.path.join(bigstore_directory(), "objects", hash_function_name)
 
 
 def object_filename(hash_function_name, hexdigest):
     return os.path.join(object_directory(hash_function_name), hexdigest[:2], hexdigest[2:])
 
 
+def shared_object_filename(hash_function_name, hexdigest):
+    """
+    Where an object would be in the object cache that clones on this machine
+    share (bigstore.cache-dir), or None if there isn't one.
+    """
+    directory = setting("bigstore.cache-dir")
+    if directory:
+        return os.path.join(os.path.expanduser(directory), "objects", hash_function_name, hexdigest[:2],
+                            hexdigest[2:])
+
+
+def place_object(source_filename, filename):
+    """
+    Make `filename` a hard link to `source_filename`, or a reflink or a copy of
+    it across filesystems. Nothing ever sees a partly written object: links
+    appear atomically, and copies are renamed into place once complete.
+
+    :return: False if `source_filename` doesn't exist
+    """
+    directory = os.path.dirname(filename)
+    mkdir_p(directory)
+    try:
+        os.link(source_filename, filename)
+        return True
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            # Someone else got there first, and objects never change.
+            return True
+        if e.errno == errno.ENOENT:
+            return False
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+
+    fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".place-")
+    os.close(fd)
+    try:
+        if not reflink(source_filename, temporary_filename):
+            with open(source_filename, 'rb') as source, open(temporary_filename, 'wb') as file:
+                copy_to_output(source, file)
+        os.chmod(temporary_filename, 0o444)
+        replace(temporary_filename, filename)
+    except BaseException as e:
+        os.unlink(temporary_filename)
+        if isinstance(e, (IOError, OSError)) and e.errno == errno.ENOENT:
+            return False
+        raise
+    return True
+
+
+def find_object(hash_function_name, hexdigest):
+    """
+    Locate an object in the local object store, bringing it in from the shared
+    object cache if only that has it.
+
+    :return: the object's filename, or None if it isn't available locally
+    """
+    filename = object_filename(hash_function_name, hexdigest)
+    if os.path.exists(filename):
+        return filename
+
+    shared_filename = shared_object_filename(hash_function_name, hexdigest)
+    if shared_filename and place_object(shared_filename, filename):
+        return filename
+    return None
+
+
+def share_object(hash_function_name, hexdigest):
+    """
+    Add an object from the local object store to the shared object cache, if
+    there is one and it doesn't have the object yet. Objects are made
+    read-only, and readable by everyone who can reach the cache. A cache that
+    can't be written to is skipped silently.
+    """
+    shared_filename = shared_object_filename(hash_function_name, hexdigest)
+    if not shared_filename or os.path.exists(shared_filename):
+        return
+
+    filename = object_filename(hash_function_name, hexdigest)
+    try:
+        os.chmod(filename, 0o444)
+        place_object(filename, shared_filename)
+    except (IOError, OSError):
+        pass
+
+
+def touch_object(hash_function_name, hexdigest, size):
+    """
+    Note that an object in the local store has just been used, for pruning. A
+    failure to record it is never worth failing the caller over.
+
+    Accesses are only recorded while bigstore.cache.max-size is set, since the
+    access log is only folded into the cache index when the store's size is
+    checked; otherwise it would grow without bound. A `git bigstore prune`
+    without a size cap goes by the objects' modification times.
+    """
+    if cache_max_size() is None:
+        return
+    try:
+        record_access(os.path.join(bigstore_directory(), "access-log"), hash_function_name, hexdigest, size)
+    except (IOError, OSError):
+        pass
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -151,18 +473,17 @@ def is_bigstore_file(filename):
     :param filename: filename to inspect
     :return: True if the file starts with `bigstore`
     """
-    prefix = 'bigstore\n'
     try:
-        with open(filename) as fd:
-            return fd.read(len(prefix)) == prefix
+        with open(filename, 'rb') as fd:
+            return fd.read(len(pointer_prefix)) == pointer_prefix
     except IOError:
         return False
 
 
 class ProgressPercentage(object):
-    def __init__(self, filename):
+    def __init__(self, filename, size=None):
         self.filename = filename
-        self.size = float(os.path.getsize(filename))
+        self.size = float(os.path.getsize(filename) if size is None else size)
         self.seen_so_far = 0
 
     def __call__(self, bytes_amount):
@@ -176,209 +497,1141 @@ class ProgressPercentage(object):
         sys.stdout.flush()
 
 
-def pathnames_from_filename(filename):
-    filters = []
-    try:
-        with open(filename) as file:
-            for line in file:
-                match = attribute_regex.match(line)
-                if match:
-                    groups = match.groups()
-                    if len(groups) > 0:
-                        filters.append((groups[0], groups[1]))
-    except IOError:
-        # The .gitattributes file might not exist. Should prompt the user to run
-        # "git bigstore init"?
-        pass
-    return filters
+def read_records(stream, separator=b"\0"):
+    """
+    Generator that splits a binary stream into records as it is read, so that
+    arbitrarily long command output never has to be held in memory at once.
+    """
+    pending = b""
+    while True:
+        chunk = stream.read(65536)
+        if not chunk:
+            break
+
+        records = (pending + chunk).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield record
+
+    if pending:
+        yield pending
+
+
+def compile_patterns(patterns):
+    """
+    Compile shell wildcards into a single matcher.
+
+    :param patterns: list of wildcards, as accepted by fnmatch
+    :return: a function that tests a filename against all of the wildcards, or
+             None if there are no wildcards (i.e. everything matches)
+    """
+    if not patterns:
+        return None
+
+    regex = re.compile("|".join("(?:{})".format(fnmatch.translate(pattern)) for pattern in patterns))
+    return lambda filename: regex.match(filename) is not None
+
+
+def is_bigstore_filter(value):
+    return value in ("bigstore", chunked_filter_name) or codec_for_filter(value) is not None
+
+
+def pathnames(patterns=None):
+    """
+    Generator that will yield (sha, filename, filter_name) for files in HEAD that
+    have a bigstore filter set by .gitattributes (at any level of the tree) or
+    private attributes.
+
+    The tree listing is streamed through `git check-attr` so that attributes are
+    resolved exactly as git resolves them, with memory bounded by the pipes in
+    between rather than by the size of the tree.
 
+    The whole tree is listed wherever this is run from, but filenames are
+    yielded relative to the current directory so that they can be opened as
+    they are.
 
-def pathnames():
-    """ Generator that will yield pathnames for pathnames tracked under .gitattributes and private attributes """
-    filters = []
-    filters.extend(pathnames_from_filename(os.path.join(toplevel_dir, '.gitattributes')))
-    filters.extend(pathnames_from_filename(os.path.join(toplevel_dir, '.git/info/attributes')))
-    if not filters:
+    :param patterns: only yield filenames matching one of these wildcards,
+                     which are matched against paths from the top of the tree
+    """
+    match = compile_patterns(patterns)
+    toplevel = toplevel_directory()
+
+    ls_tree = subprocess.Popen(["git", "ls-tree", "-r", "-z", "--full-tree", "HEAD"],
+                               cwd=toplevel, stdout=subprocess.PIPE)
+    check_attr = subprocess.Popen(["git", "check-attr", "--stdin", "-z", "filter"],
+                                  cwd=toplevel, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # check-attr answers in the order it is asked, so the shas of paths that are
+    # in flight just need to be remembered in the same order.
+    shas = collections.deque()
+
+    def feed():
+        try:
+            for record in read_records(ls_tree.stdout):
+                metadata, path = record.split(b"\t", 1)
+                mode, object_type, sha = metadata.split(b" ")
+                # Filters don't apply to submodules or symlinks.
+                if object_type != b"blob" or mode == b"120000":
+                    continue
+                if match and not match(fsdecode(path)):
+                    continue
+
+                shas.append(sha.decode('ascii'))
+                check_attr.stdin.write(path + b"\0")
+        except (IOError, OSError):
+            # check-attr went away because the caller stopped early.
+            pass
+        finally:
+            ls_tree.stdout.close()
+            try:
+                check_attr.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    found = False
+    try:
+        records = read_records(check_attr.stdout)
+        for path, _, value in zip(records, records, records):
+            sha = shas.popleft()
+            value = value.decode('utf-8', 'replace')
+            if is_bigstore_filter(value):
+                found = True
+                yield sha, os.path.relpath(os.path.join(toplevel, fsdecode(path))), value
+    finally:
+        check_attr.stdout.close()
+        feeder.join()
+        ls_tree.wait()
+        check_attr.wait()
+
+    if not found and not patterns:
         sys.stderr.write("No bigstore gitattributes filters found.  Is .gitattributes set up correctly?\n")
-        return
 
-    results = g().ls_tree("HEAD", r=True).split('\n')
-    filenames = {}
-    for result in results:
-        metadata, filename = result.split('\t')
-        _, _, sha = metadata.split(' ')
-        filenames[filename] = sha
 
-    for wildcard, filter in filters:
-        for filename, sha in iteritems(filenames):
-            if fnmatch.fnmatch(filename, wildcard):
-                yield sha, filename, filter == "bigstore-compress"
+def load_chunk_index():
+    """ :return: ChunkIndex for the local object store """
+    return ChunkIndex.load(os.path.join(bigstore_directory(), "chunk-index"))
+
+
+def load_notes_index():
+    """
+    Read every bigstore note once so that commands can look entries up without
+    running `git notes show` per object.
+
+    :return: NotesIndex
+    """
+    return NotesIndex.load(os.path.join(bigstore_directory(), "notes-index"))
+
+
+def resolve(ref):
+    """ :return: the commit `ref` points to, or None if it doesn't exist """
+    commit = git_output("rev-parse", "--verify", "-q", ref)
+    return commit.decode('ascii').strip() if commit is not None else None
+
+
+def remote_notes(repository):
+    """
+    Ask a repository which commit its bigstore notes are at, with a single
+    `git ls-remote`.
+
+    :return: the commit, or None if the repository has no notes or can't be
+             reached
+    """
+    output = git_output("ls-remote", repository, notes_ref)
+    if not output:
+        return None
+    return output.decode('ascii').split("\t", 1)[0]
+
+
+# The commit origin's bigstore notes were at when they were last synced by this
+# process, so that notes origin already has aren't pushed back.
+origin_notes = None
 
 
 def pull_metadata(repository='origin'):
     """
-    Pull metadata from repository and automatically merge it with local metadata
+    Pull metadata from repository and automatically merge it with local metadata.
+    Nothing is fetched or merged if the local notes already include the
+    repository's.
 
     :param repository: git url or remote
     """
-    try:
-        if repository == "origin":
-            sys.stderr.write("pulling bigstore metadata...")
-        else:
-            sys.stderr.write("pulling bigstore metadata from {}...".format(repository))
+    global origin_notes
 
-        g().fetch(repository, "refs/notes/bigstore:refs/notes/bigstore-remote", "--force")
-    except git.exc.GitCommandError:
-        try:
-            # Create a ref so that we can push up to the repo.
-            g().notes("--ref=bigstore", "add", "HEAD", "-m", "bigstore")
-            sys.stderr.write("done\n")
-        except git.exc.GitCommandError:
-            # If it fails silently, an existing notes object already exists.
-            sys.stderr.write("\n")
+    if repository == "origin":
+        sys.stderr.write("pulling bigstore metadata...")
     else:
-        g().notes("--ref=bigstore", "merge", "-s", "cat_sort_uniq", "refs/notes/bigstore-remote")
+        sys.stderr.write("pulling bigstore metadata from {}...".format(repository))
+
+    local = resolve(notes_ref)
+    remote = remote_notes(repository)
+    if remote is None:
+        if local is None:
+            try:
+                # Create a ref so that we can push up to the repo.
+                g().notes("--ref=bigstore", "add", "HEAD", "-m", "bigstore")
+            except git.exc.GitCommandError:
+                # If it fails silently, an existing notes object already exists.
+                pass
         sys.stderr.write("done\n")
+        return
 
+    if repository == "origin":
+        origin_notes = remote
 
-def push():
-    assert_initialized()
-    pull_metadata()
+    if remote == local or (local is not None and
+                           git_output("merge-base", "--is-ancestor", remote, local) is not None):
+        sys.stderr.write("up to date\n")
+        return
 
-    if len(sys.argv) > 2:
-        filters = sys.argv[2:]
-    else:
-        filters = []
+    if resolve("refs/notes/bigstore-remote") != remote:
+        g().fetch(repository, "refs/notes/bigstore:refs/notes/bigstore-remote", "--force")
+    g().notes("--ref=bigstore", "merge", "-s", "cat_sort_uniq", "refs/notes/bigstore-remote")
+    if local is not None and git_output("merge-base", local, "refs/notes/bigstore-remote") is None:
+        # The remote notes were compacted (or started independently), so
+        # the merge would drag the whole old history back in. Keep the
+        # remote's history instead, with the merged notes on top of it.
+        rebase_notes("refs/notes/bigstore-remote", "Merged notes from refs/notes/bigstore-remote")
+    sys.stderr.write("done\n")
 
-    # Should show a message to the user if not in the base directory.
-    for sha, filename, compress in pathnames():
-        should_process = len(filters) == 0 or any(fnmatch.fnmatch(filename, filter) for filter in filters)
-        if should_process:
-            try:
-                entries = g().notes("--ref=bigstore", "show", sha).split('\n')
-            except git.exc.GitCommandError:
-                # No notes exist for this object
-                entries = []
-
-            backend = default_backend()
-            for entry in entries:
-                try:
-                    timestamp, action, backend_name, _ = entry.split('\t')
-                except ValueError:
-                    # probably a blank line
-                    pass
-                else:
-                    if action in ("upload", "upload-compressed") and backend.name == backend_name:
-                        break
-            else:
-                try:
-                    firstline, hash_function_name, hexdigest = g().show(sha).split('\n')
-                except ValueError:
-                    pass
-                else:
-                    if firstline == 'bigstore':
-                        if not backend.exists(hexdigest):
-                            with open(object_filename(hash_function_name, hexdigest), 'rb') as file:
-                                if compress:
-                                    with tempfile.TemporaryFile() as compressed_file:
-                                        compressor = bz2.BZ2Compressor()
-                                        for line in file:
-                                            compressed_file.write(compressor.compress(line))
-
-                                        compressed_file.write(compressor.flush())
-                                        compressed_file.seek(0)
-
-                                        sys.stderr.write("compressed!\n")
-                                        backend.push(compressed_file, hexdigest, cb=ProgressPercentage(filename))
-                                else:
-                                    backend.push(file, hexdigest, cb=ProgressPercentage(filename))
-
-                            sys.stderr.write("\n")
-
-                        user_name = g().config("user.name")
-                        user_email = g().config("user.email")
-
-                        # XXX Should the action ("upload / upload-compress") be
-                        # different if the file already exists on the backend?
-                        if compress:
-                            action = "upload-compressed"
-                        else:
-                            action = "upload"
-
-                        # We use the timestamp as the first entry as it will help us
-                        # sort the entries easily with the cat_sort_uniq merge.
-                        g().notes("--ref=bigstore", "append", sha, "-m", "{}	{}	{}	{} <{}>".format(
-                            time.time(), action, backend.name, user_name, user_email))
+
+def push_metadata(fatal=True):
+    """
+    Push the bigstore notes to origin, unless origin already has them.
+
+    :param fatal: raise if the push fails, rather than just reporting it
+    """
+    global origin_notes
+
+    local = resolve(notes_ref)
+    if local is None or local == origin_notes:
+        return
 
     sys.stderr.write("pushing bigstore metadata...")
-    g().push("origin", "refs/notes/bigstore")
+    try:
+        g().push("origin", notes_ref)
+    except git.exc.GitCommandError as e:
+        if fatal:
+            raise
+        if e.stderr and 'read only' in e.stderr:
+            sys.stderr.write('read only\n')
+        else:
+            sys.stderr.write('ERROR\n')
+        return
+
+    origin_notes = local
     sys.stderr.write("done\n")
 
 
-def pull():
+def rebase_notes(parent, message):
+    """
+    Replace the bigstore notes history with a single commit of the current
+    notes on top of `parent` (or on nothing, if it's None). Every note is
+    kept as it is.
+
+    :return: the new notes commit
+    """
+    current = git_output("rev-parse", "--verify", "-q", notes_ref).decode('ascii').strip()
+    tree = git_output("rev-parse", current + "^{tree}").decode('ascii').strip()
+    if parent is not None:
+        parent = git_output("rev-parse", parent).decode('ascii').strip()
+
+    if parent is not None and git_output("rev-parse", parent + "^{tree}").decode('ascii').strip() == tree:
+        commit = parent
+    else:
+        command = ["commit-tree", tree, "-m", message]
+        if parent is not None:
+            command += ["-p", parent]
+        commit = git_output(*command).decode('ascii').strip()
+
+    g().update_ref("-m", message, notes_ref, commit, current)
+    return commit
+
+
+def compact_notes(push=True):
+    """
+    Squash the history of the bigstore notes into a single commit, keeping
+    every entry. The notes are merged with the remote's first, and the
+    compacted notes replace the remote's unless another push got there in the
+    meantime.
+
+    :param push: replace the notes on origin too
+    """
+    global origin_notes
+
     assert_initialized()
     pull_metadata()
 
-    if len(sys.argv) > 2:
-        filters = sys.argv[2:]
+    if resolve(notes_ref) is None:
+        sys.stderr.write("no bigstore notes to compact\n")
+        return
+
+    commits = int(git_output("rev-list", "--count", notes_ref))
+    if commits > 1:
+        rebase_notes(None, "Compacted bigstore notes")
+    sys.stderr.write("compacted {} notes commits into 1\n".format(commits))
+
+    if push:
+        # Only replace what pull_metadata() saw on origin.
+        lease = "--force-with-lease={}:{}".format(notes_ref, origin_notes or "")
+        sys.stderr.write("pushing bigstore metadata...")
+        g().push(lease, "origin", notes_ref)
+        origin_notes = resolve(notes_ref)
+        sys.stderr.write("done\n")
+
+
+def remote_inventory(backend_name):
+    """
+    Load the inventory of objects on a backend, listing whatever part of it is
+    older than `bigstore.inventory.ttl` seconds (an hour by default).
+
+    :return: Inventory, or None if the backend couldn't be listed
+    """
+    ttl = int_setting("bigstore.inventory.ttl")
+    inventory = Inventory.load(os.path.join(bigstore_directory(), "inventory", backend_name),
+                               ttl if ttl is not None else 3600)
+    listed = inventory.refresh(backend_name, backend_for_name)
+    inventory.save()
+    return inventory if listed else None
+
+
+def transfer_journal(name):
+    """ :return: the TransferJournal kept for a push or pull under the bigstore directory """
+    return TransferJournal.open(os.path.join(bigstore_directory(), "transfers", "{}.journal".format(name)))
+
+
+def default_jobs():
+    """
+    Number of concurrent transfers to run when `--jobs` isn't given. Read from
+    the repository's git config first so that it can be tuned per machine, then
+    from the .bigstore config file.
+
+    :return: int
+    """
+    jobs = int_setting("bigstore.jobs")
+    return max(1, jobs) if jobs is not None else 1
+
+
+def transfer_callback(filename, jobs, size=None):
+    # Progress bars from several workers would just overwrite each other.
+    if jobs == 1:
+        return ProgressPercentage(filename, size)
+
+
+def pack_settings(pack=None):
+    """
+    Pack mode settings for push. Pack mode is on when bigstore.pack.threshold
+    is set, unless `pack` says otherwise.
+
+    :param pack: True or False to turn pack mode on or off regardless of the
+                 config
+    :return: (largest object to pack, target pack size) in bytes, or None if
+             pack mode is off
+    """
+    threshold = parse_size(setting("bigstore.pack.threshold"))
+    if pack is False or (pack is None and threshold is None):
+        return None
+    return threshold or default_pack_threshold, parse_size(setting("bigstore.pack.size")) or default_pack_size
+
+
+def compression_threads():
+    """
+    Number of threads to compress with, from bigstore.compress.threads in the
+    repository's git config or the .bigstore config file. Defaults to one.
+
+    More than one thread splits large objects into several compressed streams,
+    which versions of git-bigstore without multi-stream support can't pull.
+
+    :return: int
+    """
+    threads = int_setting("bigstore.compress.threads")
+    return max(1, threads) if threads is not None else 1
+
+
+def decompression_threads():
+    """
+    Number of threads to decompress multi-stream objects with, from
+    bigstore.compress.threads. Defaults to one per core.
+
+    :return: int
+    """
+    threads = int_setting("bigstore.compress.threads")
+    return max(1, threads) if threads is not None else cpu_count() or 1
+
+
+def codec_level(codec_name):
+    """
+    Compression level configured for a codec with bigstore.compress.<codec>.level,
+    or None for the codec's default.
+    """
+    level = config("bigstore.compress.{}.level".format(codec_name))
+    try:
+        return int(level)
+    except (TypeError, ValueError):
+        return None
+
+
+def upload_object(backend, filename, hash_function_name, hexdigest, codec_name, level, threads, jobs,
+                  check_remote=True):
+    """
+    Upload a local object unless the backend already has it. Runs on a transfer
+    worker.
+
+    :param codec_name: codec to compress the object with before uploading, if any
+    :param level: compression level, or None for the codec's default
+    :param threads: number of threads to compress with
+    :param check_remote: ask the backend whether it has the object first
+    :return: number of compressed streams uploaded, or None if nothing was
+             uploaded
+    """
+    streams = None
+    if not (check_remote and backend.exists(hexdigest)):
+        streams = 1
+        with open(object_filename(hash_function_name, hexdigest), 'rb') as file:
+            if codec_name:
+                with tempfile.TemporaryFile() as compressed_file:
+                    streams = compress_file(get_codec(codec_name), file, compressed_file, level, threads)
+                    compressed_file.seek(0)
+
+                    sys.stderr.write("compressed!\n")
+                    backend.push(compressed_file, hexdigest, cb=transfer_callback(filename, jobs))
+            else:
+                backend.push(file, hexdigest, cb=transfer_callback(filename, jobs))
+
+        if jobs == 1:
+            sys.stderr.write("\n")
+        else:
+            sys.stderr.write("uploaded {}\n".format(filename))
+
+    return streams
+
+
+def upload_chunked_object(backend, filename, hash_function_name, hexdigest, remote_has, jobs):
+    """
+    Upload a local object as content-defined chunks, skipping chunks the
+    backend already has, followed by the manifest that lists them. Runs on a
+    transfer worker.
+
+    :param remote_has: function telling whether the backend has an object, or
+                       None to ask the backend
+    :return: (manifest hexdigest, list of (chunk hexdigest, length))
+    """
+    if remote_has is None:
+        remote_has = backend.exists
+
+    entries = []
+    sent = set()
+    with open(object_filename(hash_function_name, hexdigest), 'rb') as file:
+        callback = transfer_callback(filename, jobs, os.fstat(file.fileno()).st_size)
+        for data in chunks(file):
+            chunk = chunk_hexdigest(data)
+            entries.append((chunk, len(data)))
+            if chunk in sent or remote_has(chunk):
+                if callback:
+                    callback(len(data))
+                continue
+            backend.push(io.BytesIO(data), chunk, cb=callback)
+            sent.add(chunk)
+
+    manifest = format_manifest(entries)
+    manifest_hexdigest = chunk_hexdigest(manifest)
+    if not remote_has(manifest_hexdigest):
+        backend.push(io.BytesIO(manifest), manifest_hexdigest)
+
+    if jobs == 1:
+        sys.stderr.write("\n")
+    sys.stderr.write("uploaded {} ({} of {} chunks)\n".format(filename, len(sent), len(entries)))
+    return manifest_hexdigest, entries
+
+
+class DigestMismatch(Exception):
+    pass
+
+
+def write_verified(filename, hash_function_name, hexdigest, blocks):
+    """
+    Write `blocks` to a temporary file next to `filename`, and only move it
+    over `filename` once its digest matches `hexdigest`.
+
+    :raise DigestMismatch: if the contents don't match
+    """
+    hash_function = hash_functions[hash_function_name]()
+    directory = os.path.dirname(filename) or "."
+    fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".bigstore-")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for data in blocks:
+                hash_function.update(data)
+                file.write(data)
+
+        if hash_function.hexdigest() != hexdigest:
+            raise DigestMismatch("downloaded contents of {} don't match {}:{}".format(
+                filename, hash_function_name, hexdigest))
+
+        try:
+            os.chmod(temporary_filename, os.stat(filename).st_mode & 0o777)
+        except OSError:
+            pass
+        replace(temporary_filename, filename)
+    except BaseException:
+        if os.path.exists(temporary_filename):
+            os.unlink(temporary_filename)
+        raise
+
+
+def upload_pack(backend, objects, jobs):
+    """
+    Upload local objects together as one pack. Runs on a transfer worker.
+
+    :param objects: list of (hash function name, hexdigest)
+    :return: (pack hexdigest, list of (offset, length) for each object)
+    """
+    hash_function = hash_functions[pack_hash_function_name]()
+    locations = []
+    with tempfile.TemporaryFile() as pack:
+        for hash_function_name, hexdigest in objects:
+            offset = pack.tell()
+            with open(object_filename(hash_function_name, hexdigest), 'rb') as file:
+                while True:
+                    data = file.read(chunk_size)
+                    if not data:
+                        break
+                    hash_function.update(data)
+                    pack.write(data)
+            locations.append((offset, pack.tell() - offset))
+
+        size = pack.tell()
+        pack.seek(0)
+        label = "pack of {} objects".format(len(objects))
+        backend.push(pack, hash_function.hexdigest(), cb=transfer_callback(label, jobs, size))
+
+    if jobs == 1:
+        sys.stderr.write("\n")
+    sys.stderr.write("uploaded {}\n".format(label))
+    return hash_function.hexdigest(), locations
+
+
+def download_object(backend, filename, hash_function_name, hexdigest, codec_name, threads, jobs,
+                    check_remote=True):
+    """
+    Download an object from the backend into the working tree. Runs on a
+    transfer worker.
+
+    Compressed objects are streamed from the backend through the decompressor
+    and straight into the file, with the download running on its own thread so
+    that the network and the decompressor are busy at the same time. The
+    contents are hashed on the way through, and only replace the working tree
+    file once they match the pointer.
+
+    :param codec_name: codec the object was compressed with, if any
+    :param threads: number of threads to decompress with
+    :param check_remote: ask the backend whether it has the object first
+    :return: True if the file was downloaded
+    """
+    if check_remote and not backend.exists(hexdigest):
+        return False
+
+    if codec_name:
+        decompressor = make_decompressor(get_codec(codec_name), threads)
+        callback = transfer_callback(filename, jobs)
+
+        def decompressed():
+            for data in prefetch(backend.stream(hexdigest, chunk_size), download_queue_size):
+                if callback:
+                    callback(len(data))
+                yield decompressor.decompress(data)
+            yield decompressor.flush()
+
+        write_verified(filename, hash_function_name, hexdigest, decompressed())
     else:
-        filters = []
+        with open(filename, 'wb') as file:
+            backend.pull(file, hexdigest, cb=transfer_callback(filename, jobs))
 
-    for sha, filename, compress in pathnames():
-        should_process = len(filters) == 0 or any(fnmatch.fnmatch(filename, filter) for filter in filters)
-        if should_process:
-            try:
-                entries = g().notes("--ref=bigstore", "show", sha).split('\n')
-            except git.exc.GitCommandError:
-                if is_bigstore_file(filename):
-                    # Possibly this file was added on another fork so we don't have metadata.
-                    # Lets try assuming a default entry and see if it downloads anything.
-                    entries = ['\t'.join([
-                        '',
-                        'upload-compressed' if compress else 'upload',
-                        config('bigstore.backend'),  # default backend
-                        ''])]
-                else:
-                    entries = []
-            for entry in entries:
-                _, action, backend_name, _ = entry.split('\t')
-                if action in ('upload', 'upload-compressed'):
-                    firstline, hash_function_name, hexdigest = g().show(sha).split('\n')
-                    if firstline == 'bigstore':
-                        try:
-                            with open(object_filename(hash_function_name, hexdigest)):
-                                pass
-                        except IOError:
-                            backend = backend_for_name(backend_name)
-                            if backend.exists(hexdigest):
-                                if action == 'upload-compressed':
-                                    with tempfile.TemporaryFile() as compressed_file:
-                                        backend.pull(compressed_file, hexdigest, cb=ProgressPercentage(filename))
-                                        compressed_file.seek(0)
-
-                                        decompressor = bz2.BZ2Decompressor()
-                                        with open(filename, 'wb') as file:
-                                            for line in compressed_file:
-                                                file.write(decompressor.decompress(line))
-                                else:
-                                    with open(filename, 'wb') as file:
-                                        backend.pull(file, hexdigest, cb=ProgressPercentage(filename))
-
-                                sys.stderr.write('\n')
-                                g().add(filename)
+    if jobs == 1:
+        sys.stderr.write('\n')
+    else:
+        sys.stderr.write('downloaded {}\n'.format(filename))
 
-                    break
+    return True
+
+
+def download_packed_objects(backend, pack_hexdigest, offset, length, members, jobs):
+    """
+    Fetch one range of a pack and write out each of the objects in it. Runs on
+    a transfer worker.
+
+    :param members: list of (offset, length, (filename, hash function name,
+                    hexdigest)) for the objects within the range
+    :return: list of the filenames written
+    """
+    data = backend.read_range(pack_hexdigest, offset, length)
+    if len(data) != length:
+        raise IOError("short read from pack {}: {} of {} bytes".format(pack_hexdigest, len(data), length))
+
+    filenames = []
+    for member_offset, member_length, (filename, hash_function_name, hexdigest) in members:
+        start = member_offset - offset
+        write_verified(filename, hash_function_name, hexdigest, [data[start:start + member_length]])
+        filenames.append(filename)
+        sys.stderr.write('downloaded {}\n'.format(filename))
+    return filenames
 
-    sys.stderr.write('pushing bigstore metadata...')
+
+def read_local_chunk(location, chunk, length):
+    """
+    :param location: where the chunk index says the chunk is, or None
+    :return: the chunk's contents from the local object store, or None if they
+             aren't there
+    """
+    if location is None:
+        return None
+
+    hash_function_name, hexdigest, offset = location
     try:
-        g().push('origin', 'refs/notes/bigstore')
-        sys.stderr.write('done\n')
-    except git.exc.GitCommandError as e:
-        if e.stderr and 'read only' in e.stderr:
-            sys.stderr.write('read only\n')
+        with open(object_filename(hash_function_name, hexdigest), 'rb') as file:
+            file.seek(offset)
+            data = file.read(length)
+    except (IOError, OSError):
+        return None
+
+    if len(data) != length or chunk_hexdigest(data) != chunk:
+        return None
+    touch_object(hash_function_name, hexdigest, os.path.getsize(object_filename(hash_function_name, hexdigest)))
+    return data
+
+
+def download_chunked_object(backend, filename, hash_function_name, hexdigest, manifest_hexdigest, locate, jobs,
+                            label=None):
+    """
+    Rebuild an object that was uploaded as chunks, taking every chunk that a
+    local object already contains from the object store and downloading the
+    rest. Runs on a transfer worker.
+
+    :param locate: function mapping a chunk hexdigest to where the chunk index
+                   says it is
+    :param label: name to report progress under, if not `filename`
+    :return: list of (chunk hexdigest, length) from the manifest
+    """
+    label = label or filename
+    entries = parse_manifest(b"".join(backend.stream(manifest_hexdigest)))
+    callback = transfer_callback(label, jobs, sum(length for _, length in entries))
+    downloaded = [0]
+
+    def contents():
+        for chunk, length in entries:
+            data = read_local_chunk(locate(chunk), chunk, length)
+            if data is None:
+                data = b"".join(backend.stream(chunk, chunk_size))
+                downloaded[0] += 1
+            if callback:
+                callback(len(data))
+            yield data
+
+    write_verified(filename, hash_function_name, hexdigest, prefetch(contents(), download_queue_size))
+
+    if jobs == 1:
+        sys.stderr.write('\n')
+    sys.stderr.write('downloaded {} ({} of {} chunks)\n'.format(label, downloaded[0], len(entries)))
+    return entries
+
+
+def smudge_fetch_enabled():
+    """
+    Whether the smudge filter downloads objects that aren't available locally
+    (`bigstore.smudge.fetch`), rather than leaving their pointers in place.
+    """
+    return bool(bool_setting("bigstore.smudge.fetch"))
+
+
+def smudge_fetch_jobs():
+    """
+    Number of objects the filter process fetches at once during a checkout,
+    from `bigstore.smudge.jobs`, then `bigstore.jobs`. Defaults to 8.
+
+    :return: int
+    """
+    jobs = int_setting("bigstore.smudge.jobs")
+    if jobs is None:
+        jobs = int_setting("bigstore.jobs")
+    return max(1, jobs) if jobs is not None else 8
+
+
+def pointer_blob_sha(data):
+    """ :return: the sha of the git blob holding pointer contents `data` """
+    return hashlib.sha1(b"blob " + str(len(data)).encode('ascii') + b"\0" + data).hexdigest()
+
+
+smudge_notes = None
+
+
+def object_source(sha):
+    """
+    Where to fetch the object behind the pointer blob `sha` from, going by the
+    bigstore notes, which are read the first time they're needed.
+
+    :return: (backend name, upload action)
+    """
+    global smudge_notes
+    if smudge_notes is None:
+        smudge_notes = load_notes_index()
+
+    for _, action, backend_name, _ in smudge_notes.entries(sha):
+        if is_upload_action(action):
+            return backend_name, action
+
+    # Possibly this file was added on another fork so we don't have metadata.
+    # The default backend may have it anyway.
+    return config('bigstore.backend'), 'upload'
+
+
+def fetch_object(backend, hash_function_name, hexdigest, action, label, locate=None):
+    """
+    Download an object into the local object store, for the smudge filter to
+    check out. Runs on a transfer worker.
+
+    Unlike pull, the working tree and the index are left to git, and there are
+    no progress bars, since a smudge filter's stdout carries file contents.
+
+    :param action: upload action from the object's notes
+    :param label: pathname to report progress under
+    :param locate: chunk index lookup, for objects that were uploaded as chunks
+    :return: True if the object is available locally, False if it couldn't be
+             fetched (the error is reported, not raised)
+    """
+    if find_object(hash_function_name, hexdigest):
+        return True
+
+    filename = object_filename(hash_function_name, hexdigest)
+    mkdir_p(os.path.dirname(filename))
+    location = location_for_action(action)
+    manifest_hexdigest = manifest_for_action(action)
+    codec_name = codec_for_action(action)
+    try:
+        if location:
+            pack_hexdigest, offset, length = location
+            data = backend.read_range(pack_hexdigest, offset, length)
+            write_verified(filename, hash_function_name, hexdigest, [data])
+        elif manifest_hexdigest:
+            download_chunked_object(backend, filename, hash_function_name, hexdigest, manifest_hexdigest,
+                                    locate or (lambda chunk: None), None, label)
         else:
-            # An error pushing during a pull is not fatal
-            sys.stderr.write('ERROR\n')
+            decompressor = make_decompressor(get_codec(codec_name), decompression_threads()) if codec_name else None
+
+            def contents():
+                for data in prefetch(backend.stream(hexdigest, chunk_size), download_queue_size):
+                    yield decompressor.decompress(data) if decompressor else data
+                if decompressor:
+                    yield decompressor.flush()
+
+            write_verified(filename, hash_function_name, hexdigest, contents())
+    except Exception as e:
+        sys.stderr.write("bigstore: couldn't fetch {}: {}\n".format(label, e))
+        return False
+
+    share_object(hash_function_name, hexdigest)
+    if not manifest_hexdigest:
+        sys.stderr.write('downloaded {}\n'.format(label))
+    return True
+
+
+def push(patterns=None, jobs=None, verify_remote=False, pack=None):
+    """
+    Upload bigstore objects for tracked files that haven't been uploaded to the
+    default backend yet.
+
+    :param patterns: only push filenames matching one of these wildcards
+    :param jobs: number of concurrent uploads; defaults to `bigstore.jobs`
+    :param verify_remote: ask the backend about each object instead of going by
+                          the remote inventory
+    :param pack: upload small objects in packs; defaults to whether
+                 `bigstore.pack.threshold` is set
+    """
+    assert_initialized()
+    pull_metadata()
+
+    if jobs is None:
+        jobs = default_jobs()
+    reserve_jobs(jobs)
+
+    notes = load_notes_index()
+    backend = default_backend()
+    user_name = repository_config.get("user.name")
+    user_email = repository_config.get("user.email")
+
+    levels = dict((codec_name, codec_level(codec_name)) for codec_name in codec_names)
+    threads = compression_threads()
+    # Only listed once it's clear that there's enough to look up.
+    inventory = None
+    chunk_index = load_chunk_index()
+    packing = pack_settings(pack)
+    # (hash function name, hexdigest) -> (size, shas of the pointers) for
+    # objects waiting to be packed
+    pending = collections.OrderedDict()
+    # Uploads are journaled as they finish, until the notes commit that
+    # records them has been written.
+    journal = transfer_journal("push-{}".format(backend.name))
+
+    def save_progress():
+        journal.clear()
+        if inventory is not None:
+            inventory.save()
+
+    notes_writer = NotesWriter(on_flush=save_progress)
+
+    def append_note(sha, action):
+        # We use the timestamp as the first entry as it will help us
+        # sort the entries easily with the cat_sort_uniq merge.
+        entry = (str(time.time()), action, backend.name, "{} <{}>".format(user_name, user_email))
+        journal.complete(sha, *entry)
+        notes_writer.append(sha, entry)
+        notes.add(sha, entry)
+
+    # Uploads that finished before an earlier push was interrupted only need
+    # their notes written; the backend isn't asked about them again.
+    interrupted = journal.interrupted()
+    recovered = 0
+    for sha, entry in journal.done.items():
+        if len(entry) == 4 and tuple(entry) not in notes.entries(sha):
+            notes_writer.append(sha, tuple(entry))
+            notes.add(sha, entry)
+            recovered += 1
+    if recovered or interrupted:
+        sys.stderr.write("resuming interrupted push: {} uploads already done, {} to retry\n".format(
+            recovered, len(interrupted)))
+
+    # (hash function name, hexdigest) -> shas of the pointers waiting for the
+    # object's upload, or the action it was uploaded with once that's done.
+    # Files with the same contents share one upload.
+    uploads = {}
+
+    def share_upload(key, sha):
+        """
+        Have `sha` share the upload of its object, if this push has already
+        started one.
+
+        :return: False if it hasn't
+        """
+        waiting = uploads.get(key)
+        if waiting is None:
+            return False
+        if isinstance(waiting, list):
+            journal.queue(sha)
+            waiting.append(sha)
+        else:
+            append_note(sha, waiting)
+        return True
+
+    def finish_upload(key, action):
+        for sha in uploads[key]:
+            append_note(sha, action)
+        uploads[key] = action
+
+    def record_upload(key, codec_name):
+        def callback(streams):
+            # An object that was already on the backend (streams is None)
+            # could have been compressed in several streams, so it's given
+            # the action that handles either.
+            if codec_name:
+                action = compressed_action(codec_name, streams)
+            else:
+                action = "upload"
+
+            finish_upload(key, action)
+            if inventory is not None:
+                inventory.add(key[1])
+        return callback
+
+    def record_chunked_upload(key):
+        hash_function_name, hexdigest = key
+
+        def callback(result):
+            manifest_hexdigest, entries = result
+            finish_upload(key, chunked_action(manifest_hexdigest))
+            chunk_index.add(hash_function_name, hexdigest, entries)
+            if inventory is not None:
+                inventory.add(manifest_hexdigest)
+                for chunk, _ in entries:
+                    inventory.add(chunk)
+        return callback
+
+    def record_pack(members):
+        def callback(result):
+            pack_hexdigest, locations = result
+            for shas, (offset, length) in zip(members, locations):
+                for sha in shas:
+                    append_note(sha, packed_action(pack_hexdigest, offset, length))
+            if inventory is not None:
+                inventory.add(pack_hexdigest)
+        return callback
+
+    def packed_size(hash_function_name, hexdigest):
+        """ :return: the object's size if it should go in a pack, or None """
+        if not packing:
+            return None
+        try:
+            size = os.path.getsize(object_filename(hash_function_name, hexdigest))
+        except OSError:
+            return None
+        return size if size <= packing[0] else None
+
+    # Whatever has been uploaded is recorded in one notes commit, even if a
+    # later upload fails.
+    with notes_writer, TransferPool(jobs, backend_for_name) as pool, CatFile() as catfile:
+        # Files that haven't been uploaded to this backend yet, one per blob.
+        candidates = collections.OrderedDict()
+        # Should show a message to the user if not in the base directory.
+        for sha, filename, filter_name in pathnames(patterns):
+            if sha in candidates:
+                continue
+            for timestamp, action, backend_name, _ in notes.entries(sha):
+                if is_upload_action(action) and backend.name == backend_name:
+                    break
+            else:
+                candidates[sha] = (filename, filter_name)
+
+        # Listing the backend takes a request per prefix, so it only pays off
+        # with more objects than that to look up; a few are asked about one at
+        # a time instead.
+        if not verify_remote and len(candidates) > len(prefixes):
+            inventory = remote_inventory(backend.name)
+
+        for sha, (filename, filter_name) in candidates.items():
+            codec_name = codec_for_filter(filter_name)
+            pointer = catfile.pointer(sha)
+            if pointer:
+                hash_function_name, hexdigest = pointer
+                key = (hash_function_name, hexdigest)
+                if key in pending:
+                    # The same contents as a file that's waiting to be packed.
+                    pending[key][1].append(sha)
+                elif share_upload(key, sha):
+                    continue
+                elif filter_name == chunked_filter_name:
+                    journal.queue(sha)
+                    uploads[key] = [sha]
+                    pool.submit(record_chunked_upload(key), backend.name,
+                                upload_chunked_object, filename, hash_function_name, hexdigest,
+                                inventory.contains if inventory is not None else None, jobs)
+                elif inventory is not None and inventory.contains(hexdigest):
+                    uploads[key] = [sha]
+                    record_upload(key, codec_name)(None)
+                else:
+                    size = packed_size(hash_function_name, hexdigest)
+                    if size is not None:
+                        pending[key] = (size, [sha])
+                    else:
+                        journal.queue(sha)
+                        uploads[key] = [sha]
+                        pool.submit(record_upload(key, codec_name), backend.name, upload_object,
+                                    filename, hash_function_name, hexdigest, codec_name,
+                                    levels.get(codec_name), threads, jobs, inventory is None)
+
+        if pending:
+            packs = plan_packs([((pointer, shas), size) for pointer, (size, shas) in pending.items()], packing[1])
+            for members in packs:
+                for _, shas in members:
+                    for sha in shas:
+                        journal.queue(sha)
+                pool.submit(record_pack([shas for _, shas in members]), backend.name, upload_pack,
+                            [pointer for pointer, _ in members], jobs)
+
+        pool.join()
+
+    journal.remove()
+    if inventory is not None:
+        inventory.save()
+    chunk_index.save()
+    enforce_cache_limit()
+
+    push_metadata()
+
+
+def pull(patterns=None, jobs=None, verify_remote=False):
+    """
+    Download bigstore objects for tracked files that aren't available locally.
+
+    :param patterns: only pull filenames matching one of these wildcards
+    :param jobs: number of concurrent downloads; defaults to `bigstore.jobs`
+    :param verify_remote: ask the backend about each object instead of going by
+                          the remote inventory
+    """
+    assert_initialized()
+    pull_metadata()
+
+    if jobs is None:
+        jobs = default_jobs()
+    reserve_jobs(jobs)
+
+    notes = load_notes_index()
+    threads = decompression_threads()
+
+    chunk_index = load_chunk_index()
+    # (backend name, pack hexdigest) -> list of (offset, length, (filename,
+    # hash function name, hexdigest))
+    packed = collections.OrderedDict()
+    # backend name -> list of (filename, (hash function name, hexdigest),
+    # action) for objects downloaded on their own
+    unpacked = collections.OrderedDict()
+
+    # Downloaded files are journaled until they're staged, so that the next
+    # pull stages whatever an interrupted one had written out.
+    journal = transfer_journal("pull")
+    downloaded = [filename for filename in journal.done
+                  if os.path.isfile(filename) and not is_bigstore_file(filename)]
+    if downloaded:
+        sys.stderr.write("resuming interrupted pull: staging {} downloaded files\n".format(len(downloaded)))
+        stage_files(downloaded)
+    journal.clear()
+    unstaged = []
+
+    def stage_downloaded(filenames, batch_size=1000):
+        for filename in filenames:
+            journal.complete(filename)
+            unstaged.append(filename)
+        if len(unstaged) >= batch_size:
+            stage_files(unstaged)
+            del unstaged[:]
+            journal.clear()
+
+    # (hash function name, hexdigest) -> files waiting for the object to be
+    # downloaded for another file with the same contents, or the file it was
+    # downloaded to once that's done. Each object is only downloaded once.
+    downloads = {}
+
+    def share_download(key, filename):
+        """
+        Have `filename` share the download of its object, if this pull has
+        already started one.
+
+        :return: False if it hasn't
+        """
+        waiting = downloads.get(key)
+        if waiting is None:
+            return False
+        if isinstance(waiting, list):
+            journal.queue(filename)
+            waiting.append(filename)
+        else:
+            stage_downloaded(copy_download(waiting, [filename]))
+        return True
+
+    def finish_download(key, filename):
+        """ :return: the files written """
+        waiting, downloads[key] = downloads[key], filename
+        return [filename] + copy_download(filename, waiting)
+
+    def copy_download(source_filename, filenames):
+        for filename in filenames:
+            with open(source_filename, 'rb') as source, open(filename, 'wb') as file:
+                copy_to_output(source, file)
+            sys.stderr.write("{} (same contents as {})\n".format(filename, source_filename))
+        return filenames
+
+    def add_file(filename, key):
+        def callback(downloaded):
+            if downloaded:
+                stage_downloaded(finish_download(key, filename))
+        return callback
+
+    def add_chunked_file(filename, key):
+        hash_function_name, hexdigest = key
+
+        def callback(entries):
+            stage_downloaded(finish_download(key, filename))
+            chunk_index.add(hash_function_name, hexdigest, entries)
+        return callback
+
+    def add_packed_files(members):
+        def callback(filenames):
+            written = []
+            for _, _, (filename, hash_function_name, hexdigest) in members:
+                written += finish_download((hash_function_name, hexdigest), filename)
+            stage_downloaded(written)
+        return callback
+
+    with TransferPool(jobs, backend_for_name) as pool, CatFile() as catfile:
+        for sha, filename, filter_name in pathnames(patterns):
+            codec_name = codec_for_filter(filter_name)
+            entries = notes.entries(sha)
+            # Chunked files can't be found without the manifest named in their
+            # metadata.
+            if not entries and filter_name != chunked_filter_name and is_bigstore_file(filename):
+                # Possibly this file was added on another fork so we don't have metadata.
+                # Lets try assuming a default entry and see if it downloads anything.
+                entries = [(
+                    '',
+                    compressed_action(codec_name) if codec_name else 'upload',
+                    config('bigstore.backend'),  # default backend
+                    '')]
+            for _, action, backend_name, _ in entries:
+                if is_upload_action(action):
+                    pointer = catfile.pointer(sha)
+                    if pointer:
+                        hash_function_name, hexdigest = pointer
+                        key = (hash_function_name, hexdigest)
+                        source_filename = find_object(hash_function_name, hexdigest)
+                        if source_filename:
+                            # e.g. brought in from the shared object cache; the
+                            # working tree may still hold the pointer.
+                            if is_bigstore_file(filename):
+                                restore_file(source_filename, filename, pointer)
+                                sys.stderr.write("{} (from the local object store)\n".format(filename))
+                                stage_downloaded([filename])
+                        elif not share_download(key, filename):
+                            downloads[key] = []
+                            manifest_hexdigest = manifest_for_action(action)
+                            location = location_for_action(action)
+                            if location:
+                                pack_hexdigest, offset, length = location
+                                packed.setdefault((backend_name, pack_hexdigest), []).append(
+                                    (offset, length, (filename, hash_function_name, hexdigest)))
+                            elif manifest_hexdigest:
+                                journal.queue(filename)
+                                pool.submit(add_chunked_file(filename, key), backend_name, download_chunked_object,
+                                            filename, hash_function_name, hexdigest, manifest_hexdigest,
+                                            chunk_index.locate, jobs)
+                            else:
+                                unpacked.setdefault(backend_name, []).append((filename, key, action))
+
+                    break
+
+        for backend_name, objects in unpacked.items():
+            # Listing the backend takes a request per prefix, so it only pays
+            # off with more objects than that to look up there.
+            inventory = None
+            if not verify_remote and backend_name and len(objects) > len(prefixes):
+                inventory = remote_inventory(backend_name)
+            for filename, key, action in objects:
+                hash_function_name, hexdigest = key
+                journal.queue(filename)
+                # Anything the inventory doesn't know about may have been
+                # uploaded since it was listed, so it's still worth asking the
+                # backend.
+                pool.submit(add_file(filename, key), backend_name, download_object, filename,
+                            hash_function_name, hexdigest, codec_for_action(action), threads, jobs,
+                            inventory is None or not inventory.contains(hexdigest))
+
+        # Objects from the same pack are fetched together, with one ranged
+        # request for any that are close to each other.
+        for (backend_name, pack_hexdigest), objects in packed.items():
+            for offset, length, members in coalesce(objects):
+                for _, _, (filename, _, _) in members:
+                    journal.queue(filename)
+                pool.submit(add_packed_files(members), backend_name, download_packed_objects, pack_hexdigest,
+                            offset, length, members, jobs)
+
+        pool.join()
+
+    stage_files(unstaged)
+    journal.remove()
+    chunk_index.save()
+    enforce_cache_limit()
+
+    # An error pushing during a pull is not fatal
+    push_metadata(fatal=False)
 
 
 def fetch(repository):
@@ -390,63 +1643,441 @@ def fetch(repository):
     pull_metadata()
     pull_metadata(repository)
 
-    sys.stderr.write("pushing bigstore metadata...")
-    g().push("origin", "refs/notes/bigstore")
-    sys.stderr.write("done\n")
+    push_metadata()
+
+
+def read_chunk(input, view):
+    """
+    Fill `view` from `input`, stopping short only at the end of the input.
+
+    :return: number of bytes read
+    """
+    # Python 2's SpooledTemporaryFile can only read().
+    readinto = getattr(input, 'readinto', None)
+    count = 0
+    while count < len(view):
+        if readinto is not None:
+            n = readinto(view[count:])
+        else:
+            data = input.read(len(view) - count)
+            n = len(data)
+            view[count:count + n] = data
+        if not n:
+            break
+        count += n
+    return count
 
 
-def filter_clean():
-    # Operate on stdin/stdout in binary mode
-    firstline = next(stdin)
-    if firstline == b"bigstore\n":
-        stdout.write(firstline)
-        for line in stdin:
-            stdout.write(line)
+def store_object(temporary_filename, hash_function_name, hexdigest):
+    """
+    Move a freshly written object into place, or throw it away if the object
+    store (or the shared object cache) already has it.
+    """
+    if find_object(hash_function_name, hexdigest):
+        os.unlink(temporary_filename)
     else:
-        file = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-        hash_function = default_hash_function()
-        hash_function.update(firstline)
-        file.write(firstline)
+        filename = object_filename(hash_function_name, hexdigest)
+        mkdir_p(os.path.dirname(filename))
+        replace(temporary_filename, filename)
+
+
+def filter_clean(input=None, output=None):
+    """
+    Replace file contents with a bigstore pointer, storing the contents as an
+    object in the local object directory.
+
+    Input is read in fixed-size chunks and hashed as it is written to a
+    temporary file next to the objects, which is then renamed into place.
+
+    :param input: binary stream to read file contents from (default: stdin)
+    :param output: binary stream to write the pointer to (default: stdout)
+    """
+    input = input or stdin
+    output = output or stdout
 
-        for line in stdin:
-            hash_function.update(line)
-            file.write(line)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    count = read_chunk(input, view)
 
-        file.close()
+    if view[:len(pointer_prefix)] == pointer_prefix:
+        while count:
+            output.write(view[:count])
+            count = read_chunk(input, view)
+        return
+
+    hash_function_name = default_hash_function_name()
+    hash_function = hash_functions[hash_function_name]()
+    hash_function.update(view[:count])
+    directory = object_directory(hash_function_name)
+    size = count
+
+    if count < chunk_size:
+        # All of the input fit in one chunk, so there's nothing to write if the
+        # object is already stored.
+        hexdigest = hash_function.hexdigest()
+        if not find_object(hash_function_name, hexdigest):
+            mkdir_p(directory)
+            fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".clean-")
+            with os.fdopen(fd, 'wb') as file:
+                file.write(view[:count])
+            store_object(temporary_filename, hash_function_name, hexdigest)
+    else:
+        mkdir_p(directory)
+        fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".clean-")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                while count:
+                    file.write(view[:count])
+                    count = read_chunk(input, view)
+                    hash_function.update(view[:count])
+                    size += count
+        except BaseException:
+            os.unlink(temporary_filename)
+            raise
 
         hexdigest = hash_function.hexdigest()
-        mkdir_p(os.path.join(object_directory(default_hash_function_name), hexdigest[:2]))
-        shutil.copy(file.name, object_filename(default_hash_function_name, hexdigest))
+        store_object(temporary_filename, hash_function_name, hexdigest)
 
-        stdout.write(b"bigstore\n")
-        stdout.write(native_str_to_bytes("{}\n".format(default_hash_function_name)))
-        stdout.write(native_str_to_bytes("{}\n".format(hexdigest)))
+    share_object(hash_function_name, hexdigest)
+    touch_object(hash_function_name, hexdigest, size)
 
+    output.write(pointer_prefix)
+    output.write("{}\n".format(hash_function_name).encode('ascii'))
+    output.write("{}\n".format(hexdigest).encode('ascii'))
 
-def filter_smudge():
-    # Operate on stdin/stdout in binary mode
-    firstline = next(stdin)
-    if firstline == b"bigstore\n":
-        hash_function_name = next(stdin)
-        hexdigest = next(stdin)
-        source_filename = object_filename(bytes_to_native_str(hash_function_name)[:-1],
-                                          bytes_to_native_str(hexdigest)[:-1])
 
+def copy_to_output(file, output):
+    """
+    Copy the rest of `file` to `output`, letting the kernel move the data with
+    sendfile(2) when both ends are real file descriptors.
+    """
+    try:
+        output_fd = output.fileno()
+        input_fd = file.fileno()
+        sendfile = os.sendfile
+        # sendfile(2) can only read from files it can map, not from pipes.
+        regular_file = stat.S_ISREG(os.fstat(input_fd).st_mode)
+    except (AttributeError, io.UnsupportedOperation):
+        regular_file = False
+
+    if regular_file:
+        output.flush()
+        offset = file.tell()
         try:
-            with open(source_filename):
-                pass
+            while True:
+                sent = sendfile(output_fd, input_fd, offset, chunk_size)
+                if not sent:
+                    return
+                offset += sent
+        except OSError as e:
+            # e.g. older kernels and macOS only sendfile to sockets
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+            file.seek(offset)
+
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    count = read_chunk(file, view)
+    while count:
+        output.write(view[:count])
+        count = read_chunk(file, view)
+
+
+def filter_smudge(input=None, output=None, pathname=None, fetch=None):
+    """
+    Replace a bigstore pointer with the contents of its object, if the object is
+    available locally or, with `bigstore.smudge.fetch` set, can be downloaded.
+    Otherwise the pointer is written back out unchanged.
+
+    :param input: binary stream to read the pointer from (default: stdin)
+    :param output: binary stream to write file contents to (default: stdout)
+    :param pathname: file being checked out, for messages
+    :param fetch: download missing objects; defaults to `bigstore.smudge.fetch`
+    """
+    input = input or stdin
+    output = output or stdout
+
+    # Anything bigger than a pointer is passed through untouched.
+    view = memoryview(bytearray(pointer_max_size + 1))
+    count = read_chunk(input, view)
+    data = view[:count].tobytes()
+    pointer = parse_pointer(data)
+
+    if pointer:
+        hash_function_name, hexdigest = pointer
+        # Brings the object in from the shared object cache if need be.
+        if not find_object(hash_function_name, hexdigest) and (smudge_fetch_enabled() if fetch is None else fetch):
+            backend_name, action = object_source(pointer_blob_sha(data))
+            fetch_object(backend_for_name(backend_name), hash_function_name, hexdigest, action,
+                         pathname or hexdigest, load_chunk_index().locate)
+        try:
+            file = open(object_filename(hash_function_name, hexdigest), 'rb')
         except IOError:
-            stdout.write(firstline)
-            stdout.write(hash_function_name)
-            stdout.write(hexdigest)
+            output.write(view[:count])
+        else:
+            with file:
+                touch_object(hash_function_name, hexdigest, os.fstat(file.fileno()).st_size)
+                copy_to_output(file, output)
+    else:
+        output.write(view[:count])
+        copy_to_output(input, output)
+
+
+# ioctl request to clone a file's extents, from <linux/fs.h>
+FICLONE = 0x40049409
+
+
+def reflink(source_filename, filename):
+    """
+    Make `filename` a copy-on-write clone of `source_filename` (Linux FICLONE).
+
+    :return: False if the filesystem can't clone files
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    with open(source_filename, 'rb') as source, open(filename, 'wb') as file:
+        try:
+            fcntl.ioctl(file.fileno(), FICLONE, source.fileno())
+        except (IOError, OSError):
+            return False
+    return True
+
+
+def hard_link(source_filename, filename, mode):
+    """
+    Hard link `filename` to an object. The link shares the object's mode, which
+    is made read-only, since writing to the working tree file in place would
+    change the object too. An object that's still writable hasn't been linked
+    anywhere, so it takes on `mode`; one that has is only linked again where
+    the mode is the same, since git would see the executable bit change.
+
+    :param mode: permissions `filename` should have, or None for the object's
+    :return: False if the file couldn't be linked
+    """
+    object_mode = os.stat(source_filename).st_mode & 0o777
+    wanted = (object_mode if mode is None else mode) & ~0o222
+    try:
+        if object_mode != wanted:
+            if not object_mode & 0o222:
+                return False
+            os.chmod(source_filename, wanted)
+        os.link(source_filename, filename)
+    except OSError:
+        return False
+    return True
+
+
+def link_object(source_filename, filename):
+    """
+    Replace `filename` with a reflink to an object, or a hard link (see
+    hard_link()) where the filesystem can't clone files, keeping the file's
+    mode either way.
+
+    :return: "reflink", "hardlink" or "copy", depending on what was possible
+    """
+    directory = os.path.dirname(filename) or "."
+    fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".bigstore-")
+    os.close(fd)
+
+    try:
+        mode = os.stat(filename).st_mode & 0o777
+    except OSError:
+        mode = None
+
+    try:
+        if reflink(source_filename, temporary_filename):
+            method = "reflink"
+            if mode is not None:
+                os.chmod(temporary_filename, mode)
         else:
-            with open(source_filename, 'rb') as file:
-                for line in file:
-                    stdout.write(line)
+            os.unlink(temporary_filename)
+            if hard_link(source_filename, temporary_filename, mode):
+                method = "hardlink"
+            else:
+                # Probably a different filesystem than the object directory, or
+                # an object that's already linked with another mode.
+                with open(source_filename, 'rb') as source, open(temporary_filename, 'wb') as file:
+                    copy_to_output(source, file)
+                method = "copy"
+                if mode is not None:
+                    os.chmod(temporary_filename, mode)
+
+        replace(temporary_filename, filename)
+    except BaseException:
+        if os.path.exists(temporary_filename):
+            os.unlink(temporary_filename)
+        raise
+
+    return method
+
+
+def stage_files(filenames, batch_size=1000):
+    """ `git add` files, a batch at a time rather than one process per file. """
+    for offset in range(0, len(filenames), batch_size):
+        g().execute(["git", "--literal-pathspecs", "add", "--"] + filenames[offset:offset + batch_size])
+
+
+def restore_file(source_filename, filename, pointer, link=False):
+    """
+    Replace a pointer file in the working tree with its object's contents.
+
+    :param link: reflink or hard link the file to the object store instead of
+                 copying it
+    :return: how the file was written, as reported by `checkout`
+    """
+    if link:
+        method = link_object(source_filename, filename)
     else:
-        stdout.write(firstline)
-        for line in stdin:
-            stdout.write(line)
+        with open(source_filename, 'rb') as source, open(filename, 'wb') as file:
+            copy_to_output(source, file)
+        method = "copy"
+
+    touch_object(pointer[0], pointer[1], os.path.getsize(source_filename))
+    return method
+
+
+def checkout(patterns=None, link=False):
+    """
+    Replace pointer files in the working tree with the contents of their
+    objects, for objects that are available locally.
+
+    :param patterns: only check out filenames matching one of these wildcards
+    :param link: reflink or hard link files to the object store instead of
+                 copying their contents
+    """
+    filenames = []
+    with CatFile() as catfile:
+        for sha, filename, _ in pathnames(patterns):
+            if not is_bigstore_file(filename):
+                continue
+
+            pointer = catfile.pointer(sha)
+            if not pointer:
+                continue
+
+            source_filename = find_object(*pointer)
+            if not source_filename:
+                sys.stderr.write("{}: not available locally, run `git bigstore pull`\n".format(filename))
+                continue
+
+            method = restore_file(source_filename, filename, pointer, link)
+            filenames.append(filename)
+            sys.stderr.write("{} ({})\n".format(filename, method))
+
+    # The index still has the pointers' sizes and timestamps, so git would see
+    # every file as modified until it is cleaned again.
+    stage_files(filenames)
+    enforce_cache_limit()
+
+
+def load_cache_index():
+    """ :return: CacheIndex for the local object store, with the access log folded in """
+    index = CacheIndex.load(os.path.join(bigstore_directory(), "cache-index"))
+    index.replay(os.path.join(bigstore_directory(), "access-log"))
+    return index
+
+
+def cache_max_size():
+    """ Size cap for the local object store from bigstore.cache.max-size, or None. """
+    return parse_size(setting("bigstore.cache.max-size"))
+
+
+def pinned_objects():
+    """
+    Objects that pruning must keep: those that files in HEAD point to, and any
+    that the bigstore notes don't record as uploaded to some backend.
+
+    :return: (set of (hash function name, hexdigest) in HEAD, set of (hash
+             function name, hexdigest) that have been uploaded)
+    """
+    with CatFile() as catfile:
+        in_head = set()
+        for sha, _, _ in pathnames():
+            pointer = catfile.pointer(sha)
+            if pointer:
+                in_head.add(pointer)
+
+        uploaded = set()
+        for sha, entries in load_notes_index().items():
+            if any(is_upload_action(action) for _, action, _, _ in entries):
+                pointer = catfile.pointer(sha)
+                if pointer:
+                    uploaded.add(pointer)
+
+    return in_head, uploaded
+
+
+def prune(max_size=None, dry_run=False, index=None):
+    """
+    Remove the least recently used objects from the local object store until
+    it fits in `max_size`. Objects that files in HEAD point to, or that haven't
+    been uploaded, are always kept; anything removed is downloaded again by
+    the next `git bigstore pull` that needs it.
+
+    :param max_size: size to prune to in bytes; defaults to
+                     bigstore.cache.max-size, or removing everything that can
+                     be removed
+    :param dry_run: only report what would be removed
+    :param index: CacheIndex to prune with, which is checked against the object
+                  directories if it isn't given
+    """
+    if max_size is None:
+        max_size = cache_max_size() or 0
+
+    if index is None:
+        assert_initialized()
+        index = load_cache_index()
+        index.scan(os.path.join(bigstore_directory(), "objects"))
+
+    total = index.total_size()
+    if total <= max_size:
+        index.save()
+        return
+
+    in_head, uploaded = pinned_objects()
+    removed = 0
+    freed = 0
+    for _, hash_function_name, hexdigest, size in index.least_recently_used():
+        if total <= max_size:
+            break
+        pointer = (hash_function_name, hexdigest)
+        if pointer in in_head or pointer not in uploaded:
+            continue
+
+        if not dry_run:
+            try:
+                os.unlink(object_filename(hash_function_name, hexdigest))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            index.remove(hash_function_name, hexdigest)
+        total -= size
+        freed += size
+        removed += 1
+
+    # Even a dry run has to keep the access log it folded in. The removals
+    # above only touched the index if they really happened.
+    index.save()
+
+    sys.stderr.write("{} {} objects ({:.1f} MB), {:.1f} MB left\n".format(
+        "would remove" if dry_run else "removed", removed, freed / (1024 * 1024), total / (1024 * 1024)))
+    if total > max_size:
+        sys.stderr.write("the rest is in use by HEAD or hasn't been uploaded yet\n")
+
+
+def enforce_cache_limit():
+    """ Prune the local object store if it has outgrown bigstore.cache.max-size. """
+    max_size = cache_max_size()
+    if max_size is None:
+        return
+
+    index = load_cache_index()
+    if not index.scanned:
+        index.scan(os.path.join(bigstore_directory(), "objects"))
+    prune(max_size, index=index)
 
 
 def request_rackspace_credentials():
@@ -457,10 +2088,10 @@ def request_rackspace_credentials():
     api_key = input("API Key: ")
     container = input("Container: ")
 
-    g().config("bigstore.backend", "cloudfiles", file=config_filename)
-    g().config("bigstore.cloudfiles.username", username, file=config_filename)
-    g().config("bigstore.cloudfiles.key", api_key, file=config_filename)
-    g().config("bigstore.cloudfiles.container", container, file=config_filename)
+    bigstore_config().set("bigstore.backend", "cloudfiles")
+    bigstore_config().set("bigstore.cloudfiles.username", username)
+    bigstore_config().set("bigstore.cloudfiles.key", api_key)
+    bigstore_config().set("bigstore.cloudfiles.container", container)
 
 
 def request_s3_credentials():
@@ -468,8 +2099,17 @@ def request_s3_credentials():
     print("Enter your Amazon S3 Bucket")
     print("Credentials are now done by ENV Variables.\n")
     s3_bucket = input("Bucket Name: ")
-    g().config("bigstore.backend", "s3", file=config_filename)
-    g().config("bigstore.s3.bucket", s3_bucket, file=config_filename)
+    bigstore_config().set("bigstore.backend", "s3")
+    bigstore_config().set("bigstore.s3.bucket", s3_bucket)
+
+def request_local_path():
+    print()
+    print("Enter the directory to store files in (relative to the top of the repository, or a file:// URL)")
+    print()
+    path = input("Path: ")
+    bigstore_config().set("bigstore.backend", "local")
+    bigstore_config().set("bigstore.local.path", path)
+
 
 def request_google_cloud_storage_credentials():
     print()
@@ -479,84 +2119,88 @@ def request_google_cloud_storage_credentials():
     google_secret = input("Secret Key: ")
     google_bucket = input("Bucket Name: ")
 
-    g().config("bigstore.backend", "gs", file=config_filename)
-    g().config("bigstore.gs.key", google_key, file=config_filename)
-    g().config("bigstore.gs.secret", google_secret, file=config_filename)
-    g().config("bigstore.gs.bucket", google_bucket, file=config_filename)
+    bigstore_config().set("bigstore.backend", "gs")
+    bigstore_config().set("bigstore.gs.key", google_key)
+    bigstore_config().set("bigstore.gs.secret", google_secret)
+    bigstore_config().set("bigstore.gs.bucket", google_bucket)
 
 
-def log():
-    filename = sys.argv[2]
-    trees = g().log("--pretty=format:%T", filename).split('\n')
-    entries = []
-    for tree in trees:
-        entry = g().ls_tree('-r', tree, filename)
-        if entry.strip() == '':
-            # skip empty lines as they will cause exceptions later
-            continue
-        metadata, filename = entry.split('\t')
-        _, _, sha = metadata.split(' ')
-        try:
-            notes = g().notes("--ref=bigstore", "show", sha).split('\n')
-        except git.exc.GitCommandError:
-            # No note found for object.
-            pass
-        else:
-            notes.reverse()
-            for note in notes:
-                if note == '':
-                    continue
+def format_timestamp(timestamp):
+    """ Format a note's timestamp in local time, like `Sat Apr 13 21:52:21 2013 PDT`. """
+    local_time = time.localtime(float(timestamp))
+    return "{} {} {}".format(time.strftime("%a %b", local_time), local_time.tm_mday,
+                             time.strftime("%H:%M:%S %Y %Z", local_time))
 
-                timestamp, action, backend, user = note.split('\t')
-                utc_dt = datetime.fromtimestamp(float(timestamp), tz=pytz.timezone("UTC"))
-                dt = utc_dt.astimezone(dateutil_tz.tzlocal())
-                formatted_date = "{} {} {}".format(dt.strftime("%a %b"), dt.strftime("%e").replace(' ', ''),
-                                                   dt.strftime("%T %Y %Z"))
-                entries.append((dt, sha, formatted_date, action, backend, user))
-
-    sorted_entries = sorted(entries, key=operator.itemgetter(0), reverse=True)
-    for dt, sha, formatted_date, action, backend, user in sorted_entries:
-        if action in ("upload", "upload-compressed"):
-            line = u"({}) {}: {} \u2190 {}".format(sha[:6], formatted_date, backend, user)
-        else:
-            line = u"({}) {}: {} \u2192 {}".format(sha[:6], formatted_date, backend, user)
 
-        print(line)
+def log(filename, limit=None, since=None):
+    """
+    Print the upload and download history of a file, newest commit first.
 
+    The file's history is read with a single streamed `git log --raw` and
+    looked up in the notes index, so each line is printed as soon as the
+    commit that introduced that version of the file is reached.
 
-def init():
+    :param filename: file (or directory) to show the history of
+    :param limit: stop after this many entries
+    :param since: only look at commits more recent than this date, in any
+                  format `git log --since` understands
+    """
+    notes = load_notes_index()
+
+    command = ["git", "log", "--raw", "-z", "--no-abbrev", "--no-renames", "--format="]
+    if since:
+        command.append("--since={}".format(since))
+    process = subprocess.Popen(command + ["--", filename], stdout=subprocess.PIPE)
+
+    printed = 0
+    seen = set()
     try:
-        g().config("bigstore.backend", file=config_filename)
-    except git.exc.GitCommandError:
+        records = read_records(process.stdout)
+        for metadata, _ in zip(records, records):
+            # The blob each commit changed the file to, or zeros if it was
+            # deleted.
+            sha = metadata.lstrip(b"\n").split(b" ")[3].decode('ascii')
+            if sha in seen or not sha.strip("0"):
+                continue
+            seen.add(sha)
+
+            for timestamp, action, backend, user in reversed(notes.entries(sha)):
+                if limit is not None and printed >= limit:
+                    return
+                arrow = u"\u2190" if is_upload_action(action) else u"\u2192"
+                print(u"({}) {}: {} {} {}".format(sha[:6], format_timestamp(timestamp), backend, arrow, user))
+                printed += 1
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def init():
+    if config("bigstore.backend") is None:
         print("What backend would you like to store your files with?")
         print("(1) Amazon S3")
         print("(2) Google Cloud Storage")
         print("(3) Rackspace Cloud Files")
+        print("(4) A local directory")
         choice = None
-        while choice not in ["1", "2", "3"]:
+        while choice not in ["1", "2", "3", "4"]:
             choice = input("Enter your choice here: ")
 
         if choice == "1":
             print("""New Behavior: Use standard aws env variables for credentials or machine role.
                    Assume-role is now supported in aws profiles.""")
-            try:
-                g().config("bigstore.s3.bucket", file=config_filename)
-            except git.exc.GitCommandError:
+            if config("bigstore.s3.bucket") is None:
                 request_s3_credentials()
         elif choice == "2":
-            try:
-                g().config("bigstore.gs.key", file=config_filename)
-                g().config("bigstore.gs.secret", file=config_filename)
-                g().config("bigstore.gs.bucket", file=config_filename)
-            except git.exc.GitCommandError:
+            if None in (config("bigstore.gs.key"), config("bigstore.gs.secret"), config("bigstore.gs.bucket")):
                 request_google_cloud_storage_credentials()
         elif choice == "3":
-            try:
-                g().config("bigstore.cloudfiles.username", file=config_filename)
-                g().config("bigstore.cloudfiles.key", file=config_filename)
-                g().config("bigstore.cloudfiles.container", file=config_filename)
-            except git.exc.GitCommandError:
+            if None in (config("bigstore.cloudfiles.username"), config("bigstore.cloudfiles.key"),
+                        config("bigstore.cloudfiles.container")):
                 request_rackspace_credentials()
+        elif choice == "4":
+            if config("bigstore.local.path") is None:
+                request_local_path()
 
     else:
         print("Reading credentials from .bigstore configuration file.")
@@ -570,12 +2214,14 @@ def init():
             # Occurs when notes already exist for this ref.
             print("Bigstore has already been initialized.")
 
-    g().config("filter.bigstore.clean", "git-bigstore filter-clean")
-    g().config("filter.bigstore.smudge", "git-bigstore filter-smudge")
-    g().config("filter.bigstore-compress.clean", "git-bigstore filter-clean")
-    g().config("filter.bigstore-compress.smudge", "git-bigstore filter-smudge")
+    for filter_name in filter_names():
+        repository_config.set("filter.{}.clean".format(filter_name), "git-bigstore filter-clean")
+        repository_config.set("filter.{}.smudge".format(filter_name), "git-bigstore filter-smudge")
+        # Git versions that understand long-running filters use this instead of
+        # starting the clean / smudge commands above once per file.
+        repository_config.set("filter.{}.process".format(filter_name), "git-bigstore filter-process")
 
-    mkdir_p(object_directory(default_hash_function_name))
+    mkdir_p(object_directory(default_hash_function_name()))
 
 
 def assert_initialized():
@@ -583,13 +2229,9 @@ def assert_initialized():
     Check to make sure `git bigstore init` has been called.
     If not, then print an error and exit(1)
     """
-    try:
-        if g().config('filter.bigstore.clean') == 'git-bigstore filter-clean':
-            return  # repo config looks good
-    except git.exc.GitCommandError:
-        # `git config` can throw errors if the key is missing
-        pass
-    if os.path.exists(os.path.join(toplevel_dir, '.git')):
+    if repository_config.get('filter.bigstore.clean') == 'git-bigstore filter-clean':
+        return  # repo config looks good
+    if os.path.exists(os.path.join(toplevel_directory(), '.git')):
         sys.stderr.write('fatal: You must run `git bigstore init` first.\n')
     else:
         sys.stderr.write('fatal: Not a git repository.\n')
@@ -0,0 +1,184 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Access tracking for the local object store, so that it can be pruned least
+recently used first.
+
+Filters only append a line to the access log, which is cheap enough to do for
+every file git cleans or smudges. The log is folded into the cache index
+whenever the store's size is checked, so neither needs a walk over the
+objects.
+"""
+
+from builtins import object
+import binascii
+import os
+import pickle
+import tempfile
+import time
+
+from .compat import replace
+
+# Bump whenever the pickled layout of the cache index changes.
+index_version = 1
+
+
+def record_access(log_filename, hash_function_name, hexdigest, size):
+    """ Append an access to an object to the access log. """
+    line = "{:.0f}\t{}\t{}\t{}\n".format(time.time(), hash_function_name, hexdigest, size)
+    # A single short append is atomic, so concurrent filters don't interleave.
+    with open(log_filename, 'a') as file:
+        file.write(line)
+
+
+class CacheIndex(object):
+    """
+    Size and last access time of every object in the local object store.
+
+    Digests are kept as bytes, keyed by hash function, which keeps the index
+    at well under 100 bytes per object.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # hash function name -> {digest: (last access, size)}
+        self.objects = {}
+        # Whether the object directories have been listed at least once, so
+        # that objects stored before access tracking existed are known.
+        self.scanned = False
+        self.changed = False
+
+    @classmethod
+    def load(cls, filename):
+        index = cls(filename)
+        try:
+            with open(filename, 'rb') as file:
+                version, objects, scanned = pickle.load(file)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return index
+
+        if version == index_version:
+            index.objects = objects
+            index.scanned = scanned
+        return index
+
+    def save(self):
+        if not self.changed or not self.filename:
+            return
+
+        directory = os.path.dirname(self.filename)
+        try:
+            fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".cache-index-")
+        except (IOError, OSError):
+            return
+
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((index_version, self.objects, self.scanned), file, protocol=2)
+        replace(temporary_filename, self.filename)
+        self.changed = False
+
+    def touch(self, hash_function_name, hexdigest, accessed, size):
+        objects = self.objects.setdefault(hash_function_name, {})
+        digest = binascii.unhexlify(hexdigest)
+        previous = objects.get(digest)
+        if previous is None or previous[0] < accessed or previous[1] != size:
+            objects[digest] = (max(accessed, previous[0] if previous else 0), size)
+            self.changed = True
+
+    def remove(self, hash_function_name, hexdigest):
+        if self.objects.get(hash_function_name, {}).pop(binascii.unhexlify(hexdigest), None) is not None:
+            self.changed = True
+
+    def replay(self, log_filename):
+        """ Fold the access log into the index and start a new log. """
+        replaying_filename = log_filename + ".replaying"
+        try:
+            replace(log_filename, replaying_filename)
+        except OSError:
+            # Nothing has been logged since the last replay.
+            return
+
+        with open(replaying_filename) as file:
+            for line in file:
+                fields = line.rstrip("\n").split("\t")
+                # A filter may have been killed half way through a line.
+                if len(fields) != 4:
+                    continue
+                accessed, hash_function_name, hexdigest, size = fields
+                try:
+                    self.touch(hash_function_name, hexdigest, int(accessed), int(size))
+                except (TypeError, ValueError):
+                    continue
+        os.unlink(replaying_filename)
+
+    def scan(self, objects_directory):
+        """
+        Reconcile the index with the object directories: forget objects that
+        are gone, and add the ones it doesn't know about, taking their
+        modification time as their last access. Only the new objects are
+        stat()ed.
+        """
+        try:
+            hash_function_names = os.listdir(objects_directory)
+        except OSError:
+            hash_function_names = []
+
+        for hash_function_name in list(self.objects):
+            if hash_function_name not in hash_function_names:
+                del self.objects[hash_function_name]
+                self.changed = True
+
+        for hash_function_name in hash_function_names:
+            directory = os.path.join(objects_directory, hash_function_name)
+            known = self.objects.get(hash_function_name, {})
+            found = set()
+            for prefix in sorted(os.listdir(directory)):
+                if len(prefix) != 2 or not os.path.isdir(os.path.join(directory, prefix)):
+                    continue
+                for name in os.listdir(os.path.join(directory, prefix)):
+                    if name.startswith("."):
+                        continue
+                    hexdigest = prefix + name
+                    try:
+                        digest = binascii.unhexlify(hexdigest)
+                    except (TypeError, ValueError):
+                        continue
+                    found.add(digest)
+                    if digest not in known:
+                        try:
+                            status = os.stat(os.path.join(directory, prefix, name))
+                        except OSError:
+                            continue
+                        self.touch(hash_function_name, hexdigest, int(status.st_mtime), status.st_size)
+
+            for digest in set(known) - found:
+                del known[digest]
+                self.changed = True
+
+        if not self.scanned:
+            self.scanned = True
+            self.changed = True
+
+    def total_size(self):
+        return sum(size for objects in self.objects.values() for _, size in objects.values())
+
+    def least_recently_used(self):
+        """ :return: list of (last access, hash function name, hexdigest, size), oldest first """
+        entries = []
+        for hash_function_name, objects in self.objects.items():
+            for digest, (accessed, size) in objects.items():
+                entries.append((accessed, hash_function_name, binascii.hexlify(digest).decode('ascii'), size))
+        entries.sort()
+        return entries
@@ -0,0 +1,133 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import subprocess
+
+# "bigstore\n" + hash function name + "\n" + hex digest + "\n". Even sha512 is
+# well under this, so anything larger can't be a pointer.
+pointer_max_size = 256
+
+
+def parse_pointer(data):
+    """
+    Parse the contents of a bigstore pointer blob.
+
+    :param data: blob contents
+    :return: (hash_function_name, hexdigest), or None if `data` isn't a pointer
+    """
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+
+    if len(lines) != 3 or lines[0] != b"bigstore":
+        return None
+
+    return lines[1].decode('ascii'), lines[2].decode('ascii')
+
+
+class CatFile(object):
+    """
+    A pair of `git cat-file --batch-check` / `git cat-file --batch` processes
+    kept open for the length of a command, so that reading many objects doesn't
+    start a git process per object. Object sizes are checked through
+    --batch-check first, so large blobs are never read just to be thrown away.
+
+    Usage:
+
+        with CatFile() as catfile:
+            pointer = catfile.pointer(sha)
+    """
+
+    def __init__(self):
+        self.check_process = None
+        self.batch_process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for process in (self.check_process, self.batch_process):
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+                process.stdout.close()
+
+        self.check_process = None
+        self.batch_process = None
+
+    @staticmethod
+    def start(option):
+        return subprocess.Popen(("git", "cat-file", option), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @staticmethod
+    def request(process, sha):
+        process.stdin.write("{}\n".format(sha).encode('ascii'))
+        process.stdin.flush()
+        header = process.stdout.readline().decode('ascii').split()
+        if len(header) != 3:
+            # "<sha> missing"
+            return None
+        return header
+
+    def info(self, sha):
+        """
+        :return: (type, size) of the object, or None if it doesn't exist
+        """
+        if self.check_process is None:
+            self.check_process = self.start("--batch-check")
+
+        header = self.request(self.check_process, sha)
+        if header is None:
+            return None
+        return header[1], int(header[2])
+
+    def read(self, sha):
+        """
+        :return: the object's contents, or None if it doesn't exist
+        """
+        if self.batch_process is None:
+            self.batch_process = self.start("--batch")
+
+        header = self.request(self.batch_process, sha)
+        if header is None:
+            return None
+
+        size = int(header[2])
+        data = self.batch_process.stdout.read(size)
+        # Every object is followed by a newline.
+        self.batch_process.stdout.read(1)
+        return data
+
+    def pointer(self, sha):
+        """
+        Read a bigstore pointer blob.
+
+        :return: (hash_function_name, hexdigest), or None if `sha` isn't a pointer
+        """
+        info = self.info(sha)
+        if info is None:
+            return None
+
+        object_type, size = info
+        if object_type != "blob" or size > pointer_max_size:
+            return None
+
+        data = self.read(sha)
+        if data is None:
+            return None
+        return parse_pointer(data)
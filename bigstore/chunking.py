@@ -0,0 +1,237 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-defined chunking for the `bigstore-chunked` filter.
+
+Files tracked with `filter=bigstore-chunked` are split into chunks with
+FastCDC when they're pushed. Every chunk is stored on the backend as an object
+of its own, keyed by its sha256, alongside a manifest listing the chunks in
+order. Since chunk boundaries depend on the content around them rather than on
+offsets, an edit only changes the chunks it touches, and only those have to be
+uploaded, stored, or downloaded again.
+
+The chunker's parameters and gear table are part of the format: changing them
+moves every boundary, so unchanged content would no longer deduplicate.
+
+Boundaries are found by the `_cdc` extension when it was built, which is
+about a hundred times faster than the pure-Python scan and releases the GIL.
+Both find exactly the same boundaries.
+"""
+
+from builtins import object
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+
+from .compat import replace
+
+try:
+    from . import _cdc
+except ImportError:
+    _cdc = None
+
+chunked_filter_name = 'bigstore-chunked'
+
+chunk_hash_function_name = 'sha256'
+
+min_size = 256 * 1024
+average_size = 1024 * 1024
+max_size = 4 * 1024 * 1024
+
+# Normalized chunking: cut points are harder to find before the average size
+# and easier after it, which keeps chunk sizes close to the average. The masks
+# use the top bits of the fingerprint, which depend on the most input.
+mask_small = ((1 << 22) - 1) << (64 - 22)
+mask_large = ((1 << 18) - 1) << (64 - 18)
+fingerprint_mask = (1 << 64) - 1
+
+# 256 pseudo-random 64-bit values, derived from a fixed seed so that every
+# client finds the same boundaries.
+gear = [int(hashlib.sha256("bigstore-gear-{}".format(i).encode('ascii')).hexdigest()[:16], 16)
+        for i in range(256)]
+packed_gear = struct.pack("<256Q", *gear)
+
+manifest_header = b"bigstore-manifest\n"
+
+# Bump whenever the pickled layout of the chunk index changes.
+index_version = 1
+
+
+def cut_point(data, start, end):
+    """
+    Find where the chunk starting at `start` ends.
+
+    :param data: bytearray holding at least `max_size` bytes from `start`,
+                 unless the input ends before then
+    :param end: end of the input available in `data`
+    :return: length of the chunk
+    """
+    if _cdc is not None:
+        return _cdc.cut_point(data, start, end, packed_gear, min_size, average_size, max_size, mask_small,
+                              mask_large)
+    return python_cut_point(data, start, end)
+
+
+def python_cut_point(data, start, end):
+    """ cut_point() in pure Python, for when the `_cdc` extension isn't built. """
+    length = end - start
+    if length <= min_size:
+        return length
+
+    normal = start + min(average_size, length)
+    limit = start + min(max_size, length)
+    fingerprint = 0
+
+    position = start + min_size
+    for byte in data[position:normal]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & fingerprint_mask
+        position += 1
+        if not fingerprint & mask_small:
+            return position - start
+
+    for byte in data[position:limit]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & fingerprint_mask
+        position += 1
+        if not fingerprint & mask_large:
+            return position - start
+
+    return limit - start
+
+
+def chunks(file):
+    """ Generator that splits the rest of `file` into content-defined chunks. """
+    buffer = bytearray()
+    finished = False
+    while True:
+        while not finished and len(buffer) < max_size:
+            data = file.read(max_size)
+            if not data:
+                finished = True
+            buffer.extend(data)
+
+        if not buffer:
+            return
+
+        length = cut_point(buffer, 0, len(buffer))
+        yield bytes(buffer[:length])
+        del buffer[:length]
+
+
+def chunked_action(manifest_hexdigest):
+    """ Note action for an object uploaded as chunks, listed in the given manifest. """
+    return 'upload-chunked:{}'.format(manifest_hexdigest)
+
+
+def manifest_for_action(action):
+    """
+    :return: hexdigest of the manifest for an "upload-chunked" note action, or
+             None if the action isn't one
+    """
+    if action.startswith('upload-chunked:'):
+        return action[len('upload-chunked:'):]
+
+
+def chunk_hexdigest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def format_manifest(entries):
+    """
+    :param entries: list of (chunk hexdigest, length), in order
+    :return: manifest contents
+    """
+    lines = [manifest_header, "{}\n".format(chunk_hash_function_name).encode('ascii')]
+    for hexdigest, length in entries:
+        lines.append("{} {}\n".format(hexdigest, length).encode('ascii'))
+    return b"".join(lines)
+
+
+def parse_manifest(data):
+    """
+    :return: list of (chunk hexdigest, length), in order
+    :raise ValueError: if `data` isn't a manifest this version understands
+    """
+    if not data.startswith(manifest_header):
+        raise ValueError("not a bigstore manifest")
+
+    lines = data[len(manifest_header):].decode('ascii').split("\n")
+    if lines[0] != chunk_hash_function_name:
+        raise ValueError("unsupported chunk hash function {!r}".format(lines[0]))
+
+    entries = []
+    for line in lines[1:]:
+        if line:
+            hexdigest, length = line.split(" ")
+            entries.append((hexdigest, int(length)))
+    return entries
+
+
+class ChunkIndex(object):
+    """
+    Where chunks can be found in the local object store, so that pulling a new
+    version of a chunked file only downloads the chunks that no local object
+    already contains.
+
+    Entries are only hints: objects can be removed, so a chunk is checked
+    against its digest whenever it's read.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # chunk hexdigest -> (hash function name, object hexdigest, offset)
+        self.chunks = {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, filename):
+        index = cls(filename)
+        try:
+            with open(filename, 'rb') as file:
+                version, chunks = pickle.load(file)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return index
+
+        if version == index_version:
+            index.chunks = chunks
+        return index
+
+    def save(self):
+        if not self.changed or not self.filename:
+            return
+
+        directory = os.path.dirname(self.filename)
+        try:
+            fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".chunk-index-")
+        except (IOError, OSError):
+            return
+
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((index_version, self.chunks), file, protocol=2)
+        replace(temporary_filename, self.filename)
+        self.changed = False
+
+    def add(self, hash_function_name, hexdigest, entries):
+        """ Record the chunks that make up an object, as listed in its manifest. """
+        offset = 0
+        for chunk, length in entries:
+            self.chunks[chunk] = (hash_function_name, hexdigest, offset)
+            offset += length
+        self.changed = True
+
+    def locate(self, chunk):
+        """ :return: (hash function name, object hexdigest, offset), or None """
+        return self.chunks.get(chunk)
@@ -0,0 +1,73 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stand-ins for the os functions that Python 2 (or, for pread and pwrite,
+Windows) doesn't have.
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+
+if hasattr(os, 'replace'):
+    replace = os.replace
+elif sys.platform == 'win32':
+    def replace(source, destination):
+        """ os.replace(), except that there's a moment when `destination` is missing. """
+        try:
+            os.remove(destination)
+        except OSError:
+            pass
+        os.rename(source, destination)
+else:
+    # rename() already replaces the destination atomically on POSIX.
+    replace = os.rename
+
+if hasattr(os, 'fsdecode'):
+    fsdecode = os.fsdecode
+else:
+    def fsdecode(filename):
+        # Python 2's native strings are bytes, which os takes as they are.
+        return filename
+
+
+def cpu_count():
+    """ :return: the number of CPUs, or None if it can't be told """
+    if hasattr(os, 'cpu_count'):
+        return os.cpu_count()
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+    pwrite = os.pwrite
+else:
+    # Without them, threads share the file's offset, so seeking and reading or
+    # writing have to happen together.
+    offset_lock = threading.Lock()
+
+    def pread(fd, length, offset):
+        with offset_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def pwrite(fd, data, offset):
+        with offset_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
@@ -0,0 +1,538 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compression codecs for the `bigstore-compress` family of filters.
+
+A file tracked with `filter=bigstore-compress-<codec>` is compressed with that
+codec before it is uploaded, and the codec is recorded in its upload note so
+that `pull` knows how to decompress it. Plain `bigstore-compress` means bz2,
+as it always has.
+"""
+
+from builtins import object
+import bz2
+import collections
+import re
+import threading
+import zlib
+
+from .chunking import chunked_filter_name, manifest_for_action
+from .packing import location_for_action
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Optional, faster codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Every codec a filter can name, whether or not its library is installed here.
+codec_names = ('bz2', 'zlib', 'lzma', 'zstd', 'lz4')
+
+default_codec_name = 'bz2'
+
+filter_regex = re.compile(r'^bigstore-compress(?:-([a-z0-9]+))?$')
+
+# Size of the blocks that file contents are streamed through.
+block_size = 1024 * 1024
+
+# Size of the independently compressed blocks when compressing in parallel.
+# Each becomes its own stream in the output, so bigger blocks compress a little
+# better and smaller ones spread across more cores.
+parallel_block_size = 4 * 1024 * 1024
+
+# When decompressing in parallel, a stream this large with no further stream
+# header in sight is decompressed serially instead of being held in memory.
+max_segment_size = 64 * 1024 * 1024
+
+
+class CodecUnavailable(Exception):
+    pass
+
+
+class Codec(object):
+    name = None
+    default_level = None
+    levels = ()
+    # Regex for the bytes that start a stream. Codecs with a distinctive header
+    # can have multi-stream objects split up and decompressed in parallel.
+    stream_magic = None
+
+    def compressor(self, level=None):
+        """ :return: an object with compress(data) and flush() """
+        raise NotImplementedError
+
+    def decompressor(self):
+        """ :return: an object with decompress(data), eof and unused_data """
+        raise NotImplementedError
+
+
+class EndOfStream(object):
+    """
+    Python 2's bz2 and zlib decompressors don't have `eof`, so this works it out
+    after each call with `probe(decompressor)`, which offers the decompressor
+    more input and returns (any output that produced, whether it had finished).
+    """
+
+    def __init__(self, decompressor, probe):
+        self.decompressor = decompressor
+        self.probe = probe
+        self.eof = False
+
+    def decompress(self, data):
+        output = self.decompressor.decompress(data)
+        if self.decompressor.unused_data:
+            self.eof = True
+            return output
+        more, self.eof = self.probe(self.decompressor)
+        return output + more
+
+    @property
+    def unused_data(self):
+        return self.decompressor.unused_data
+
+
+def probe_bz2(decompressor):
+    # Only a finished decompressor refuses more input.
+    try:
+        return decompressor.decompress(b""), False
+    except EOFError:
+        return b"", True
+
+
+def probe_zlib(decompressor):
+    # A finished decompressor leaves anything it's given in unused_data.
+    probe = decompressor.copy()
+    try:
+        probe.decompress(b"\x00")
+    except zlib.error:
+        return b"", False
+    return b"", bool(probe.unused_data)
+
+
+class BZ2Codec(Codec):
+    name = 'bz2'
+    default_level = 9
+    levels = range(1, 10)
+    # "BZh" + block size, then the first block's magic (BCD pi)
+    stream_magic = re.compile(b"BZh[1-9]\x31\x41\x59\x26\x53\x59")
+
+    def compressor(self, level=None):
+        return bz2.BZ2Compressor(level or self.default_level)
+
+    def decompressor(self):
+        decompressor = bz2.BZ2Decompressor()
+        return decompressor if hasattr(decompressor, 'eof') else EndOfStream(decompressor, probe_bz2)
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    default_level = 6
+    levels = range(0, 10)
+
+    def compressor(self, level=None):
+        return zlib.compressobj(self.default_level if level is None else level)
+
+    def decompressor(self):
+        decompressor = zlib.decompressobj()
+        return decompressor if hasattr(decompressor, 'eof') else EndOfStream(decompressor, probe_zlib)
+
+
+class LZMACodec(Codec):
+    name = 'lzma'
+    default_level = 6
+    levels = range(0, 10)
+    stream_magic = re.compile(b"\xfd7zXZ\x00")
+
+    def compressor(self, level=None):
+        return lzma.LZMACompressor(preset=self.default_level if level is None else level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    default_level = 3
+    levels = range(1, 23)
+
+    def compressor(self, level=None):
+        return zstandard.ZstdCompressor(level=level or self.default_level).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class LZ4Compressor(object):
+    """ Give lz4's frame compressor the same compress() / flush() shape as the rest. """
+
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.started = False
+
+    def compress(self, data):
+        header = b""
+        if not self.started:
+            self.started = True
+            header = self.compressor.begin()
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header = b""
+        if not self.started:
+            self.started = True
+            header = self.compressor.begin()
+        return header + self.compressor.flush()
+
+
+class LZ4Codec(Codec):
+    name = 'lz4'
+    default_level = 0
+    levels = range(0, 17)
+
+    def compressor(self, level=None):
+        return LZ4Compressor(self.default_level if level is None else level)
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+codecs = {}
+
+
+def register(codec):
+    codecs[codec.name] = codec
+
+
+register(BZ2Codec())
+register(ZlibCodec())
+if lzma is not None:
+    register(LZMACodec())
+if zstandard is not None:
+    register(ZstdCodec())
+if lz4 is not None:
+    register(LZ4Codec())
+
+
+def get_codec(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise CodecUnavailable("the {} codec isn't available; is its Python package installed?".format(name))
+
+
+def codec_for_filter(value):
+    """
+    :param value: value of a file's `filter` attribute
+    :return: name of the codec the filter compresses with, or None if it doesn't
+    """
+    match = filter_regex.match(value)
+    if match:
+        return match.group(1) or default_codec_name
+
+
+def filter_names():
+    """ :return: every bigstore filter name that `git bigstore init` configures """
+    return (['bigstore', 'bigstore-compress'] + ['bigstore-compress-{}'.format(name) for name in codec_names] +
+            [chunked_filter_name])
+
+
+def compressed_action(codec_name, streams=1):
+    """
+    Note action for an object uploaded with `codec_name`. Single-stream bz2
+    objects keep the plain "upload-compressed" action that older versions
+    understand. Anything else is spelled out so that older versions skip the
+    entry rather than feed it to the wrong decompressor, or to one that stops at
+    the end of the first stream.
+
+    :param streams: number of compressed streams the object is made of, or None
+                    if that isn't known (e.g. it was uploaded by someone else)
+    """
+    if codec_name == default_codec_name and streams == 1:
+        return 'upload-compressed'
+    return 'upload-compressed:{}'.format(codec_name)
+
+
+def codec_for_action(action):
+    """
+    :return: codec name for an "upload-compressed" note action, or None if the
+             action isn't one
+    """
+    if action == 'upload-compressed':
+        return default_codec_name
+    if action.startswith('upload-compressed:'):
+        return action[len('upload-compressed:'):]
+
+
+def is_upload_action(action):
+    return (action == 'upload' or codec_for_action(action) is not None or manifest_for_action(action) is not None or
+            location_for_action(action) is not None)
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def parallel_available():
+    """
+    True if blocks can be compressed on a thread pool. concurrent.futures is
+    only looked for here, and imported when it's needed, since it's slow to
+    load and most filter invocations never use it.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2, where it comes from the futures backport, if at all.
+        import imp
+        try:
+            imp.find_module('futures', [imp.find_module('concurrent')[1]])
+        except ImportError:
+            return False
+        return True
+    return find_spec("concurrent.futures") is not None
+
+
+def shared_executor(threads):
+    """
+    Thread pool shared by every compression job in the process, so that several
+    concurrent transfers don't each start a pool the size of the machine. The
+    codecs release the GIL while they work, so threads are enough.
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=threads)
+        return executor
+
+
+def compress_block(codec, level, data):
+    compressor = codec.compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_file(codec, source, destination, level=None, threads=1):
+    """
+    Compress everything left in `source` into `destination`.
+
+    With more than one thread, the input is split into blocks which are
+    compressed independently and written out in order as a multi-stream object
+    (in the same way as pbzip2 does for bz2).
+
+    :return: number of compressed streams written
+    """
+    if threads <= 1 or not parallel_available():
+        compressor = codec.compressor(level)
+        while True:
+            data = source.read(block_size)
+            if not data:
+                break
+            destination.write(compressor.compress(data))
+        destination.write(compressor.flush())
+        return 1
+
+    pool = shared_executor(threads)
+    in_flight = collections.deque()
+    streams = 0
+    while True:
+        data = source.read(parallel_block_size)
+        if data:
+            in_flight.append(pool.submit(compress_block, codec, level, data))
+
+        # Keep a couple of blocks per thread in flight to bound memory.
+        while in_flight and (not data or len(in_flight) > threads * 2):
+            destination.write(in_flight.popleft().result())
+            streams += 1
+
+        if not data:
+            break
+
+    if streams == 0:
+        destination.write(compress_block(codec, level, b""))
+        streams = 1
+    return streams
+
+
+class MultiStreamDecompressor(object):
+    """
+    Decompress any number of concatenated streams, where the codec's own
+    decompressor stops at the end of the first one.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.decompressor = codec.decompressor()
+        self.in_stream = False
+
+    def decompress(self, data):
+        output = []
+        while data:
+            self.in_stream = True
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+
+            data = self.decompressor.unused_data
+            self.decompressor = self.codec.decompressor()
+            self.in_stream = False
+        return b"".join(output)
+
+    def flush(self):
+        if self.in_stream:
+            raise ValueError("compressed data ended before the end of a stream")
+        return b""
+
+    @property
+    def complete(self):
+        """ True if the input so far ended exactly at the end of a stream. """
+        return not self.in_stream
+
+
+def decompress_segment(codec, data):
+    """
+    Decompress a run of whole streams.
+
+    :return: (output, ok) where ok is False if `data` turned out not to be made
+             of whole streams
+    """
+    decompressor = MultiStreamDecompressor(codec)
+    try:
+        output = decompressor.decompress(data)
+    except Exception:
+        return b"", False
+    return output, decompressor.complete
+
+
+class ParallelDecompressor(object):
+    """
+    Decompress a multi-stream object on several threads. Input is split
+    wherever a stream header appears, each piece is decompressed on the shared
+    pool, and output is handed back in order.
+
+    A stream header can turn up by chance inside compressed data. Pieces that
+    don't decompress as whole streams are merged with the pieces after them
+    until they do, so a false split costs time but never correctness.
+    """
+
+    def __init__(self, codec, threads):
+        self.codec = codec
+        self.threads = threads
+        self.pool = shared_executor(threads)
+        self.buffer = bytearray()
+        self.search_from = 1
+        self.in_flight = collections.deque()
+        self.carry = None
+        self.serial = None
+
+    def decompress(self, data):
+        if self.serial:
+            return self.serial.decompress(data)
+
+        self.buffer.extend(data)
+        while True:
+            match = self.codec.stream_magic.search(self.buffer, self.search_from)
+            if not match:
+                break
+            self.submit(bytes(self.buffer[:match.start()]))
+            del self.buffer[:match.start()]
+            self.search_from = 1
+
+        # Headers can straddle the end of the buffer, so back up a little.
+        self.search_from = max(1, len(self.buffer) - 16)
+
+        if len(self.buffer) > max_segment_size:
+            # Probably a single large stream (e.g. compressed by an older
+            # version), so stop buffering and decompress the rest as it comes.
+            output = self.drain(block=True)
+            self.serial = MultiStreamDecompressor(self.codec)
+            output.append(self.serial.decompress(bytes((self.carry or b"") + self.buffer)))
+            self.carry = None
+            self.buffer = bytearray()
+            return b"".join(output)
+
+        return b"".join(self.drain(block=False))
+
+    def flush(self):
+        if self.serial:
+            return self.serial.flush()
+
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        output = self.drain(block=True)
+        if self.carry is not None:
+            # Whatever is left doesn't end on a stream boundary; decompress it
+            # serially so that errors surface the way they would otherwise.
+            serial = MultiStreamDecompressor(self.codec)
+            output.append(serial.decompress(self.carry))
+            output.append(serial.flush())
+            self.carry = None
+        return b"".join(output)
+
+    def submit(self, segment):
+        self.in_flight.append((segment, self.pool.submit(decompress_segment, self.codec, segment)))
+
+    def drain(self, block):
+        output = []
+        while self.in_flight:
+            segment, future = self.in_flight[0]
+            if not (block or future.done() or len(self.in_flight) > self.threads * 2):
+                break
+
+            self.in_flight.popleft()
+            data, ok = future.result()
+            if self.carry is None and ok:
+                output.append(data)
+            else:
+                self.carry = (self.carry or b"") + segment
+                data, ok = decompress_segment(self.codec, self.carry)
+                if ok:
+                    output.append(data)
+                    self.carry = None
+        return output
+
+
+def make_decompressor(codec, threads=1):
+    """
+    :return: an incremental decompressor, with decompress(data) and flush(), that
+             handles objects made of several concatenated streams
+    """
+    if threads > 1 and codec.stream_magic is not None and parallel_available():
+        return ParallelDecompressor(codec, threads)
+    return MultiStreamDecompressor(codec)
+
+
+def decompress_file(codec, source, destination, threads=1):
+    """
+    Decompress everything left in `source` into `destination`, including objects
+    made of several concatenated streams.
+    """
+    decompressor = make_decompressor(codec, threads)
+    while True:
+        data = source.read(block_size)
+        if not data:
+            break
+        destination.write(decompressor.decompress(data))
+    destination.write(decompressor.flush())
@@ -0,0 +1,73 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import subprocess
+
+
+def normalize(name):
+    """
+    Spell a config variable the way `git config --list` does: the section and
+    the variable name are case-insensitive, the subsection isn't.
+    """
+    section, _, rest = name.partition(".")
+    subsection, _, key = rest.rpartition(".")
+    if subsection:
+        return "{}.{}.{}".format(section.lower(), subsection, key.lower())
+    return "{}.{}".format(section.lower(), key.lower())
+
+
+class GitConfig(object):
+    """
+    A snapshot of git config, read with a single `git config --list -z` the
+    first time a value is needed rather than a `git config` process per value.
+
+    Usage:
+
+        repository_config = GitConfig()
+        bigstore_config = GitConfig("--file", ".bigstore")
+        bucket = bigstore_config.get("bigstore.s3.bucket")
+    """
+
+    def __init__(self, *options):
+        self.options = options
+        self.values = None
+
+    def load(self):
+        process = subprocess.Popen(("git", "config") + self.options + ("--list", "-z"),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = process.communicate()
+
+        values = {}
+        if process.returncode == 0:
+            for record in output.split(b"\0"):
+                if not record:
+                    continue
+                name, _, value = record.partition(b"\n")
+                # Like `git config <name>`, the last value wins.
+                values[name.decode('utf-8')] = value.decode('utf-8')
+        self.values = values
+
+    def get(self, name, default=None):
+        """
+        :return: the value of `name` as a str, or `default` if it isn't set
+        """
+        if self.values is None:
+            self.load()
+        return self.values.get(normalize(name), default)
+
+    def set(self, name, value):
+        subprocess.check_call(("git", "config") + self.options + (name, value))
+        if self.values is not None:
+            self.values[normalize(name)] = value
@@ -0,0 +1,383 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Git's long-running filter protocol (see "Long Running Filter Process" in
+gitattributes(5)). Git starts `git-bigstore filter-process` once and streams
+every file through it, instead of starting a new interpreter per file.
+
+With `bigstore.smudge.fetch` set, files whose objects aren't available locally
+are delayed during a checkout: their objects are downloaded in the background,
+several at a time, and git collects the files once they've arrived.
+"""
+
+from builtins import object
+import io
+import sys
+import tempfile
+
+from .bigstore import (backend_for_name, fetch_object, filter_clean, filter_smudge, find_object, load_chunk_index,
+                       object_source, pointer_blob_sha, reserve_jobs, smudge_fetch_enabled, smudge_fetch_jobs)
+from .catfile import parse_pointer, pointer_max_size
+from .transfer import TransferPool
+
+# Use a bytes mode stdin/stdout for both Python 2 and 3.
+if sys.version_info >= (3,):
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+else:
+    stdin = sys.stdin
+    stdout = sys.stdout
+
+MAX_PACKET_DATA = 65516
+
+# Content up to this size is kept in memory while a smudge request is read in.
+SPOOL_SIZE = 1024 * 1024
+
+capabilities = ('clean', 'smudge', 'delay')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def read_packet(stream):
+    """
+    Read one pkt-line.
+
+    :return: the packet's payload, or None for a flush packet
+    """
+    header = stream.read(4)
+    if len(header) != 4:
+        raise EOFError()
+
+    length = int(header, 16)
+    if length == 0:
+        return None
+    if length < 4:
+        raise ProtocolError("invalid packet length {!r}".format(header))
+
+    data = stream.read(length - 4)
+    if len(data) != length - 4:
+        raise EOFError()
+    return data
+
+
+def read_text_packets(stream):
+    """ Read text pkt-lines up to the next flush packet. """
+    lines = []
+    while True:
+        packet = read_packet(stream)
+        if packet is None:
+            return lines
+        lines.append(packet.decode('utf-8').rstrip('\n'))
+
+
+def write_packet(stream, data):
+    stream.write("{:04x}".format(len(data) + 4).encode('ascii'))
+    stream.write(data)
+
+
+def write_text_packet(stream, line):
+    write_packet(stream, "{}\n".format(line).encode('utf-8'))
+
+
+def write_flush(stream):
+    stream.write(b"0000")
+
+
+class PacketReader(io.RawIOBase):
+    """ File-like view of pkt-line content, up to the next flush packet. """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.finished:
+            packet = read_packet(self.stream)
+            if packet is None:
+                self.finished = True
+            else:
+                self.buffer = packet
+
+        count = min(len(b), len(self.buffer))
+        b[:count] = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return count
+
+    def drain(self):
+        """ Discard any content the filter didn't read. """
+        while not self.finished:
+            self.readinto(bytearray(MAX_PACKET_DATA))
+
+
+class PacketWriter(object):
+    """
+    File-like writer that sends content as pkt-lines. The "status=success"
+    header is sent right before the first packet of content, so a filter that
+    fails before producing any output can still report a clean error.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = bytearray()
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            write_text_packet(self.stream, "status=success")
+            write_flush(self.stream)
+
+    def write(self, b):
+        self.buffer.extend(b)
+        while len(self.buffer) >= MAX_PACKET_DATA:
+            self.start()
+            write_packet(self.stream, bytes(self.buffer[:MAX_PACKET_DATA]))
+            del self.buffer[:MAX_PACKET_DATA]
+        return len(b)
+
+    def flush(self):
+        self.start()
+        if self.buffer:
+            write_packet(self.stream, bytes(self.buffer))
+            del self.buffer[:]
+
+
+class Prefetcher(object):
+    """
+    Fetches the objects for delayed smudge requests on a TransferPool, while
+    git carries on checking out the files it doesn't have to wait for.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        reserve_jobs(jobs)
+        self.pool = None
+        self.locate = None
+        # pathname -> pointer, for files git will ask for again
+        self.delayed = {}
+        # pathnames fetched (or given up on) since git last asked
+        self.available = []
+        # names of backends that couldn't be set up, reported once each
+        self.unavailable = set()
+
+    def delay(self, pathname, pointer, blob=None):
+        """ Start fetching the object behind `pointer` for `pathname`. """
+        if self.pool is None:
+            self.locate = load_chunk_index().locate
+            self.pool = TransferPool(self.jobs, self.backend)
+            self.pool.__enter__()
+
+        hash_function_name, hexdigest = parse_pointer(pointer)
+        backend_name, action = object_source(blob or pointer_blob_sha(pointer))
+        self.delayed[pathname] = pointer
+        # A file whose object couldn't be fetched is still handed back, so
+        # that git checks out its pointer rather than failing.
+        self.pool.submit(lambda _: self.available.append(pathname), backend_name, self.fetch,
+                         hash_function_name, hexdigest, action, pathname, self.locate)
+
+    def backend(self, name):
+        """
+        Backend factory for the pool. A backend that can't be set up (a missing
+        library, bad configuration) is reported rather than raised, since an
+        exception from a worker would end the filter, and the checkout with it.
+        """
+        try:
+            backend = backend_for_name(name)
+            error = "isn't configured"
+        except Exception as e:
+            backend = None
+            error = "couldn't be set up: {}".format(e)
+        if backend is None and name not in self.unavailable:
+            self.unavailable.add(name)
+            sys.stderr.write("bigstore: backend {} {}\n".format(name, error))
+        return backend
+
+    @staticmethod
+    def fetch(backend, hash_function_name, hexdigest, action, pathname, locate):
+        """ Transfer task. :return: True if the object was fetched """
+        if backend is None:
+            return False
+        try:
+            return fetch_object(backend, hash_function_name, hexdigest, action, pathname, locate)
+        except Exception as e:
+            sys.stderr.write("bigstore: couldn't fetch {}: {}\n".format(pathname, e))
+            return False
+
+    def take(self, pathname):
+        """ :return: the pointer of a delayed file, or None if it wasn't delayed """
+        return self.delayed.pop(pathname, None)
+
+    def wait(self):
+        """
+        :return: pathnames that became available since the last call, waiting
+                 for at least one unless nothing is left in flight
+        """
+        if self.pool is None:
+            return []
+
+        self.pool.collect(block=False)
+        while not self.available and self.pool.completed < self.pool.submitted:
+            self.pool.collect(block=True)
+        available, self.available = self.available, []
+        return available
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.__exit__(None, None, None)
+            self.pool = None
+
+
+class FilterProcess(object):
+    def __init__(self, input=None, output=None):
+        self.input = input or stdin
+        self.output = output or stdout
+        self.capabilities = set()
+        self.fetch = None
+        self.prefetcher = None
+
+    def handshake(self):
+        if read_text_packets(self.input) != ["git-filter-client", "version=2"]:
+            raise ProtocolError("unexpected filter client welcome")
+
+        write_text_packet(self.output, "git-filter-server")
+        write_text_packet(self.output, "version=2")
+        write_flush(self.output)
+
+        offered = set(line[len("capability="):] for line in read_text_packets(self.input)
+                      if line.startswith("capability="))
+        for capability in capabilities:
+            if capability in offered:
+                self.capabilities.add(capability)
+                write_text_packet(self.output, "capability={}".format(capability))
+        write_flush(self.output)
+        self.output.flush()
+
+    def run(self):
+        self.handshake()
+
+        try:
+            self.serve()
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+
+    def serve(self):
+        while True:
+            try:
+                headers = read_text_packets(self.input)
+            except EOFError:
+                # Git closes the pipe once it has nothing left to filter.
+                return
+
+            request = dict(header.split("=", 1) for header in headers)
+            command = request.get("command")
+            if command in ("clean", "smudge"):
+                self.filter(command, request)
+            elif command == "list_available_blobs":
+                self.list_available_blobs()
+            else:
+                raise ProtocolError("unsupported command {!r}".format(command))
+
+            self.output.flush()
+
+    def filter(self, command, request):
+        content = PacketReader(self.input)
+        output = PacketWriter(self.output)
+
+        try:
+            if command == "clean":
+                # Cleaning only produces a short pointer once all of its input
+                # has been hashed, so the content can be streamed straight in
+                # and the response held until git has finished sending.
+                pointer = io.BytesIO()
+                filter_clean(io.BufferedReader(content), pointer)
+                content.drain()
+                output.write(pointer.getvalue())
+            else:
+                # Git writes the whole blob before it reads a response, so the
+                # input has to be taken in completely before anything is sent
+                # back. Pointers are tiny; anything else spills to disk.
+                with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+                    data = content.read(MAX_PACKET_DATA)
+                    while data:
+                        spool.write(data)
+                        data = content.read(MAX_PACKET_DATA)
+                    spool.seek(0)
+
+                    pathname = request.get("pathname")
+                    pointer = self.prefetcher.take(pathname) if self.prefetcher else None
+                    if pointer is not None:
+                        # Git asks for a delayed file again without its
+                        # content; its object has been fetched, or couldn't be.
+                        filter_smudge(io.BytesIO(pointer), output, pathname, fetch=False)
+                    elif request.get("can-delay") == "1" and self.delay(pathname, spool, request.get("blob")):
+                        write_text_packet(self.output, "status=delayed")
+                        write_flush(self.output)
+                        return
+                    else:
+                        filter_smudge(spool, output, pathname, fetch=self.fetch)
+            output.flush()
+        except Exception as e:
+            content.drain()
+            sys.stderr.write("bigstore: {} failed for {}: {}\n".format(command, request.get("pathname"), e))
+            if output.started:
+                write_flush(self.output)
+            write_text_packet(self.output, "status=error")
+            write_flush(self.output)
+        else:
+            write_flush(self.output)
+            # An empty list keeps the "success" status sent before the content.
+            write_flush(self.output)
+
+    def delay(self, pathname, spool, blob):
+        """
+        Delay a smudge request whose object has to be fetched first.
+
+        :return: True if the request was delayed
+        """
+        if self.fetch is None:
+            self.fetch = smudge_fetch_enabled()
+        if not self.fetch:
+            return False
+
+        data = spool.read(pointer_max_size + 1)
+        spool.seek(0)
+        pointer = parse_pointer(data)
+        if not pointer or find_object(*pointer):
+            return False
+
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher(smudge_fetch_jobs())
+        self.prefetcher.delay(pathname, data, blob)
+        return True
+
+    def list_available_blobs(self):
+        # An empty list tells git that nothing else is coming.
+        prefetcher = self.prefetcher
+        for pathname in prefetcher.wait() if prefetcher else []:
+            write_text_packet(self.output, "pathname={}".format(pathname))
+        write_flush(self.output)
+        write_text_packet(self.output, "status=success")
+        write_flush(self.output)
+
+
+def filter_process():
+    FilterProcess().run()
@@ -0,0 +1,213 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local record of which objects a backend has, so that push and pull can
+decide what to transfer without a HEAD request per object.
+
+Backends store objects under the first two hex characters of their digest, so
+a bucket is listed as 256 independent prefixes, in parallel. Each prefix is
+kept as sorted arrays of binary digests (one per digest length) along with the
+time it was listed, and only prefixes older than the TTL are listed again.
+"""
+
+from builtins import object
+import binascii
+import os
+import pickle
+import re
+import sys
+import tempfile
+import time
+
+from .compat import replace
+from .transfer import TransferPool
+
+# Bump whenever the pickled layout below changes.
+cache_version = 1
+
+prefixes = ["{:02x}".format(i) for i in range(256)]
+
+hexdigest_regex = re.compile(r'^(?:[0-9a-f]{2})+$')
+
+# Number of prefixes listed at once.
+list_jobs = 16
+
+
+class DigestSet(object):
+    """ Sorted, fixed-width binary digests packed into one bytes object. """
+
+    def __init__(self, width, data=b""):
+        self.width = width
+        self.data = data
+
+    @classmethod
+    def from_digests(cls, width, digests):
+        return cls(width, b"".join(sorted(set(digests))))
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def position(self, digest):
+        """ :return: (index where `digest` is or would go, whether it's there) """
+        # add() may swap in new data from another thread while a lookup runs.
+        data = self.data
+        low, high = 0, len(data) // self.width
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * self.width
+            value = data[offset:offset + self.width]
+            if value < digest:
+                low = middle + 1
+            elif value > digest:
+                high = middle
+            else:
+                return middle, True
+        return low, False
+
+    def __contains__(self, digest):
+        return self.position(digest)[1]
+
+    def add(self, digest):
+        index, found = self.position(digest)
+        if not found:
+            offset = index * self.width
+            self.data = self.data[:offset] + digest + self.data[offset:]
+
+
+def list_prefix(backend, prefix):
+    """
+    List the objects stored under `prefix`. Runs on a transfer worker.
+
+    :return: list of binary digests
+    """
+    digests = []
+    for hexdigest in backend.list(prefix):
+        if hexdigest.startswith(prefix) and hexdigest_regex.match(hexdigest):
+            digests.append(binascii.unhexlify(hexdigest))
+    return digests
+
+
+class Inventory(object):
+    """
+    The objects a backend is known to have.
+
+    Usage:
+
+        inventory = Inventory.load(filename, ttl)
+        inventory.refresh(backend_name, backend_for_name)
+        if inventory.contains(hexdigest):
+            ...
+        inventory.save()
+    """
+
+    def __init__(self, filename=None, ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+        # prefix -> (time listed, {digest length: DigestSet})
+        self.prefixes = {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, filename, ttl):
+        inventory = cls(filename, ttl)
+        try:
+            with open(filename, 'rb') as file:
+                version, listings = pickle.load(file)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return inventory
+
+        if version == cache_version:
+            inventory.prefixes = dict(
+                (prefix, (listed_at, dict((width, DigestSet(width, data)) for width, data in sets.items())))
+                for prefix, (listed_at, sets) in listings.items())
+        return inventory
+
+    def save(self):
+        if not self.changed or not self.filename:
+            return
+
+        directory = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".inventory-")
+        except (IOError, OSError):
+            return
+
+        listings = dict(
+            (prefix, (listed_at, dict((width, digests.data) for width, digests in sets.items())))
+            for prefix, (listed_at, sets) in self.prefixes.items())
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((cache_version, listings), file, protocol=2)
+        replace(temporary_filename, self.filename)
+        self.changed = False
+
+    def stale_prefixes(self, now=None):
+        now = time.time() if now is None else now
+        return [prefix for prefix in prefixes
+                if prefix not in self.prefixes or now - self.prefixes[prefix][0] > self.ttl]
+
+    def refresh(self, backend_name, backend_factory, jobs=list_jobs):
+        """
+        List every prefix that is missing or older than the TTL.
+
+        :return: False if the backend couldn't be listed, in which case the
+                 inventory shouldn't be relied on
+        """
+        stale = self.stale_prefixes()
+        if not stale:
+            return True
+
+        def store(prefix, listed_at):
+            def callback(digests):
+                sets = {}
+                for digest in digests:
+                    sets.setdefault(len(digest), []).append(digest)
+                self.prefixes[prefix] = (listed_at, dict(
+                    (width, DigestSet.from_digests(width, values)) for width, values in sets.items()))
+                self.changed = True
+            return callback
+
+        sys.stderr.write("listing {} prefixes on {}...".format(len(stale), backend_name))
+        sys.stderr.flush()
+        try:
+            with TransferPool(jobs, backend_factory) as pool:
+                for prefix in stale:
+                    pool.submit(store(prefix, time.time()), backend_name, list_prefix, prefix)
+                pool.join()
+        except Exception as e:
+            sys.stderr.write("failed ({})\n".format(e))
+            return False
+
+        sys.stderr.write("done\n")
+        return True
+
+    def contains(self, hexdigest):
+        digest = binascii.unhexlify(hexdigest)
+        listing = self.prefixes.get(hexdigest[:2])
+        if listing is None:
+            return False
+        digests = listing[1].get(len(digest))
+        return digests is not None and digest in digests
+
+    def add(self, hexdigest):
+        """ Record an object that has just been uploaded. """
+        digest = binascii.unhexlify(hexdigest)
+        listing = self.prefixes.get(hexdigest[:2])
+        if listing is None:
+            # Not listed yet, so the next refresh will pick it up anyway.
+            return
+        listing[1].setdefault(len(digest), DigestSet(len(digest))).add(digest)
+        self.changed = True
@@ -0,0 +1,107 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import collections
+import os
+
+
+class TransferJournal(object):
+    """
+    Append-only record of the transfers a push or pull has queued and
+    finished, so that a run that dies part way can be picked up without
+    redoing (or asking the backend about) the work it had already done.
+
+    Each line is tab-separated: `queued <key>` when a transfer is handed to a
+    worker, and `done <key> <fields...>` once it has finished. Lines are
+    flushed as they're written; a line cut short by a crash is ignored.
+
+    Usage:
+
+        journal = TransferJournal.open(filename)
+        for key, fields in journal.done.items():
+            ...  # finish recording work from the interrupted run
+        journal.clear()
+
+        journal.queue(key)
+        journal.complete(key, field, ...)
+
+        journal.remove()  # once everything is recorded elsewhere
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.queued = set()
+        # key -> list of fields, in the order the transfers finished
+        self.done = collections.OrderedDict()
+        self.file = None
+
+    @classmethod
+    def open(cls, filename):
+        journal = cls(filename)
+        try:
+            with open(filename) as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break
+                    fields = line[:-1].split("\t")
+                    if fields[0] == "queued" and len(fields) == 2:
+                        journal.queued.add(fields[1])
+                    elif fields[0] == "done" and len(fields) >= 2:
+                        journal.done[fields[1]] = fields[2:]
+        except (IOError, OSError):
+            pass
+        return journal
+
+    def interrupted(self):
+        """ :return: keys of transfers that were queued but never finished """
+        return self.queued - set(self.done)
+
+    def write(self, *fields):
+        if self.file is None:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = open(self.filename, 'a')
+        self.file.write("\t".join(fields) + "\n")
+        self.file.flush()
+
+    def queue(self, key):
+        self.queued.add(key)
+        self.write("queued", key)
+
+    def complete(self, key, *fields):
+        self.done[key] = list(fields)
+        self.write("done", key, *fields)
+
+    def clear(self):
+        """ Forget everything recorded so far. """
+        self.close()
+        self.queued.clear()
+        self.done.clear()
+        if os.path.exists(self.filename):
+            with open(self.filename, 'w'):
+                pass
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
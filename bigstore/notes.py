@@ -0,0 +1,308 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import collections
+import os
+import pickle
+import subprocess
+import tempfile
+
+from .compat import replace
+
+notes_ref = "refs/notes/bigstore"
+
+# Bump whenever the pickled layout below changes.
+cache_version = 1
+
+
+def git_output(*args):
+    """
+    Run a git command and return its stdout, or None if it fails.
+    """
+    process = subprocess.Popen(("git",) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return output
+
+
+def read_blobs(shas):
+    """
+    Read a batch of blobs with a single `git cat-file --batch`.
+
+    :param shas: list of blob shas
+    :return: dict of sha -> bytes
+    """
+    if not shas:
+        return {}
+
+    process = subprocess.Popen(("git", "cat-file", "--batch"), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate("".join("{}\n".format(sha) for sha in shas).encode('ascii'))
+
+    blobs = {}
+    offset = 0
+    while offset < len(output):
+        end = output.index(b"\n", offset)
+        header = output[offset:end].decode('ascii').split(" ")
+        offset = end + 1
+        if header[-1] == "missing":
+            continue
+
+        size = int(header[2])
+        blobs[header[0]] = output[offset:offset + size]
+        offset += size + 1
+    return blobs
+
+
+def parse_entries(note):
+    """
+    Parse the tab-separated `timestamp action backend user` lines of a bigstore
+    note, skipping blank lines and anything else that isn't an entry.
+
+    :return: tuple of (timestamp, action, backend, user) tuples
+    """
+    entries = []
+    for line in note.decode('utf-8', 'replace').split('\n'):
+        fields = line.split('\t')
+        if len(fields) == 4:
+            entries.append(tuple(fields))
+    return tuple(entries)
+
+
+class NotesIndex(object):
+    """
+    Every entry on refs/notes/bigstore, read in one pass and looked up by the
+    sha of the annotated object.
+
+    The parsed index is cached on disk alongside the id of the notes commit it
+    was built from. When the notes ref has moved on since then, only the notes
+    that changed in between are read again.
+    """
+
+    def __init__(self, commit=None, notes=None):
+        self.commit = commit
+        # sha -> (note blob sha, entries)
+        self.notes = notes if notes is not None else {}
+
+    @classmethod
+    def load(cls, cache_filename=None):
+        commit = git_output("rev-parse", "--verify", "-q", notes_ref)
+        if commit is None:
+            return cls()
+        commit = commit.decode('ascii').strip()
+
+        index = None
+        if cache_filename:
+            index = cls.read_cache(cache_filename)
+
+        if index is None:
+            index = cls.build(commit)
+        elif index.commit != commit:
+            if not index.update(commit):
+                index = cls.build(commit)
+        else:
+            return index
+
+        if cache_filename:
+            index.write_cache(cache_filename)
+        return index
+
+    @classmethod
+    def build(cls, commit):
+        index = cls(commit)
+        listing = git_output("notes", "--ref=bigstore", "list") or b""
+        pairs = [line.split(" ") for line in listing.decode('ascii').split("\n") if line]
+        blobs = read_blobs(sorted(set(note for note, _ in pairs)))
+        for note, sha in pairs:
+            if note in blobs:
+                index.notes[sha] = (note, parse_entries(blobs[note]))
+        return index
+
+    def update(self, commit):
+        """
+        Bring the index up to date with `commit` by reading only the notes that
+        changed since the indexed commit.
+
+        :return: False if the difference couldn't be computed
+        """
+        changes = git_output("diff-tree", "-r", "--no-renames", self.commit, commit)
+        if changes is None:
+            return False
+
+        changed = {}
+        for line in changes.decode('ascii').split("\n"):
+            if not line.startswith(":"):
+                continue
+            metadata, path = line.split("\t", 1)
+            _, _, _, note, status = metadata.split(" ")
+            # Notes trees fan out into directories once they grow large.
+            sha = path.replace("/", "")
+            if status == "D":
+                self.notes.pop(sha, None)
+            else:
+                changed[sha] = note
+
+        blobs = read_blobs(sorted(set(changed.values())))
+        for sha, note in changed.items():
+            if note in blobs:
+                self.notes[sha] = (note, parse_entries(blobs[note]))
+
+        self.commit = commit
+        return True
+
+    @classmethod
+    def read_cache(cls, cache_filename):
+        try:
+            with open(cache_filename, 'rb') as file:
+                version, commit, notes = pickle.load(file)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+        if version != cache_version:
+            return None
+        return cls(commit, notes)
+
+    def write_cache(self, cache_filename):
+        directory = os.path.dirname(cache_filename)
+        try:
+            fd, temporary_filename = tempfile.mkstemp(dir=directory, prefix=".notes-index-")
+        except (IOError, OSError):
+            # No bigstore directory yet, so nowhere to cache the index.
+            return
+
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((cache_version, self.commit, self.notes), file, protocol=2)
+        replace(temporary_filename, cache_filename)
+
+    def entries(self, sha):
+        """
+        :return: tuple of (timestamp, action, backend, user) tuples for `sha`
+        """
+        return self.notes.get(sha, (None, ()))[1]
+
+    def items(self):
+        """ Generator that yields (sha, entries) for every annotated object. """
+        for sha, (_, entries) in self.notes.items():
+            yield sha, entries
+
+    def add(self, sha, entry):
+        """ Record an entry that has just been appended to the notes for `sha`. """
+        note, entries = self.notes.get(sha, (None, ()))
+        self.notes[sha] = (note, entries + (tuple(entry),))
+
+
+class NotesWriter(object):
+    """
+    Entries appended to the bigstore notes, written out together as a single
+    notes commit through `git fast-import` instead of a `git notes append`
+    process, and a commit, for each one.
+
+    Entries are written whenever `checkpoint_size` of them have built up, and
+    when the writer is closed, so an interrupted command keeps what it
+    recorded up to its last checkpoint. `on_flush`, if given, is called after
+    each notes commit.
+
+    Usage:
+
+        with NotesWriter() as writer:
+            writer.append(sha, (timestamp, action, backend, user))
+    """
+
+    def __init__(self, checkpoint_size=1000, message="Notes added by 'git bigstore'", on_flush=None):
+        self.checkpoint_size = checkpoint_size
+        self.message = message
+        self.on_flush = on_flush
+        # sha -> list of entries
+        self.pending = collections.OrderedDict()
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def append(self, sha, entry):
+        self.pending.setdefault(sha, []).append("\t".join(entry))
+        self.count += 1
+        if self.count >= self.checkpoint_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        parent = git_output("rev-parse", "--verify", "-q", notes_ref)
+        # sha -> (path of its note in the notes tree, note blob sha)
+        paths = {}
+        # Large notes trees fan out into directories named after the first
+        # bytes of the sha; new notes go in at the same depth.
+        fanout = 0
+        if parent is not None:
+            parent = parent.decode('ascii').strip()
+            listing = git_output("ls-tree", "-r", "-z", parent) or b""
+            for record in listing.decode('utf-8').split("\0"):
+                if not record:
+                    continue
+                metadata, path = record.split("\t", 1)
+                fanout = path.count("/")
+                sha = path.replace("/", "")
+                if sha in self.pending:
+                    paths[sha] = (path, metadata.split(" ")[2])
+
+        blobs = read_blobs(sorted(set(note for _, note in paths.values())))
+
+        identity = git_output("var", "GIT_COMMITTER_IDENT")
+        if identity is None:
+            raise RuntimeError("can't write bigstore notes without a committer identity (set user.name and "
+                               "user.email)")
+
+        commands = [b"commit " + notes_ref.encode('ascii') + b"\n",
+                    b"committer " + identity.strip() + b"\n",
+                    data_command(self.message.encode('utf-8'))]
+        if parent is not None:
+            commands.append("from {}\n".format(parent).encode('ascii'))
+        for sha, lines in self.pending.items():
+            # Entries are separated by blank lines, the way `git notes append`
+            # writes them.
+            note = "\n\n".join(lines).encode('utf-8') + b"\n"
+            if sha in paths:
+                path, blob = paths[sha]
+                if blobs.get(blob, b"").strip():
+                    note = blobs[blob].rstrip(b"\n") + b"\n\n" + note
+            else:
+                path = "/".join([sha[2 * level:2 * level + 2] for level in range(fanout)] + [sha[2 * fanout:]])
+            # fast-import's own notes command only annotates commits, so the
+            # note is written to its path in the notes tree.
+            commands.append("M 100644 inline {}\n".format(path).encode('ascii'))
+            commands.append(data_command(note))
+
+        process = subprocess.Popen(("git", "fast-import", "--quiet"), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, error = process.communicate(b"".join(commands))
+        if process.returncode != 0:
+            # e.g. another process moved the notes ref in the meantime, which
+            # fast-import won't overwrite.
+            raise RuntimeError("couldn't write bigstore notes: {}".format(error.decode('utf-8', 'replace').strip()))
+
+        self.pending.clear()
+        self.count = 0
+        if self.on_flush is not None:
+            self.on_flush()
+
+
+def data_command(data):
+    """ A fast-import `data` command carrying `data`. """
+    return "data {}\n".format(len(data)).encode('ascii') + data + b"\n"
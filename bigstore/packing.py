@@ -0,0 +1,95 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Packs of small objects.
+
+With pack mode on, push concatenates objects below a size threshold into
+packs, each stored on the backend as one object keyed by its sha256. The note
+for every packed file records the pack and the object's offset and length
+within it, so any single object can be found without downloading an index,
+and pull reads what it needs with as few ranged requests as it can.
+"""
+
+pack_hash_function_name = 'sha256'
+
+# Objects closer together than this in a pack are fetched with one request,
+# since downloading the gap costs less than another round trip.
+max_gap = 256 * 1024
+
+# Largest range fetched with one request.
+max_span = 8 * 1024 * 1024
+
+
+def packed_action(pack_hexdigest, offset, length):
+    """ Note action for an object stored at `offset` in a pack. """
+    return 'upload-packed:{}:{}:{}'.format(pack_hexdigest, offset, length)
+
+
+def location_for_action(action):
+    """
+    :return: (pack hexdigest, offset, length) for an "upload-packed" note
+             action, or None if the action isn't one
+    """
+    if not action.startswith('upload-packed:'):
+        return None
+
+    fields = action.split(':')
+    if len(fields) != 4:
+        return None
+    try:
+        return fields[1], int(fields[2]), int(fields[3])
+    except ValueError:
+        return None
+
+
+def plan_packs(objects, pack_size):
+    """
+    Split objects into packs of about `pack_size` bytes.
+
+    :param objects: list of (object, size)
+    :return: list of lists of objects
+    """
+    packs = []
+    current = []
+    current_size = 0
+    for item, size in objects:
+        if current and current_size + size > pack_size:
+            packs.append(current)
+            current = []
+            current_size = 0
+        current.append(item)
+        current_size += size
+    if current:
+        packs.append(current)
+    return packs
+
+
+def coalesce(objects):
+    """
+    Group objects from one pack into ranges to fetch with one request each.
+
+    :param objects: list of (offset, length, object)
+    :return: list of (offset, length, list of (offset, length, object)), in
+             pack order
+    """
+    ranges = []
+    for offset, length, item in sorted(objects, key=lambda entry: entry[:2]):
+        if ranges:
+            start, end, members = ranges[-1]
+            if offset - end <= max_gap and max(end, offset + length) - start <= max_span:
+                ranges[-1] = (start, max(end, offset + length), members + [(offset, length, item)])
+                continue
+        ranges.append((offset, offset + length, [(offset, length, item)]))
+    return [(start, end - start, members) for start, end, members in ranges]
@@ -0,0 +1,329 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rate control for backend requests.
+
+Every backend is used through a ScheduledBackend, which:
+
+- caps the number of requests in flight with an AdaptiveLimit. The limit grows
+  by about one request for every round of requests that succeed, and halves
+  when the backend throttles (S3 SlowDown, HTTP 429 and 503) or starts
+  answering much more slowly than it can. This is additive increase,
+  multiplicative decrease, the way TCP shares a link;
+- retries throttled and transient failures, with exponential backoff and full
+  jitter, so that clients that were throttled together don't all come back at
+  the same moment;
+- holds transfers to bandwidth limits, per backend and for the whole process,
+  so that a big push doesn't take the whole uplink from everyone else on the
+  network.
+
+A backend says which of its errors are worth retrying with
+`classify_error(error)`, which returns "throttled", "transient" or None.
+"""
+
+from builtins import object
+import random
+import socket
+import sys
+import threading
+import time
+
+# Ceiling for the number of requests in flight to one backend, unless
+# configured otherwise.
+default_max_requests = 64
+
+default_retries = 5
+
+# Delay before the first retry, doubling for each one after that, up to
+# `backoff_cap`.
+backoff_base = 0.25
+backoff_cap = 30.0
+
+# A request counts as slow if it takes this many times as long as the quickest
+# the backend has been, and at least `latency_slack` seconds longer.
+latency_factor = 4.0
+latency_slack = 0.1
+
+# Errors from the network itself, rather than a backend's answer.
+if sys.version_info >= (3,):
+    connection_errors = (socket.timeout, ConnectionError)
+else:
+    connection_errors = (socket.timeout,)
+
+
+def backoff(attempt):
+    """ :return: seconds to wait before retry number `attempt`, counting from 0 """
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+
+class BandwidthLimit(object):
+    """ Bytes per second, shared by every transfer that goes through it. """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.free_at = 0
+
+    def consume(self, size):
+        """ Wait as long as moving `size` bytes at the limit takes. """
+        with self.lock:
+            start = max(time.time(), self.free_at)
+            self.free_at = start + size / self.rate
+            finish = self.free_at
+
+        delay = finish - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveLimit(object):
+    """
+    Number of requests allowed in flight at once, adjusted AIMD style.
+
+    Usage:
+
+        ticket = limit.acquire()
+        ...
+        limit.release(ticket, congested=False)
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.started = 0
+        # Requests started up to this one were already in flight when the
+        # limit was last cut. Their failures are part of the same burst, so
+        # they don't cut it again.
+        self.cut_after = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ Wait for a free slot. :return: ticket to hand back to release() """
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+            self.started += 1
+            return self.started
+
+    def release(self, ticket, congested=False):
+        with self.condition:
+            if congested:
+                if ticket > self.cut_after:
+                    # Like TCP, back off from what was actually in flight
+                    # rather than from a limit that may never have been
+                    # reached.
+                    self.limit = max(1.0, min(self.limit, self.in_flight) / 2.0)
+                    self.cut_after = self.started
+            elif self.in_flight >= int(self.limit):
+                # Only grow while the limit is what's holding requests back.
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class Latency(object):
+    """ Tracks how quickly a backend can answer, to tell when it's congested. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # operation -> quickest response time seen
+        self.baselines = {}
+
+    def slow(self, operation, seconds):
+        """ :return: True if a request took much longer than the backend can manage """
+        with self.lock:
+            baseline = self.baselines.get(operation)
+            if baseline is None or seconds < baseline:
+                self.baselines[operation] = seconds
+                return False
+            # Drift up slowly, so that moving to a slower network isn't taken
+            # for congestion forever.
+            self.baselines[operation] = baseline + (seconds - baseline) * 0.01
+        return seconds > baseline * latency_factor and seconds > baseline + latency_slack
+
+
+class Scheduler(object):
+    """ Limits shared by every client of one backend. """
+
+    def __init__(self, max_requests=None, bandwidth_limits=(), retries=None):
+        self.limit = AdaptiveLimit(max_requests or default_max_requests)
+        self.bandwidth_limits = [limit for limit in bandwidth_limits if limit is not None]
+        self.retries = default_retries if retries is None else retries
+        self.latency = Latency()
+
+    def consume(self, size):
+        for limit in self.bandwidth_limits:
+            limit.consume(size)
+
+
+class ScheduledBackend(object):
+    """
+    A backend whose requests go through a Scheduler. Anything other than the
+    request methods is passed straight through to the backend.
+
+    Requests that return a generator (stream and list) are only retried until
+    their first item arrives, and hold their slot until they're exhausted or
+    closed.
+    """
+
+    def __init__(self, backend, scheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def classify(self, error):
+        classify_error = getattr(self.backend, 'classify_error', None)
+        kind = classify_error(error) if classify_error is not None else None
+        if kind is None and isinstance(error, connection_errors):
+            kind = 'transient'
+        return kind
+
+    def retry(self, operation, error, attempt):
+        """
+        Wait before retrying a failed request.
+
+        :return: False if the request shouldn't be retried
+        """
+        if attempt >= self.scheduler.retries or self.classify(error) is None:
+            return False
+
+        delay = backoff(attempt)
+        sys.stderr.write("bigstore: {} {} failed ({}), retrying in {:.1f}s\n".format(
+            self.backend.name, operation, error, delay))
+        time.sleep(delay)
+        return True
+
+    def call(self, operation, request, rewind=None, timed=False):
+        """
+        Make one request, retrying it if it fails in a way that's worth
+        retrying.
+
+        :param rewind: function that undoes a failed attempt's partial work
+        :param timed: whether the request's response time says anything about
+                      congestion (i.e. it doesn't depend on the object's size)
+        """
+        limit = self.scheduler.limit
+        attempt = 0
+        while True:
+            ticket = limit.acquire()
+            start = time.time()
+            try:
+                result = request()
+            except Exception as e:
+                limit.release(ticket, congested=self.classify(e) == 'throttled')
+                if not self.retry(operation, e, attempt):
+                    raise
+                attempt += 1
+                if rewind is not None:
+                    rewind()
+                continue
+
+            limit.release(ticket, congested=timed and self.scheduler.latency.slow(operation, time.time() - start))
+            return result
+
+    def generate(self, operation, request, metered=False):
+        """ Like call(), for requests that return a generator. """
+        limit = self.scheduler.limit
+        attempt = 0
+        while True:
+            ticket = limit.acquire()
+            start = time.time()
+            try:
+                items = iter(request())
+                first = next(items)
+            except StopIteration:
+                limit.release(ticket)
+                return
+            except Exception as e:
+                limit.release(ticket, congested=self.classify(e) == 'throttled')
+                if not self.retry(operation, e, attempt):
+                    raise
+                attempt += 1
+                continue
+            break
+
+        # The wait for the first item doesn't depend on the object's size.
+        congested = self.scheduler.latency.slow(operation, time.time() - start)
+        try:
+            item = first
+            while True:
+                if metered:
+                    self.scheduler.consume(len(item))
+                yield item
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+        except Exception as e:
+            congested = congested or self.classify(e) == 'throttled'
+            raise
+        finally:
+            limit.release(ticket, congested=congested)
+
+    def metered(self, cb):
+        """
+        Progress callback that counts transferred bytes against the bandwidth
+        limits before passing them on. Backends report either the bytes since
+        the last call (boto3, local) or the bytes so far and the total (boto,
+        cloudfiles).
+        """
+        if not self.scheduler.bandwidth_limits:
+            return cb
+
+        transferred = [0]
+
+        def callback(*args):
+            if len(args) == 2:
+                amount = args[0] - transferred[0]
+                transferred[0] = args[0]
+            else:
+                amount = args[0]
+            self.scheduler.consume(amount)
+            if cb:
+                cb(*args)
+        return callback
+
+    def push(self, file, hash, cb=None):
+        position = file.tell()
+        self.call('push', lambda: self.backend.push(file, hash, cb=self.metered(cb)),
+                  rewind=lambda: file.seek(position))
+
+    def pull(self, file, hash, cb=None):
+        def rewind():
+            file.seek(0)
+            file.truncate()
+        self.call('pull', lambda: self.backend.pull(file, hash, cb=self.metered(cb)), rewind=rewind)
+
+    def stream(self, hash, chunk_size=1024*1024):
+        return self.generate('stream', lambda: self.backend.stream(hash, chunk_size), metered=True)
+
+    def read_range(self, hash, offset, length):
+        data = self.call('read_range', lambda: self.backend.read_range(hash, offset, length))
+        self.scheduler.consume(len(data))
+        return data
+
+    def list(self, prefix):
+        return self.generate('list', lambda: self.backend.list(prefix))
+
+    def exists(self, hash):
+        return self.call('exists', lambda: self.backend.exists(hash), timed=True)
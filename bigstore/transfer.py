@@ -0,0 +1,192 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from builtins import object
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def reraise(exc_info):
+    """ Raise an exception caught on another thread, with its traceback. """
+    # future.utils is slow to import and only needed when something fails.
+    from future.utils import raise_
+    raise_(exc_info[0], exc_info[1], exc_info[2])
+
+
+class TransferPool(object):
+    """
+    Run transfer tasks on a fixed number of worker threads.
+
+    Every worker asks `backend_factory` for its backend clients once per backend
+    name; the factory decides whether a client can be shared between threads
+    or has to be built per thread. Tasks are
+    handed out through a bounded queue so that walking a huge tree never runs
+    far ahead of the network, and results are handed back to the caller in the
+    order the tasks were submitted so that anything written afterwards (e.g.
+    bigstore notes) is deterministic.
+
+    Usage:
+
+        with TransferPool(jobs, backend_for_name) as pool:
+            for ...:
+                pool.submit(handle_result, backend_name, task, *args)
+            pool.join()
+
+    `task` is called on a worker as `task(backend, *args)`, and
+    `handle_result` is called on the calling thread as `handle_result(value)`.
+    """
+
+    def __init__(self, jobs, backend_factory, queue_size=None):
+        self.jobs = max(1, jobs)
+        self.backend_factory = backend_factory
+        self.tasks = queue.Queue(maxsize=queue_size or self.jobs * 2)
+        self.results = queue.Queue()
+        self.threads = []
+        self.submitted = 0
+        self.completed = 0
+        self.pending = {}
+        self.callbacks = {}
+
+    def __enter__(self):
+        for _ in range(self.jobs):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Throw away anything that hasn't started yet so that the workers
+            # can see their sentinels.
+            try:
+                while True:
+                    self.tasks.get_nowait()
+            except queue.Empty:
+                pass
+
+        for _ in self.threads:
+            self.tasks.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        backends = {}
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                break
+
+            index, backend_name, task, args = item
+            try:
+                if backend_name not in backends:
+                    backends[backend_name] = self.backend_factory(backend_name)
+
+                value = task(backends[backend_name], *args)
+            except BaseException:
+                self.results.put((index, None, sys.exc_info()))
+            else:
+                self.results.put((index, value, None))
+
+    def submit(self, callback, backend_name, task, *args):
+        """
+        Queue `task` for a worker. Blocks while the work queue is full, handing
+        back any results that finish in the meantime.
+        """
+        index = self.submitted
+        self.submitted += 1
+        self.callbacks[index] = callback
+
+        while True:
+            try:
+                self.tasks.put((index, backend_name, task, args), timeout=0.1)
+            except queue.Full:
+                self.collect(block=False)
+            else:
+                break
+
+        self.collect(block=False)
+
+    def join(self):
+        """ Wait for every submitted task and hand back the remaining results. """
+        while self.completed < self.submitted:
+            self.collect(block=True)
+
+    def collect(self, block):
+        while True:
+            try:
+                index, value, exc_info = self.results.get(block=block)
+            except queue.Empty:
+                return
+
+            self.pending[index] = (value, exc_info)
+            while self.completed in self.pending:
+                value, exc_info = self.pending.pop(self.completed)
+                callback = self.callbacks.pop(self.completed)
+                self.completed += 1
+                if exc_info is not None:
+                    reraise(exc_info)
+
+                callback(value)
+
+            if block:
+                return
+
+
+def prefetch(iterable, size):
+    """
+    Generator that consumes `iterable` on a background thread, keeping up to
+    `size` items buffered, so that producing items (e.g. reading from the
+    network) overlaps with whatever the caller does with them.
+    """
+    items = queue.Queue(maxsize=size)
+    finished = object()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not cancelled.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                    except queue.Full:
+                        continue
+                    break
+                if cancelled.is_set():
+                    return
+        except BaseException:
+            items.put((None, sys.exc_info()))
+        else:
+            items.put((finished, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, exc_info = items.get()
+            if exc_info is not None:
+                reraise(exc_info)
+            if item is finished:
+                break
+            yield item
+    finally:
+        cancelled.set()
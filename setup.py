@@ -15,13 +15,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
 import runpy
+import sys
 
 try:
-    from setuptools import setup
+    from setuptools import setup, Extension
+    from setuptools.command.build_ext import build_ext
 except ImportError:
-    from distutils.core import setup
+    from distutils.core import setup, Extension
+    from distutils.command.build_ext import build_ext
 
 metadata_filename = "bigstore/metadata.py"
 metadata = runpy.run_path(metadata_filename)
@@ -44,6 +46,30 @@ classifiers = [
     "Topic :: Utilities",
 ]
 
+
+class optional_build_ext(build_ext):
+    """
+    The chunker's C extension only makes chunking faster, so installing
+    without a compiler falls back to the pure-Python chunker.
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self.warn_unbuilt(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self.warn_unbuilt(e)
+
+    def warn_unbuilt(self, error):
+        sys.stderr.write("warning: not building the chunking extension ({}); chunked files will be split "
+                         "much more slowly\n".format(error))
+
+
 setup(
     name='git-bigstore',
     description="Track big files with Git.",
@@ -60,13 +86,17 @@ setup(
     scripts=[
         'bin/git-bigstore',
     ],
+    ext_modules=[
+        Extension('bigstore._cdc', ['bigstore/_cdc.c']),
+    ],
+    cmdclass={'build_ext': optional_build_ext},
+    test_suite='tests',
     install_requires=[
         'future',
         'gitpython<3',
         'boto',
         'boto3',
-        'python-dateutil',
-        'pytz',
         'python-cloudfiles;python_version<="2.7"',
+        'futures;python_version<"3"',
     ],
 )
@@ -0,0 +1,63 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import unittest
+
+from bigstore import chunking
+
+# Chunk lengths for `sample_data(12 MiB)`. The boundaries are part of the
+# format, so these must never change.
+expected_lengths = [2434817, 1109369, 1280160, 1114781, 1117947, 1133601, 1411073, 1145034, 1418711, 417419]
+
+
+def sample_data(size):
+    """ Deterministic, incompressible data: sha256 of a counter. """
+    blocks = []
+    for index in range(-(-size // 32)):
+        blocks.append(hashlib.sha256("bigstore-test-{}".format(index).encode('ascii')).digest())
+    return b"".join(blocks)[:size]
+
+
+def chunk_lengths(data, native):
+    saved = chunking._cdc
+    if not native:
+        chunking._cdc = None
+    try:
+        return [len(chunk) for chunk in chunking.chunks(io.BytesIO(data))]
+    finally:
+        chunking._cdc = saved
+
+
+class ChunkingTest(unittest.TestCase):
+    data = sample_data(12 * 1024 * 1024)
+
+    def test_python_boundaries(self):
+        self.assertEqual(chunk_lengths(self.data, native=False), expected_lengths)
+
+    @unittest.skipIf(chunking._cdc is None, "the _cdc extension isn't built")
+    def test_native_boundaries(self):
+        self.assertEqual(chunk_lengths(self.data, native=True), expected_lengths)
+
+    def test_small_input_is_one_chunk(self):
+        self.assertEqual(chunk_lengths(self.data[:chunking.min_size], native=False), [chunking.min_size])
+        self.assertEqual(chunk_lengths(b"", native=False), [])
+
+    def test_chunks_reassemble(self):
+        self.assertEqual(b"".join(chunking.chunks(io.BytesIO(self.data))), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import re
+import unittest
+
+from bigstore import compression
+from bigstore.compression import BZ2Codec, ParallelDecompressor, compress_file, get_codec, parallel_available
+
+bz2_magic = b"BZh91AY&SY"
+
+
+def sample_data(size):
+    """ Deterministic, incompressible data: sha256 of a counter. """
+    blocks = []
+    for index in range(-(-size // 32)):
+        blocks.append(hashlib.sha256("bigstore-test-{}".format(index).encode('ascii')).digest())
+    return b"".join(blocks)[:size]
+
+
+def compress(data, threads):
+    compressed = io.BytesIO()
+    streams = compress_file(get_codec('bz2'), io.BytesIO(data), compressed, threads=threads)
+    return compressed.getvalue(), streams
+
+
+def decompress(codec, data, piece_size):
+    """ Feed `data` to a ParallelDecompressor `piece_size` bytes at a time. """
+    decompressor = ParallelDecompressor(codec, 4)
+    output = []
+    for offset in range(0, len(data), piece_size):
+        output.append(decompressor.decompress(data[offset:offset + piece_size]))
+    output.append(decompressor.flush())
+    return b"".join(output)
+
+
+class SplitInsideStream(BZ2Codec):
+    """ bz2, but also "finding" stream headers inside the compressed data. """
+
+    def __init__(self, false_header):
+        self.stream_magic = re.compile(re.escape(false_header) + b"|" + BZ2Codec.stream_magic.pattern)
+
+
+@unittest.skipUnless(parallel_available(), "concurrent.futures isn't available")
+class ParallelDecompressorTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_block_size = compression.parallel_block_size
+        compression.parallel_block_size = 64 * 1024
+
+    def tearDown(self):
+        compression.parallel_block_size = self.saved_block_size
+
+    def test_single_stream_containing_header(self):
+        data = (sample_data(1000) + bz2_magic) * 200
+        compressed, streams = compress(data, threads=1)
+        self.assertEqual(streams, 1)
+        self.assertEqual(decompress(get_codec('bz2'), compressed, 1000), data)
+
+    def test_false_split_inside_stream(self):
+        data = sample_data(300 * 1024)
+        compressed, streams = compress(data, threads=1)
+        self.assertEqual(streams, 1)
+        # Bytes from the middle of the stream, taken for the start of another.
+        codec = SplitInsideStream(compressed[len(compressed) // 2:len(compressed) // 2 + 4])
+        self.assertEqual(decompress(codec, compressed, 4096), data)
+
+    def test_multi_stream_round_trip(self):
+        data = sample_data(200 * 1024) + b"\x00" * (300 * 1024) + bz2_magic * 1000
+        compressed, streams = compress(data, threads=4)
+        self.assertGreater(streams, 1)
+        self.assertEqual(len(list(BZ2Codec.stream_magic.finditer(compressed))), streams)
+        for piece_size in (1, 4096, len(compressed)):
+            self.assertEqual(decompress(get_codec('bz2'), compressed, piece_size), data)
+
+    def test_truncated_input(self):
+        data = sample_data(300 * 1024)
+        compressed, streams = compress(data, threads=4)
+        self.assertGreater(streams, 1)
+        with self.assertRaises(ValueError):
+            decompress(get_codec('bz2'), compressed[:-10], 4096)
+
+
+if __name__ == '__main__':
+    unittest.main()
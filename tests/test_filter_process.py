@@ -0,0 +1,210 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals
+
+import importlib
+import io
+import unittest
+
+# The package exports the filter_process() function under the module's name.
+filter_process = importlib.import_module('bigstore.filter_process')
+
+pointer = b"bigstore\nsha1\n" + b"0" * 40 + b"\n"
+
+welcome = ["git-filter-client", "version=2", None,
+           "capability=clean", "capability=smudge", "capability=delay", None]
+
+
+def packets(*items):
+    """
+    Encode pkt-lines: str items are text lines, bytes items are content and
+    None is a flush packet.
+    """
+    stream = io.BytesIO()
+    for item in items:
+        if item is None:
+            filter_process.write_flush(stream)
+        elif isinstance(item, bytes):
+            for offset in range(0, len(item), filter_process.MAX_PACKET_DATA):
+                filter_process.write_packet(stream, item[offset:offset + filter_process.MAX_PACKET_DATA])
+        else:
+            filter_process.write_text_packet(stream, item)
+    return stream.getvalue()
+
+
+def read_packets(data):
+    """
+    Decode pkt-lines, with flush packets as None and single lines of text
+    decoded.
+    """
+    stream = io.BytesIO(data)
+    items = []
+    while True:
+        try:
+            packet = filter_process.read_packet(stream)
+        except EOFError:
+            return items
+        if packet is not None and packet.endswith(b"\n") and packet.count(b"\n") == 1:
+            packet = packet.decode('utf-8').rstrip("\n")
+        items.append(packet)
+
+
+class FakePrefetcher(object):
+    """ Fetches every object instantly. """
+
+    def __init__(self, jobs):
+        self.delayed = {}
+        self.available = []
+        self.closed = False
+
+    def delay(self, pathname, pointer, blob=None):
+        self.delayed[pathname] = pointer
+        self.available.append(pathname)
+
+    def take(self, pathname):
+        return self.delayed.pop(pathname, None)
+
+    def wait(self):
+        available, self.available = self.available, []
+        return available
+
+    def close(self):
+        self.closed = True
+
+
+class FilterProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.smudged = []
+        self.prefetchers = []
+
+        def filter_clean(input, output):
+            data = input.read()
+            if data == b"fail":
+                raise IOError("no space left on device")
+            output.write(b"cleaned " + data)
+
+        def filter_smudge(input, output, pathname=None, fetch=None):
+            self.smudged.append((pathname, fetch))
+            data = input.read()
+            output.write(b"smudged " + data)
+            if data.startswith(b"fail after output"):
+                raise IOError("object is corrupt")
+
+        def prefetcher(jobs):
+            self.prefetchers.append(FakePrefetcher(jobs))
+            return self.prefetchers[-1]
+
+        stubs = {
+            'filter_clean': filter_clean,
+            'filter_smudge': filter_smudge,
+            'smudge_fetch_enabled': lambda: True,
+            'smudge_fetch_jobs': lambda: 4,
+            'find_object': lambda hash_function_name, hexdigest: None,
+            'Prefetcher': prefetcher,
+        }
+        self.saved = dict((name, getattr(filter_process, name)) for name in stubs)
+        for name, stub in stubs.items():
+            setattr(filter_process, name, stub)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(filter_process, name, value)
+
+    def run_filter(self, *requests):
+        """ :return: the packets the filter responded with after the handshake """
+        output = io.BytesIO()
+        filter_process.FilterProcess(io.BytesIO(packets(*(welcome + list(requests)))), output).run()
+
+        response = read_packets(output.getvalue())
+        handshake = ["git-filter-server", "version=2", None,
+                     "capability=clean", "capability=smudge", "capability=delay", None]
+        self.assertEqual(response[:len(handshake)], handshake)
+        return response[len(handshake):]
+
+    def test_clean(self):
+        response = self.run_filter("command=clean", "pathname=a.bin", None, b"contents", None)
+        self.assertEqual(response, ["status=success", None, b"cleaned contents", None, None])
+
+    def test_smudge(self):
+        data = b"x" * (filter_process.MAX_PACKET_DATA * 2 + 10)
+        response = self.run_filter("command=smudge", "pathname=a.bin", None, data, None)
+        self.assertEqual(response[:2], ["status=success", None])
+        self.assertEqual(response[-2:], [None, None])
+        self.assertEqual(b"".join(response[2:-2]), b"smudged " + data)
+        # Large content is split at the largest packet size.
+        self.assertTrue(all(len(packet) <= filter_process.MAX_PACKET_DATA for packet in response[2:-2]))
+        self.assertEqual(self.smudged, [("a.bin", None)])
+
+    def test_delayed_smudge(self):
+        response = self.run_filter(
+            "command=smudge", "pathname=a.bin", "can-delay=1", None, pointer, None,
+            "command=list_available_blobs", None,
+            "command=smudge", "pathname=a.bin", None, None,
+            "command=list_available_blobs", None)
+        self.assertEqual(response, [
+            "status=delayed", None,
+            "pathname=a.bin", None, "status=success", None,
+            "status=success", None, b"smudged " + pointer, None, None,
+            None, "status=success", None])
+        # Git asks for the delayed file again without its content, so the
+        # pointer comes from the prefetcher, which has already fetched it.
+        self.assertEqual(self.smudged, [("a.bin", False)])
+        self.assertEqual(len(self.prefetchers), 1)
+        self.assertTrue(self.prefetchers[0].closed)
+
+    def test_smudge_not_delayed_without_can_delay(self):
+        response = self.run_filter("command=smudge", "pathname=a.bin", None, pointer, None)
+        self.assertEqual(response, ["status=success", None, b"smudged " + pointer, None, None])
+        self.assertEqual(self.prefetchers, [])
+
+    def test_error(self):
+        response = self.run_filter(
+            "command=clean", "pathname=a.bin", None, b"fail", None,
+            "command=clean", "pathname=b.bin", None, b"contents", None)
+        # The failure is reported for that file only.
+        self.assertEqual(response, [
+            "status=error", None,
+            "status=success", None, b"cleaned contents", None, None])
+
+    def test_error_after_output(self):
+        response = self.run_filter("command=smudge", "pathname=a.bin", None, b"fail after output", None)
+        # Nothing had been sent yet, so the output is dropped.
+        self.assertEqual(response, ["status=error", None])
+
+        data = b"fail after output" + b"x" * filter_process.MAX_PACKET_DATA
+        response = self.run_filter("command=smudge", "pathname=a.bin", None, data, None)
+        # Content has started, so it's ended with a flush before the status.
+        self.assertEqual(response, [
+            "status=success", None, (b"smudged " + data)[:filter_process.MAX_PACKET_DATA], None,
+            "status=error", None])
+
+    def test_empty_content(self):
+        response = self.run_filter("command=clean", "pathname=empty", None, None)
+        self.assertEqual(response, ["status=success", None, b"cleaned ", None, None])
+
+    def test_content_split_across_packets(self):
+        data = packets("command=clean", "pathname=a.bin", None) + b"0008abcd0008efgh0000"
+        output = io.BytesIO()
+        filter_process.FilterProcess(io.BytesIO(packets(*welcome) + data), output).run()
+        self.assertIn(b"cleaned abcdefgh", output.getvalue())
+
+    def test_unexpected_welcome(self):
+        process = filter_process.FilterProcess(io.BytesIO(packets("git-filter-client", "version=3", None)),
+                                               io.BytesIO())
+        self.assertRaises(filter_process.ProtocolError, process.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
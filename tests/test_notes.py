@@ -0,0 +1,117 @@
+# Copyright 2015-2017 Lionheart Software LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from bigstore.notes import NotesWriter
+
+
+def git(*args):
+    return subprocess.check_output(("git",) + args).decode('utf-8')
+
+
+def object_sha(index):
+    # Notes can be written for objects the repository doesn't have.
+    return hashlib.sha1("bigstore-test-{}".format(index).encode('ascii')).hexdigest()
+
+
+def entry(index):
+    return ("{}".format(1500000000 + index), "upload", "local", "Test <test@example.com>")
+
+
+def show(sha):
+    return git("notes", "--ref=bigstore", "show", sha)
+
+
+class NotesWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        git("init", "-q")
+        git("config", "user.name", "Test")
+        git("config", "user.email", "test@example.com")
+
+    def tearDown(self):
+        os.chdir(self.saved_directory)
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        with NotesWriter() as writer:
+            writer.append(object_sha(0), entry(0))
+            writer.append(object_sha(1), entry(1))
+            writer.append(object_sha(0), entry(2))
+
+        # Entries are separated by blank lines, as `git notes append` does.
+        self.assertEqual(show(object_sha(0)), "\t".join(entry(0)) + "\n\n" + "\t".join(entry(2)) + "\n")
+        self.assertEqual(show(object_sha(1)), "\t".join(entry(1)) + "\n")
+        self.assertEqual(git("log", "--format=%s", "refs/notes/bigstore"), "Notes added by 'git bigstore'\n")
+
+    def test_append_to_existing_note(self):
+        git("notes", "--ref=bigstore", "add", "-m", "\t".join(entry(0)), object_sha(0))
+        with NotesWriter() as writer:
+            writer.append(object_sha(0), entry(1))
+
+        self.assertEqual(show(object_sha(0)), "\t".join(entry(0)) + "\n\n" + "\t".join(entry(1)) + "\n")
+        self.assertEqual(len(git("log", "--format=%H", "refs/notes/bigstore").split()), 2)
+
+    def test_checkpoints(self):
+        flushes = []
+        with NotesWriter(checkpoint_size=2, on_flush=lambda: flushes.append(True)) as writer:
+            for index in range(3):
+                writer.append(object_sha(index), entry(index))
+            # The first two were written when the checkpoint was reached.
+            self.assertEqual(len(flushes), 1)
+            self.assertEqual(show(object_sha(1)), "\t".join(entry(1)) + "\n")
+
+        self.assertEqual(len(flushes), 2)
+        self.assertEqual(show(object_sha(2)), "\t".join(entry(2)) + "\n")
+        self.assertEqual(len(git("log", "--format=%H", "refs/notes/bigstore").split()), 2)
+
+    def test_nothing_to_write(self):
+        with NotesWriter():
+            pass
+        self.assertRaises(subprocess.CalledProcessError, git, "rev-parse", "-q", "--verify", "refs/notes/bigstore")
+
+    def test_fanout(self):
+        count = 300
+        with NotesWriter() as writer:
+            for index in range(count):
+                writer.append(object_sha(index), entry(index))
+
+        # Git fans a notes tree this large out into directories when it next
+        # rewrites it.
+        git("notes", "--ref=bigstore", "append", "-m", "\t".join(entry(count)), object_sha(count))
+        self.assertTrue(all("/" in path for path in git("ls-tree", "-r", "--name-only", "refs/notes/bigstore").split()))
+
+        with NotesWriter() as writer:
+            writer.append(object_sha(0), entry(count + 1))
+            writer.append(object_sha(count + 2), entry(count + 2))
+
+        paths = git("ls-tree", "-r", "--name-only", "refs/notes/bigstore").split()
+        self.assertEqual(len(paths), count + 2)
+        # New notes go in at the same depth as the others.
+        self.assertTrue(all("/" in path for path in paths))
+        self.assertEqual(show(object_sha(0)), "\t".join(entry(0)) + "\n\n" + "\t".join(entry(count + 1)) + "\n")
+        self.assertEqual(show(object_sha(count + 2)), "\t".join(entry(count + 2)) + "\n")
+        self.assertEqual(show(object_sha(150)), "\t".join(entry(150)) + "\n")
+
+
+if __name__ == '__main__':
+    unittest.main()